@@ -0,0 +1,144 @@
+import bisect
+import heapq
+import threading
+from collections.abc import Callable
+from datetime import datetime, timedelta
+
+from helpers import LRUCache
+
+# (start, end, one-on-one id), naive UTC datetimes
+Meeting = tuple[datetime, datetime, int]
+
+
+def ceil_to_step(moment: datetime, step: timedelta) -> datetime:
+    """Round a datetime up to the next multiple of step since midnight."""
+    midnight = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    steps = -(-(moment - midnight) // step)
+    return midnight + steps * step
+
+
+class UserCalendar:
+    """
+    Meetings of one user sorted by start. Meetings can overlap in databases created before
+    overlaps were rejected, so lookups also look back by the duration of the longest meeting.
+    """
+
+    def __init__(self, meetings: list[Meeting]):
+        self.meetings = sorted(meetings)
+        self.starts = [start for start, _, _ in self.meetings]
+        self.longest = max((end - start for start, end, _ in self.meetings), default=timedelta(0))
+
+    def overlapping(self, start: datetime, end: datetime) -> list[Meeting]:
+        """Return the meetings that overlap [start, end), in O(log n) plus the meetings returned."""
+        lo = bisect.bisect_right(self.starts, start - self.longest)
+        hi = bisect.bisect_left(self.starts, end)
+        return [meeting for meeting in self.meetings[lo:hi] if meeting[1] > start]
+
+    def iter_from(self, start: datetime):
+        """Yield the meetings that end after start, sorted by start."""
+        for i in range(bisect.bisect_right(self.starts, start - self.longest), len(self.meetings)):
+            if self.meetings[i][1] > start:
+                yield self.meetings[i]
+
+    def add(self, meeting: Meeting) -> None:
+        i = bisect.bisect_right(self.meetings, meeting)
+        self.meetings.insert(i, meeting)
+        self.starts.insert(i, meeting[0])
+        self.longest = max(self.longest, meeting[1] - meeting[0])
+
+    def remove(self, one_on_one_id: int, start: datetime) -> None:
+        lo = bisect.bisect_left(self.starts, start)
+        hi = bisect.bisect_right(self.starts, start)
+        for i in range(lo, hi):
+            if self.meetings[i][2] == one_on_one_id:
+                del self.meetings[i], self.starts[i]
+                return
+
+
+class AvailabilityIndex:
+    """
+    Per-worker calendars of recently active users, loaded from the database on first use
+    and updated as this worker schedules and cancels meetings. Calendars expire after ttl
+    seconds, so meetings written by other workers show up eventually. The database stays
+    the authority on conflicts, see DbManager.add_one_on_one.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 30.0):
+        self._calendars = LRUCache(maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def calendar(self, user_id: int, loader: Callable[[int], list[Meeting]]) -> UserCalendar:
+        """Return the calendar of a user, loading it with loader(user_id) when it is not cached."""
+        calendar = self._calendars.get(user_id)
+        if calendar is None:
+            calendar = UserCalendar(loader(user_id))
+            self._calendars.put(user_id, calendar)
+        return calendar
+
+    def conflicts(
+        self, user_ids: tuple[int, ...], start: datetime, end: datetime, loader
+    ) -> list[Meeting]:
+        """Return the meetings of any of the users that overlap [start, end)."""
+        calendars = [self.calendar(user_id, loader) for user_id in user_ids]
+        with self._lock:
+            found = {meeting[2]: meeting for c in calendars for meeting in c.overlapping(start, end)}
+        return sorted(found.values())
+
+    def add(self, user_ids: tuple[int, ...], meeting: Meeting) -> None:
+        with self._lock:
+            for user_id in user_ids:
+                calendar = self._calendars.get(user_id)
+                if calendar is not None:
+                    calendar.add(meeting)
+
+    def remove(self, user_ids: tuple[int, ...], one_on_one_id: int, start: datetime) -> None:
+        with self._lock:
+            for user_id in user_ids:
+                calendar = self._calendars.get(user_id)
+                if calendar is not None:
+                    calendar.remove(one_on_one_id, start)
+
+    def invalidate(self, *user_ids: int) -> None:
+        for user_id in user_ids:
+            self._calendars.pop(user_id)
+
+    def free_slots(
+        self,
+        user_ids: tuple[int, ...],
+        after: datetime,
+        duration: timedelta,
+        loader,
+        count: int = 5,
+        horizon: timedelta = timedelta(days=14),
+        step: timedelta = timedelta(minutes=15),
+    ) -> list[datetime]:
+        """
+        Return the starts of the next free slots that every user has, earliest first.
+
+        :param user_ids: Users that must all be free.
+        :param after: Earliest start, rounded up to a multiple of step.
+        :param duration: Length of each slot.
+        :param count: Maximum number of slots returned.
+        :param horizon: How far after `after` to look.
+        :param step: Slots start on multiples of step.
+        """
+        calendars = [self.calendar(user_id, loader) for user_id in user_ids]
+        with self._lock:
+            return self._free_slots(calendars, after, duration, count, after + horizon, step)
+
+    @staticmethod
+    def _free_slots(calendars, after, duration, count, until, step) -> list[datetime]:
+        candidate = ceil_to_step(after, step)
+        slots = []
+        for busy_start, busy_end, _ in heapq.merge(*(c.iter_from(candidate) for c in calendars)):
+            while candidate + duration <= min(busy_start, until) and len(slots) < count:
+                slots.append(candidate)
+                candidate = ceil_to_step(candidate + duration, step)
+            if len(slots) == count or busy_start >= until:
+                return slots
+            candidate = max(candidate, ceil_to_step(busy_end, step))
+        # fewer meetings than slots asked for, the rest of the horizon is free
+        while candidate + duration <= until and len(slots) < count:
+            slots.append(candidate)
+            candidate = ceil_to_step(candidate + duration, step)
+        return slots
@@ -0,0 +1,826 @@
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+from urllib.parse import urlencode
+
+from flask import Flask
+from sqlalchemy import create_engine
+
+from helpers import UserException
+from user_db import (
+    DEFAULT_SQLITE_PRAGMAS,
+    HOBBY_COUNT_DRIFT_SQL,
+    USER_OVERLAP_COUNTS_SQL,
+    WRITE_RETRIES,
+    WRITE_RETRY_DELAY,
+    DbManager,
+    apply_sqlite_pragmas,
+    db,
+)
+
+# app config of each login benchmark run, "inline" hashes passwords on the request thread
+LOGIN_MODES = {
+    "inline": {"PASSWORD_HASH_WORKERS": 0},
+    "pool": {},
+}
+
+# users seeded at each scale of the route benchmark, with a fifth as many hobbies
+ROUTE_SCALES = (100, 1000, 2000)
+# lets the route benchmark call the maintenance routes
+MAINTENANCE_TOKEN = "benchmark"
+
+# "worker" loads the model in every caller process, "service" sends every caller's texts to
+# one embedding service process
+EMBEDDING_MODES = ("worker", "service")
+
+# hobby pairs a good embedding puts close together (True) or far apart (False)
+HOBBY_PAIRS = [
+    ("football", "soccer", True),
+    ("football", "foosball", False),
+    ("playing guitar", "playing bass", True),
+    ("playing guitar", "playing chess", False),
+    ("hiking", "trekking", True),
+    ("hiking", "knitting", False),
+    ("oil painting", "watercolor painting", True),
+    ("oil painting", "oil changes", False),
+    ("swimming", "diving", True),
+    ("swimming", "baking", False),
+    ("chess", "board games", True),
+    ("chess", "cheese making", False),
+    ("running", "jogging", True),
+    ("running", "gardening", False),
+    ("photography", "filming videos", True),
+    ("photography", "pottery", False),
+    ("cooking", "baking", True),
+    ("cooking", "rock climbing", False),
+    ("yoga", "pilates", True),
+    ("yoga", "video games", False),
+]
+
+# "default" is SQLite's rollback journal as the app used it before, "tuned" is the app's current setup
+CONTENTION_MODES = {
+    "default": {},
+    "tuned": DEFAULT_SQLITE_PRAGMAS,
+}
+
+
+def _create_contention_db(db_path, users, hobbies):
+    """Create the app schema and fill it with users who each have a few of the hobbies, if any."""
+    engine = create_engine(f"sqlite:///{db_path}")
+    db.metadata.create_all(engine)
+    engine.dispose()
+
+    rng = random.Random(0)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO user (id, username, password) VALUES (?, ?, '')",
+            ((i, f"user{i}") for i in range(1, users + 1)),
+        )
+        conn.executemany(
+            "INSERT INTO hobby (id, name, user_count) VALUES (?, ?, 0)",
+            ((i, f"hobby {i}") for i in range(1, hobbies + 1)),
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO user_hobby (user_id, hobby_id) VALUES (?, ?)",
+            (
+                (u, rng.randint(1, hobbies))
+                for u in range(1, users + 1)
+                for _ in range(5 if hobbies else 0)
+            ),
+        )
+        conn.execute(
+            "UPDATE hobby SET user_count = (SELECT COUNT(*) FROM user_hobby WHERE hobby_id = hobby.id)"
+        )
+    conn.close()
+
+
+def _write(conn, rng, users, hobbies, retry):
+    """Add a random hobby to a random user like add_hobby_to_user does, optionally with retries."""
+    attempts = WRITE_RETRIES if retry else 1
+    for attempt in range(attempts):
+        try:
+            with conn:
+                user_id, hobby_id = rng.randint(1, users), rng.randint(1, hobbies)
+                conn.execute("SELECT id FROM hobby WHERE id = ?", (hobby_id,)).fetchone()
+                inserted = conn.execute(
+                    "INSERT OR IGNORE INTO user_hobby (user_id, hobby_id) VALUES (?, ?)",
+                    (user_id, hobby_id),
+                ).rowcount
+                if inserted:
+                    conn.execute(
+                        "UPDATE hobby SET user_count = user_count + 1 WHERE id = ?", (hobby_id,)
+                    )
+            return True
+        except sqlite3.OperationalError:
+            if attempt < attempts - 1:
+                time.sleep(WRITE_RETRY_DELAY * 2**attempt * (1 + rng.random()))
+    return False
+
+
+def _read(conn, rng, users):
+    """Run the two reads every home page load does."""
+    try:
+        conn.execute(
+            "SELECT id, name, user_count FROM hobby ORDER BY user_count DESC LIMIT 5"
+        ).fetchall()
+        conn.execute(
+            "SELECT hobby.id, hobby.name FROM hobby JOIN user_hobby ON user_hobby.hobby_id = hobby.id "
+            "WHERE user_hobby.user_id = ?",
+            (rng.randint(1, users),),
+        ).fetchall()
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+def _contention_worker(db_path, pragmas, role, duration, users, hobbies, seed, results):
+    conn = sqlite3.connect(db_path)
+    apply_sqlite_pragmas(conn, pragmas)
+    rng = random.Random(seed)
+    done = failed = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        if role == "write":
+            ok = _write(conn, rng, users, hobbies, retry=bool(pragmas))
+        else:
+            ok = _read(conn, rng, users)
+        done += ok
+        failed += not ok
+    conn.close()
+    results.put((role, done, failed))
+
+
+def benchmark_contention(readers=4, writers=4, duration=5.0, users=2000, hobbies=500):
+    """
+    Run reader and writer processes against one SQLite file, once per mode in
+    CONTENTION_MODES, and report the read and write throughput of each mode.
+    """
+    report = {}
+    for mode, pragmas in CONTENTION_MODES.items():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = Path(tmp_dir) / "contention.db"
+            _create_contention_db(db_path, users, hobbies)
+
+            results = multiprocessing.Queue()
+            roles = ["read"] * readers + ["write"] * writers
+            processes = [
+                multiprocessing.Process(
+                    target=_contention_worker,
+                    args=(db_path, pragmas, role, duration, users, hobbies, seed, results),
+                )
+                for seed, role in enumerate(roles)
+            ]
+            for process in processes:
+                process.start()
+            totals = {"read": [0, 0], "write": [0, 0]}
+            for _ in processes:
+                role, done, failed = results.get()
+                totals[role][0] += done
+                totals[role][1] += failed
+            for process in processes:
+                process.join()
+
+        report[mode] = {
+            "reads_per_sec": round(totals["read"][0] / duration, 1),
+            "writes_per_sec": round(totals["write"][0] / duration, 1),
+            "failed_reads": totals["read"][1],
+            "failed_writes": totals["write"][1],
+        }
+        print(f"{mode}: {report[mode]}")
+    return report
+
+
+def _hobby_stress_worker(instance_path, operations, users, hobbies, seed, results):
+    """Add and remove random hobbies of random users through DbManager, like concurrent requests do."""
+    app = Flask(__name__, instance_path=str(instance_path))
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{Path(instance_path) / DbManager.FILE_NAME}"
+    DbManager.init_db(app)
+
+    rng = random.Random(seed)
+    added = removed = rejected = errors = 0
+    with app.app_context():
+        for _ in range(operations):
+            user_id, hobby_number = rng.randint(1, users), rng.randint(1, hobbies)
+            try:
+                # every name maps to one id, as hobbies are never deleted
+                if rng.random() < 0.6:
+                    DbManager.add_hobby_to_user(user_id, f"hobby {hobby_number}")
+                    added += 1
+                else:
+                    DbManager.remove_hobby_from_user(user_id, hobby_number)
+                    removed += 1
+            except UserException:
+                rejected += 1
+            except Exception:
+                # e.g. an IntegrityError from two processes creating the same hobby
+                db.session.rollback()
+                errors += 1
+    DbManager.relation_jobs.shutdown()
+    results.put((added, removed, rejected, errors))
+
+
+def stress_hobbies(workers=8, operations=200, users=20, hobbies=10):
+    """
+    Add and remove the same few hobbies from several processes at once, then check that
+    no hobby was duplicated and that user_count and user_overlap match UserHobby exactly.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / DbManager.FILE_NAME
+        _create_contention_db(db_path, users, 0)
+
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=_hobby_stress_worker, args=(tmp_dir, operations, users, hobbies, seed, results)
+            )
+            for seed in range(workers)
+        ]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        totals = [0, 0, 0, 0]
+        for _ in processes:
+            for i, value in enumerate(results.get()):
+                totals[i] += value
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - start
+
+        conn = sqlite3.connect(db_path)
+        max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM hobby").fetchone()[0]
+        stored = "SELECT user_id, other_user_id, shared_count FROM user_overlap"
+        report = {
+            "added": totals[0],
+            "removed": totals[1],
+            "rejected": totals[2],
+            "errors": totals[3],
+            "operations_per_sec": round(sum(totals) / elapsed, 1),
+            "user_hobby_rows": conn.execute("SELECT COUNT(*) FROM user_hobby").fetchone()[0],
+            "duplicate_hobbies": conn.execute(
+                "SELECT COUNT(*) FROM (SELECT name FROM hobby GROUP BY name HAVING COUNT(*) > 1)"
+            ).fetchone()[0],
+            "drifted_user_counts": len(
+                conn.execute(HOBBY_COUNT_DRIFT_SQL, {"after": 0, "until": max_id}).fetchall()
+            ),
+            "drifted_user_overlap": conn.execute(
+                f"SELECT COUNT(*) FROM ({USER_OVERLAP_COUNTS_SQL} EXCEPT {stored})"
+            ).fetchone()[0]
+            + conn.execute(
+                f"SELECT COUNT(*) FROM ({stored} EXCEPT {USER_OVERLAP_COUNTS_SQL})"
+            ).fetchone()[0],
+        }
+        conn.close()
+
+    report["exact"] = (
+        report["added"] - report["removed"] == report["user_hobby_rows"]
+        and not report["errors"]
+        and not report["duplicate_hobbies"]
+        and not report["drifted_user_counts"]
+        and not report["drifted_user_overlap"]
+    )
+    print(f"stress: {report}")
+    return report
+
+
+def _configure_app(instance_path, config):
+    """Point flask_app, before it is imported, at the database in instance_path and apply config."""
+    os.environ["FLASK_SQLALCHEMY_DATABASE_URI"] = (
+        f"sqlite:///{Path(instance_path) / DbManager.FILE_NAME}"
+    )
+    os.environ["FLASK_LOG_FILE"] = str(Path(instance_path) / "app.log")
+    os.environ["FLASK_LOG_SAMPLE_RATE"] = "0"
+    for key, value in config.items():
+        os.environ[f"FLASK_{key}"] = json.dumps(value)
+
+
+def _serve_app(instance_path, config, ready):
+    """Serve flask_app from a temporary database with a threaded server, reporting the port."""
+    from werkzeug.serving import make_server
+
+    _configure_app(instance_path, config)
+    from flask_app import app
+    from password_hashing import password_hasher
+
+    # exit through the finally below on terminate(), so the hashing pool is shut down too
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    ready.put(server.server_port)
+    try:
+        server.serve_forever()
+    finally:
+        password_hasher.shutdown()
+
+
+def _request(port, method, path, body=None):
+    """Send one request and return its status code and latency in seconds."""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    headers = {"Content-Type": "application/x-www-form-urlencoded"} if body else {}
+    start = time.perf_counter()
+    conn.request(method, path, body=urlencode(body) if body else None, headers=headers)
+    status = conn.getresponse().status
+    conn.close()
+    return status, time.perf_counter() - start
+
+
+def _request_until(deadline, results, port, method, path, body=None):
+    """Repeat one request until the deadline, appending (status, latency) to results."""
+    while time.perf_counter() < deadline:
+        results.append(_request(port, method, path, body))
+
+
+def benchmark_login(login_clients=8, read_clients=4, duration=5.0):
+    """
+    Log in from several clients at once while other clients load the popular hobbies,
+    once per mode in LOGIN_MODES, and report login throughput and read latency.
+    """
+    report = {}
+    for mode, config in LOGIN_MODES.items():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ready = multiprocessing.Queue()
+            server = multiprocessing.Process(target=_serve_app, args=(tmp_dir, config, ready))
+            server.start()
+            port = ready.get(timeout=60)
+            credentials = {"username": "benchmark", "password": "benchmark"}
+            _request(port, "POST", "/register", credentials)
+
+            logins: list[tuple[int, float]] = []
+            reads: list[tuple[int, float]] = []
+            deadline = time.perf_counter() + duration
+            login_args = (deadline, logins, port, "POST", "/login", credentials)
+            read_args = (deadline, reads, port, "GET", "/popular_hobbies/1")
+            clients = [
+                threading.Thread(target=_request_until, args=login_args) for _ in range(login_clients)
+            ]
+            clients += [
+                threading.Thread(target=_request_until, args=read_args) for _ in range(read_clients)
+            ]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            server.terminate()
+            server.join()
+
+        statuses = [status for status, _ in logins]
+        latencies = sorted(latency for _, latency in reads)
+        report[mode] = {
+            "logins_per_sec": round(statuses.count(302) / duration, 1),
+            "rejected_logins": statuses.count(503),
+            "reads_per_sec": round(len(latencies) / duration, 1),
+            "read_p50_ms": round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+            "read_p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 2) if latencies else None,
+        }
+        print(f"{mode}: {report[mode]}")
+    return report
+
+
+def _percentiles(latencies):
+    """Return the p50, p95 and p99 of latencies in seconds, in milliseconds."""
+    latencies = sorted(latencies)
+    return {
+        f"p{p}_ms": round(latencies[min(len(latencies) - 1, len(latencies) * p // 100)] * 1000, 3)
+        for p in (50, 95, 99)
+    }
+
+
+def _route_context(db_path):
+    """Pick the users, hobbies and cursors that the route benchmark requests refer to."""
+    conn = sqlite3.connect(db_path)
+    free_hobbies = [
+        name
+        for (name,) in conn.execute(
+            "SELECT name FROM hobby WHERE id NOT IN (SELECT hobby_id FROM user_hobby WHERE user_id = 1) "
+            "ORDER BY id LIMIT 2"
+        )
+    ]
+    top_hobby = conn.execute("SELECT user_count, id FROM hobby ORDER BY user_count DESC, id").fetchone()
+    conn.close()
+    return {
+        # hobbies that user1 does not have yet, added and removed again by the write requests
+        "free_hobbies": free_hobbies + ["benchmark hobby a", "benchmark hobby b"][len(free_hobbies) :],
+        "popular_cursor": f"{top_hobby[0]}:{top_hobby[1]}",
+        "hobby_id": top_hobby[1],
+        "meeting_start": datetime.now(UTC).replace(tzinfo=None, minute=0, second=0, microsecond=0)
+        + timedelta(days=400),
+    }
+
+
+def _add_and_remove_hobby(client, ctx, i):
+    response = client.post(f"/add_hobby/{ctx['free_hobbies'][0]}")
+    ctx["added_hobby_id"] = response.get_json().get("hobby_id")
+    return response
+
+
+def _add_and_remove_hobbies(client, ctx, i):
+    response = client.post("/hobbies", json={"add": ctx["free_hobbies"]})
+    ctx["added_hobby_ids"] = [hobby["id"] for hobby in response.get_json().get("added", [])]
+    return response
+
+
+def _schedule_one_on_one(client, ctx, i):
+    start = ctx["meeting_start"] + timedelta(hours=i)
+    response = client.post(f"/schedule_one_on_one/3/{start.isoformat()}")
+    ctx["one_on_one_id"] = response.get_json().get("id")
+    return response
+
+
+# (method, rule, request) of every route the benchmark drives, run in this order in each round.
+# Write requests are undone by a later request of the same round, so every round sees the same data
+ROUTE_CASES = [
+    ("GET", "/", lambda client, ctx, i: client.get("/")),
+    ("GET", "/home", lambda client, ctx, i: client.get("/home")),
+    ("GET", "/get_current_user", lambda client, ctx, i: client.get("/get_current_user")),
+    ("GET", "/home_state", lambda client, ctx, i: client.get("/home_state")),
+    ("GET", "/popular_hobbies/<int:page_num>", lambda client, ctx, i: client.get("/popular_hobbies/1")),
+    (
+        "GET",
+        "/popular_hobbies/<int:page_num>?after",
+        lambda client, ctx, i: client.get(f"/popular_hobbies/2?after={ctx['popular_cursor']}"),
+    ),
+    ("GET", "/hobby/<int:hobby_id>", lambda client, ctx, i: client.get(f"/hobby/{ctx['hobby_id']}")),
+    (
+        "GET",
+        "/similar_hobbies/<int:hobby_id>",
+        lambda client, ctx, i: client.get(f"/similar_hobbies/{ctx['hobby_id']}"),
+    ),
+    ("GET", "/user/<string:username>", lambda client, ctx, i: client.get("/user/user2")),
+    ("GET", "/get_user_hobbies/<int:user_id>", lambda client, ctx, i: client.get("/get_user_hobbies/1")),
+    ("GET", "/most_common_user", lambda client, ctx, i: client.get("/most_common_user")),
+    (
+        "GET",
+        "/most_common_user_never_met",
+        lambda client, ctx, i: client.get("/most_common_user_never_met"),
+    ),
+    ("GET", "/free_slots/<int:user_id>", lambda client, ctx, i: client.get("/free_slots/2")),
+    (
+        "GET",
+        "/get_user_one_on_ones/<int:user_id>",
+        lambda client, ctx, i: client.get("/get_user_one_on_ones/1"),
+    ),
+    (
+        "GET",
+        "/get_user_one_on_ones/<int:user_id>/<any(upcoming, past):window>",
+        lambda client, ctx, i: client.get(f"/get_user_one_on_ones/1/{('upcoming', 'past')[i % 2]}"),
+    ),
+    ("GET", "/job_stats", lambda client, ctx, i: client.get("/job_stats")),
+    ("GET", "/cache_stats", lambda client, ctx, i: client.get("/cache_stats")),
+    (
+        "GET",
+        "/recount_hobbies/status",
+        lambda client, ctx, i: client.get(
+            "/recount_hobbies/status", headers={"X-Maintenance-Token": MAINTENANCE_TOKEN}
+        ),
+    ),
+    ("GET", "/login", lambda client, ctx, i: client.get("/login")),
+    ("GET", "/register", lambda client, ctx, i: client.get("/register")),
+    (
+        "POST",
+        "/login",
+        lambda client, ctx, i: client.post("/login", data={"username": "user1", "password": "password"}),
+    ),
+    (
+        "POST",
+        "/register",
+        lambda client, ctx, i: client.post(
+            "/register", data={"username": f"benchmark{i}", "password": "password"}
+        ),
+    ),
+    ("POST", "/add_hobby/<string:hobby_name>", _add_and_remove_hobby),
+    (
+        "DELETE",
+        "/remove_hobby/<int:hobby_id>",
+        lambda client, ctx, i: client.delete(f"/remove_hobby/{ctx['added_hobby_id']}"),
+    ),
+    ("POST", "/hobbies", _add_and_remove_hobbies),
+    (
+        "POST",
+        "/hobbies?remove",
+        lambda client, ctx, i: client.post("/hobbies", json={"remove": ctx["added_hobby_ids"]}),
+    ),
+    ("POST", "/schedule_one_on_one/<int:user_id>/<string:datetime_str>", _schedule_one_on_one),
+    (
+        "DELETE",
+        "/cancel_one_on_one/<int:one_on_one_id>",
+        lambda client, ctx, i: client.delete(f"/cancel_one_on_one/{ctx['one_on_one_id']}"),
+    ),
+]
+
+
+def _route_benchmark_worker(instance_path, rounds, backend, results):
+    """Drive every route in ROUTE_CASES through the test client as user1, rounds times."""
+    from embedding_backends import use_backend
+
+    use_backend(backend)
+    _configure_app(instance_path, {"PASSWORD_HASH_WORKERS": 0, "MAINTENANCE_TOKEN": MAINTENANCE_TOKEN})
+    from flask_app import app
+
+    # load the hobby index that benchmark_routes saved next to the database
+    app.instance_path = str(instance_path)
+    ctx = _route_context(Path(instance_path) / DbManager.FILE_NAME)
+    client = app.test_client()
+    client.post("/login", data={"username": "user1", "password": "password"})
+
+    samples = {f"{method} {rule}": ([], [], []) for method, rule, _ in ROUTE_CASES}
+    # round 0 warms up the caches and is not measured
+    for i in range(rounds + 1):
+        for method, rule, send in ROUTE_CASES:
+            start = time.perf_counter()
+            response = send(client, ctx, i)
+            latency = time.perf_counter() - start
+            if i:
+                latencies, queries, statuses = samples[f"{method} {rule}"]
+                latencies.append(latency)
+                queries.append(int(response.headers.get("X-Query-Count", 0)))
+                statuses.append(response.status_code)
+
+    covered = {(method, rule.split("?")[0]) for method, rule, _ in ROUTE_CASES}
+    skipped = sorted(
+        f"{method} {rule.rule}"
+        for rule in app.url_map.iter_rules()
+        for method in rule.methods - {"HEAD", "OPTIONS"}
+        if (method, rule.rule) not in covered
+    )
+    report = {
+        name: {
+            **_percentiles(latencies),
+            "requests_per_sec": round(len(latencies) / sum(latencies), 1),
+            "queries_per_request": round(sum(queries) / len(queries), 2),
+            "max_queries": max(queries),
+            "errors": sum(status >= 400 for status in statuses),
+        }
+        for name, (latencies, queries, statuses) in samples.items()
+    }
+    results.put((report, skipped))
+
+
+def benchmark_routes(scales=ROUTE_SCALES, rounds=50, backend="ngram-hash"):
+    """
+    Seed a database at each scale and time every route of flask_app through the test client,
+    reporting latency percentiles, queries per request, and the rows/sec of the seeding.
+    The hobbies are embedded with the given backend and indexed before the routes run, so
+    /similar_hobbies answers from the index like in production.
+    """
+    from embedding_backends import use_backend
+    from poe_commands import calculate_all_hobby_relations, seed_db
+
+    use_backend(backend)
+    report = {"commit": _current_commit(), "rounds": rounds, "backend": backend, "scales": {}}
+    for users in scales:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            seeded = seed_db(tmp_dir, users=users, hobbies=max(users // 5, 10))
+            calculate_all_hobby_relations(directory=tmp_dir)
+            results = multiprocessing.Queue()
+            worker = multiprocessing.Process(
+                target=_route_benchmark_worker, args=(tmp_dir, rounds, backend, results)
+            )
+            worker.start()
+            routes, skipped = results.get()
+            worker.join()
+
+        report["scales"][users] = {"seed": seeded, "routes": routes}
+        report["skipped_routes"] = skipped
+        print(f"{users} users:")
+        for name, stats in routes.items():
+            print(f"  {name}: {stats}")
+    print(f"not benchmarked: {', '.join(report['skipped_routes'])}")
+    return report
+
+
+def compare_route_results(baseline_file, results):
+    """Print how the p50 latency and queries of each route changed since a saved benchmark run."""
+    baseline = json.loads(Path(baseline_file).read_text())
+    for users, scale in results["scales"].items():
+        before = baseline["scales"].get(str(users))
+        if before is None:
+            continue
+        print(f"{users} users, compared with {baseline.get('commit') or baseline_file}:")
+        for name, stats in scale["routes"].items():
+            old = before["routes"].get(name)
+            if old:
+                change = (stats["p50_ms"] - old["p50_ms"]) / old["p50_ms"] * 100 if old["p50_ms"] else 0
+                print(
+                    f"  {name}: p50 {old['p50_ms']} -> {stats['p50_ms']} ms ({change:+.0f}%), "
+                    f"queries {old['queries_per_request']} -> {stats['queries_per_request']}"
+                )
+
+
+def _current_commit():
+    """Return the git commit the benchmark runs on, if this is a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _embedding_caller(socket_path, caller, duration, backend, results):
+    """Encode one new hobby name at a time for duration seconds, like workers adding hobbies."""
+    from embedding_backends import use_backend
+    from embedding_service import EmbeddingClient
+
+    if backend:
+        use_backend(backend)
+    client = EmbeddingClient()
+    client.socket_path = socket_path
+    started = time.perf_counter()
+    try:
+        client.encode([f"warm up {caller}"])
+    except Exception as e:
+        results.put(e)
+        return
+    first_encode = time.perf_counter() - started
+
+    latencies = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        client.encode([f"hobby {caller} {len(latencies)}"])
+        latencies.append(time.perf_counter() - start)
+    results.put((first_encode, latencies))
+
+
+def benchmark_embedding(callers=8, duration=5.0, backend=None):
+    """
+    Encode from several processes at once, once per mode in EMBEDDING_MODES, and report
+    encodes/sec, latency percentiles, the seconds until each caller's first embedding, and
+    how many requests the service batched per forward pass.
+    """
+    from embedding_service import EmbeddingClient, start_embedding_service, stop_embedding_service
+
+    report = {}
+    for mode in EMBEDDING_MODES:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            socket_path = os.path.join(tmp_dir, "embedding.sock") if mode == "service" else None
+            service_start = time.perf_counter()
+            service = start_embedding_service(socket_path, backend=backend) if socket_path else None
+            startup = time.perf_counter() - service_start
+
+            results = multiprocessing.Queue()
+            workers = [
+                multiprocessing.Process(
+                    target=_embedding_caller, args=(socket_path, i, duration, backend, results)
+                )
+                for i in range(callers)
+            ]
+            for worker in workers:
+                worker.start()
+            samples = [results.get() for _ in workers]
+            for worker in workers:
+                worker.join()
+            failures = [sample for sample in samples if isinstance(sample, Exception)]
+            if failures:
+                if service is not None:
+                    stop_embedding_service(service)
+                raise failures[0]
+
+            stats = None
+            if service is not None:
+                client = EmbeddingClient()
+                client.socket_path = socket_path
+                stats = client.service_stats()
+                stop_embedding_service(service)
+
+        latencies = [latency for _, caller_latencies in samples for latency in caller_latencies]
+        first_encodes = [first_encode for first_encode, _ in samples]
+        report[mode] = {
+            "encodes_per_sec": round(len(latencies) / duration, 1),
+            **_percentiles(latencies or [0.0]),
+            "service_startup_s": round(startup, 2) if service else None,
+            "max_first_encode_s": round(max(first_encodes), 3),
+            "avg_batch_requests": stats["avg_batch_requests"] if stats else None,
+        }
+        print(f"{mode}: {report[mode]}")
+    return report
+
+
+def _ranking_accuracy(backend):
+    """Return how often a related pair of HOBBY_PAIRS is more similar than an unrelated one."""
+    names = sorted({name for a, b, _ in HOBBY_PAIRS for name in (a, b)})
+    vectors = dict(zip(names, backend.encode(names), strict=True))
+    related = [float(vectors[a] @ vectors[b]) for a, b, close in HOBBY_PAIRS if close]
+    unrelated = [float(vectors[a] @ vectors[b]) for a, b, close in HOBBY_PAIRS if not close]
+    return sum(r > u for r in related for u in unrelated) / (len(related) * len(unrelated))
+
+
+def _embedding_backend_worker(key, texts, results):
+    """Measure one backend in a fresh process, so that its imports count toward its startup."""
+    import resource
+
+    from embedding_backends import get_backend
+
+    try:
+        start = time.perf_counter()
+        backend = get_backend(key)
+        backend.encode(["warm up"])
+        startup = time.perf_counter() - start
+
+        start = time.perf_counter()
+        backend.encode(texts)
+        elapsed = time.perf_counter() - start
+        results.put({
+            "startup_s": round(startup, 3),
+            "encodes_per_sec": round(len(texts) / elapsed, 1),
+            "ranking_accuracy": round(_ranking_accuracy(backend), 3),
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024,
+        })
+    except ImportError as e:
+        results.put({"skipped": str(e)})
+
+
+def benchmark_embedding_backends(texts=5000):
+    """
+    Compare the backends of embedding_backends.BACKENDS: seconds to import and encode the first
+    text, encodes/sec over texts hobby names, peak memory, and how often a related pair of
+    HOBBY_PAIRS scores higher than an unrelated one (1.0 always, 0.5 is chance).
+    """
+    from embedding_backends import BACKENDS
+
+    rng = random.Random(0)
+    words = sorted({word for a, b, _ in HOBBY_PAIRS for name in (a, b) for word in name.split()})
+    names = [" ".join(rng.sample(words, rng.randint(1, 3))) + f" {i}" for i in range(texts)]
+    report = {}
+    for key in BACKENDS:
+        results = multiprocessing.Queue()
+        worker = multiprocessing.Process(target=_embedding_backend_worker, args=(key, names, results))
+        worker.start()
+        report[key] = results.get()
+        worker.join()
+        print(f"{key}: {report[key]}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the web hobbies app.")
+    parser.add_argument(
+        "benchmark",
+        choices=["contention", "stress", "login", "routes", "embedding", "embedding-backends"],
+        help="Which benchmark to run.",
+    )
+    parser.add_argument("--output", type=str, help="Write the results to this JSON file.")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds each mode runs for.")
+    parser.add_argument(
+        "--readers", type=int, default=4, help="Number of reader processes, or reading clients."
+    )
+    parser.add_argument("--writers", type=int, default=4, help="Number of writer processes.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of stress test processes, login clients, or embedding callers.",
+    )
+    parser.add_argument(
+        "--operations", type=int, default=200, help="Hobby adds and removes per stress test process."
+    )
+    parser.add_argument(
+        "--scales",
+        type=int,
+        nargs="+",
+        default=ROUTE_SCALES,
+        help="Numbers of users the route benchmark seeds, one run per scale.",
+    )
+    parser.add_argument("--rounds", type=int, default=50, help="Requests per route and scale.")
+    parser.add_argument("--compare", type=str, help="JSON file of an earlier route benchmark run.")
+    parser.add_argument(
+        "--backend",
+        type=str,
+        help="Embedding backend of the embedding and routes benchmarks, see embedding_backends.",
+    )
+    parser.add_argument(
+        "--texts", type=int, default=5000, help="Hobby names each embedding backend encodes."
+    )
+
+    args = parser.parse_args()
+
+    if args.benchmark == "contention":
+        results = benchmark_contention(args.readers, args.writers, args.duration)
+    elif args.benchmark == "login":
+        results = benchmark_login(args.workers, args.readers, args.duration)
+    elif args.benchmark == "stress":
+        results = stress_hobbies(args.workers, args.operations)
+        if not results["exact"]:
+            raise SystemExit("Hobby counts drifted under concurrent writes.")
+    elif args.benchmark == "routes":
+        results = benchmark_routes(args.scales, args.rounds, args.backend or "ngram-hash")
+        if args.compare:
+            compare_route_results(args.compare, results)
+    elif args.benchmark == "embedding":
+        results = benchmark_embedding(args.workers, args.duration, args.backend)
+    elif args.benchmark == "embedding-backends":
+        results = benchmark_embedding_backends(args.texts)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
@@ -0,0 +1,157 @@
+import os
+import threading
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+# backend used by the web app, the embedding service and poe_commands, one of BACKENDS
+EMBEDDING_BACKEND = os.environ.get("WEB_HOBBIES_EMBEDDING_BACKEND", "sentence-transformers")
+
+
+class EmbeddingBackend(ABC):
+    """
+    Turns texts into unit length float32 vectors. Each backend stores its vectors in
+    hobby_embedding under its own name, so switching backends never compares vectors of two
+    different backends.
+    """
+
+    # key of the backend in BACKENDS
+    key = ""
+    # model column of the vectors in hobby_embedding
+    name = ""
+    # whether loading the backend is expensive enough that gunicorn workers should share one
+    # copy through embedding_service rather than load it each
+    share_between_workers = False
+
+    @abstractmethod
+    def encode(self, texts: list[str], batch_size: int = 256) -> np.ndarray:
+        """
+        Encode texts into unit length embeddings.
+
+        :param texts: Texts to encode.
+        :param batch_size: Number of texts encoded at once.
+        :return: float32 numpy array of shape (len(texts), dim).
+        """
+
+
+class SentenceTransformerBackend(EmbeddingBackend):
+    """
+    A sentence-transformers model, loaded on first use. Importing sentence_transformers pulls in
+    torch, which takes seconds and hundreds of MB, and the weights are downloaded on first use.
+    """
+
+    key = "sentence-transformers"
+    share_between_workers = True
+
+    def __init__(self, model_name: str = MODEL_NAME):
+        self.name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    def get_model(self):
+        """Load the embedding model on first use, which takes a moment."""
+        with self._lock:
+            if self._model is None:
+                from sentence_transformers import SentenceTransformer
+
+                self._model = SentenceTransformer(self.name)
+            return self._model
+
+    def encode(self, texts: list[str], batch_size: int = 256) -> np.ndarray:
+        return (
+            self.get_model()
+            .encode(
+                list(texts),
+                batch_size=batch_size,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+            )
+            .astype("float32", copy=False)
+        )
+
+
+class NgramHashingBackend(EmbeddingBackend):
+    """
+    Hashes the character n-grams of each text into `dim` signed buckets, with NumPy over
+    all texts of a batch at once. Needs no model and starts instantly, but only sees
+    spelling: "football" is close to "foosball", not to "soccer".
+    """
+
+    key = "ngram-hash"
+
+    def __init__(self, dim: int = 512, ngram_range: tuple[int, int] = (2, 4)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.name = f"ngram-hash-{ngram_range[0]}-{ngram_range[1]}-{dim}"
+
+    def encode(self, texts: list[str], batch_size: int = 256) -> np.ndarray:
+        texts = list(texts)
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            embeddings[start : start + batch_size] = self._encode_batch(
+                texts[start : start + batch_size]
+            )
+        return embeddings
+
+    def _encode_batch(self, texts: list[str]) -> np.ndarray:
+        # " playing  Football" -> " playing football ", the spaces mark the word boundaries
+        padded = [f" {' '.join(text.lower().split())} " for text in texts]
+        codes = np.frombuffer("".join(padded).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        rows = np.repeat(np.arange(len(padded)), [len(text) for text in padded])
+
+        buckets, weights = [], []
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            if len(codes) < n:
+                break
+            # n-grams that start and end in the same text
+            starts = np.flatnonzero(rows[: len(rows) - n + 1] == rows[n - 1 :])
+            hashes = np.full(len(starts), n, dtype=np.uint64)
+            for offset in range(n):
+                hashes = hashes * np.uint64(1_000_003) ^ codes[starts + offset]
+            # splitmix64 finalizer, so that similar n-grams land in unrelated buckets
+            hashes ^= hashes >> np.uint64(30)
+            hashes *= np.uint64(0xBF58476D1CE4E5B9)
+            hashes ^= hashes >> np.uint64(27)
+            hashes *= np.uint64(0x94D049BB133111EB)
+            hashes ^= hashes >> np.uint64(31)
+            buckets.append(rows[starts] * self.dim + (hashes % np.uint64(self.dim)).astype(np.int64))
+            # the top bit picks the sign, so that collisions cancel out on average
+            weights.append(np.where(hashes >> np.uint64(63), -1.0, 1.0))
+
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        if buckets:
+            embeddings = np.bincount(
+                np.concatenate(buckets), np.concatenate(weights), minlength=len(texts) * self.dim
+            ).reshape(len(texts), self.dim)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return (embeddings / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+BACKENDS = {backend.key: backend for backend in (SentenceTransformerBackend, NgramHashingBackend)}
+
+_backends: dict[str, EmbeddingBackend] = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(key: str | None = None) -> EmbeddingBackend:
+    """
+    Return the backend with the given key in BACKENDS, by default the one named by
+    WEB_HOBBIES_EMBEDDING_BACKEND or chosen with use_backend.
+    """
+    key = key or EMBEDDING_BACKEND
+    if key not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{key}', expected one of {', '.join(BACKENDS)}")
+    with _backends_lock:
+        if key not in _backends:
+            _backends[key] = BACKENDS[key]()
+        return _backends[key]
+
+
+def use_backend(key: str) -> EmbeddingBackend:
+    """Make the backend with the given key the default of this process."""
+    global EMBEDDING_BACKEND
+    backend = get_backend(key)
+    EMBEDDING_BACKEND = key
+    return backend
@@ -0,0 +1,302 @@
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+
+import numpy as np
+
+from embedding_backends import get_backend
+from helpers import encode_hobbies
+
+DEFAULT_CONFIG = {
+    # Unix socket of the embedding service that gunicorn_config starts, None encodes in the worker
+    "EMBEDDING_SERVICE_SOCKET": None,
+    # seconds a worker waits for the service before encoding in the worker itself
+    "EMBEDDING_SERVICE_TIMEOUT": 30.0,
+}
+
+# seconds the service waits for more requests once one arrives, merged into one forward pass
+BATCH_WINDOW = 0.005
+MAX_BATCH_SIZE = 256
+# encoded before the service accepts connections, so loading the model never stalls a request
+WARM_UP_TEXTS = ["warm up"]
+
+# lengths of the JSON header and of the binary body that follows it
+_FRAME = struct.Struct("!II")
+
+
+def _send(sock: socket.socket, header: dict, body: bytes = b"") -> None:
+    payload = json.dumps(header).encode("utf-8")
+    sock.sendall(_FRAME.pack(len(payload), len(body)) + payload + body)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise ConnectionError("Embedding service connection closed")
+        received += n
+    return bytes(buffer)
+
+
+def _recv(sock: socket.socket) -> tuple[dict, bytes]:
+    header_size, body_size = _FRAME.unpack(_recv_exactly(sock, _FRAME.size))
+    header = json.loads(_recv_exactly(sock, header_size))
+    return header, _recv_exactly(sock, body_size)
+
+
+class EmbeddingServer:
+    """
+    Encodes the texts sent by every gunicorn worker with one copy of the model. Requests
+    arriving within `window` seconds of each other run as one forward pass, and a text asked
+    for by several requests of a batch is encoded once.
+    """
+
+    def __init__(
+        self,
+        socket_path: str,
+        encode=encode_hobbies,
+        window: float = BATCH_WINDOW,
+        max_batch_size: int = MAX_BATCH_SIZE,
+    ):
+        self.socket_path = socket_path
+        self.encode = encode
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._requests: queue.Queue[tuple[list[str], Future]] = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "texts": 0, "batches": 0, "encoded": 0}
+
+    def serve_forever(self) -> None:
+        self.encode(WARM_UP_TEXTS, batch_size=self.max_batch_size)
+        Path(self.socket_path).unlink(missing_ok=True)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(128)
+        threading.Thread(target=self._batch_loop, name="embedding-batches", daemon=True).start()
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn: socket.socket) -> None:
+        # one connection per worker thread, kept open for all of its requests
+        with conn:
+            while True:
+                try:
+                    header, _ = _recv(conn)
+                except (ConnectionError, OSError):
+                    return
+                if header.get("op") == "stats":
+                    _send(conn, self.stats())
+                    continue
+
+                future: Future = Future()
+                self._requests.put((header["texts"], future))
+                try:
+                    embeddings = future.result()
+                except Exception as e:
+                    _send(conn, {"error": f"{type(e).__name__}: {e}"})
+                    continue
+                _send(conn, {"shape": list(embeddings.shape)}, embeddings.tobytes())
+
+    def _batch_loop(self) -> None:
+        while True:
+            batch = [self._requests.get()]
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.window
+            while size < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                size += len(batch[-1][0])
+            self._run(batch)
+
+    def _run(self, batch: list[tuple[list[str], Future]]) -> None:
+        unique = list(dict.fromkeys(text for texts, _ in batch for text in texts))
+        try:
+            embeddings = np.asarray(
+                self.encode(unique, batch_size=self.max_batch_size), dtype=np.float32
+            )
+        except Exception as e:
+            logging.exception("Embedding batch failed")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        with self._lock:
+            self._stats["requests"] += len(batch)
+            self._stats["texts"] += sum(len(texts) for texts, _ in batch)
+            self._stats["batches"] += 1
+            self._stats["encoded"] += len(unique)
+        rows = {text: i for i, text in enumerate(unique)}
+        for texts, future in batch:
+            future.set_result(embeddings[[rows[text] for text in texts]])
+
+    def stats(self) -> dict:
+        with self._lock:
+            batches = self._stats["batches"]
+            return {
+                **self._stats,
+                "avg_batch_requests": round(self._stats["requests"] / batches, 2) if batches else 0.0,
+            }
+
+
+def _serve(socket_path: str, window: float, max_batch_size: int, backend: str) -> None:
+    encode = get_backend(backend).encode
+    EmbeddingServer(socket_path, encode, window, max_batch_size).serve_forever()
+
+
+def start_embedding_service(
+    socket_path: str,
+    startup_timeout: float = 300.0,
+    window: float = BATCH_WINDOW,
+    max_batch_size: int = MAX_BATCH_SIZE,
+    backend: str | None = None,
+) -> multiprocessing.Process:
+    """
+    Start the embedding service in a process of its own, and wait until it has loaded the
+    model and accepts connections.
+
+    :param socket_path: Unix socket the service listens on.
+    :param startup_timeout: Seconds to wait for the model to load.
+    :param window: Seconds the service waits for more requests to batch with the first one.
+    :param max_batch_size: Texts per forward pass.
+    :param backend: Key of the embedding backend in BACKENDS, by default the one of this process.
+    :return: The service process, see stop_embedding_service.
+    """
+    Path(socket_path).unlink(missing_ok=True)
+    # a fresh interpreter, so the service shares no locks or threads with the gunicorn master
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    process = context.Process(
+        target=_serve,
+        args=(socket_path, window, max_batch_size, backend or get_backend().key),
+        name="embedding-service",
+        daemon=True,
+    )
+    process.start()
+
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if not process.is_alive():
+            raise RuntimeError(f"Embedding service exited with code {process.exitcode} while starting")
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(socket_path)
+            return process
+        except OSError:
+            time.sleep(0.1)
+    stop_embedding_service(process)
+    raise TimeoutError(f"Embedding service did not start within {startup_timeout} seconds")
+
+
+def detach_embedding_service(process: multiprocessing.Process) -> None:
+    """
+    Forget the embedding service in a process forked from the one that started it. A forked
+    process inherits the daemon processes multiprocessing started, and terminates them when
+    it exits, so a gunicorn worker that exits would otherwise take the service down with it.
+
+    :param process: The service process, as returned by start_embedding_service.
+    """
+    multiprocessing.process._children.discard(process)
+
+
+def stop_embedding_service(process: multiprocessing.Process) -> None:
+    process.terminate()
+    process.join(timeout=10)
+
+
+class EmbeddingClient:
+    """
+    Sends the texts of this worker to the embedding service when EMBEDDING_SERVICE_SOCKET is
+    set, and otherwise encodes them with a model loaded in this process. When the service
+    cannot be reached the worker encodes the texts itself, so embeddings never fail because
+    of the service.
+    """
+
+    def __init__(self):
+        self.socket_path: str | None = None
+        self.timeout = DEFAULT_CONFIG["EMBEDDING_SERVICE_TIMEOUT"]
+        self._local = threading.local()
+        # a forked worker opens connections of its own
+        os.register_at_fork(after_in_child=self._reset)
+
+    def init_app(self, app) -> None:
+        for key, value in DEFAULT_CONFIG.items():
+            app.config.setdefault(key, value)
+        self.socket_path = app.config["EMBEDDING_SERVICE_SOCKET"] or None
+        self.timeout = app.config["EMBEDDING_SERVICE_TIMEOUT"]
+
+    def _reset(self) -> None:
+        self._local = threading.local()
+
+    def _connection(self) -> socket.socket:
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        return sock
+
+    def _close(self) -> None:
+        sock = getattr(self._local, "sock", None)
+        self._local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def _request(self, header: dict) -> tuple[dict, bytes]:
+        sock = self._connection()
+        try:
+            _send(sock, header)
+            return _recv(sock)
+        except BaseException:
+            # a timed out or broken connection may still hold part of a response
+            self._close()
+            raise
+
+    def encode(self, texts: list[str], batch_size: int = 256) -> np.ndarray:
+        """
+        Encode texts into unit length embeddings, like helpers.encode_hobbies.
+
+        :param texts: Texts to encode.
+        :param batch_size: Texts per forward pass when encoding in this process.
+        :return: float32 numpy array of shape (len(texts), dim).
+        """
+        texts = list(texts)
+        if not self.socket_path or not texts:
+            return encode_hobbies(texts, batch_size=batch_size)
+        try:
+            header, body = self._request({"texts": texts})
+        except OSError:
+            logging.warning("Embedding service unavailable, encoding in this worker", exc_info=True)
+            return encode_hobbies(texts, batch_size=batch_size)
+        if "error" in header:
+            raise RuntimeError(f"Embedding service failed: {header['error']}")
+        return np.frombuffer(body, dtype=np.float32).reshape(header["shape"])
+
+    def service_stats(self) -> dict | None:
+        """Return the batching counters of the service, or None without one."""
+        if not self.socket_path:
+            return None
+        try:
+            return self._request({"op": "stats"})[0]
+        except OSError:
+            return None
+
+
+embedding_client = EmbeddingClient()
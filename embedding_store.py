@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+
+from embedding_backends import get_backend
+from embedding_service import embedding_client
+from helpers import LRUCache
+
+# SQLite limits the number of bound parameters per statement
+MAX_SQL_PARAMS = 500
+
+embedding_cache = LRUCache(int(os.environ.get("WEB_HOBBIES_EMBEDDING_CACHE_SIZE", 10_000)))
+
+
+def _chunks(items: list, size: int = MAX_SQL_PARAMS):
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def _from_blob(blob: bytes) -> np.ndarray:
+    # zero-copy view over the stored bytes
+    return np.frombuffer(blob, dtype=np.float32)
+
+
+def read_embeddings(conn, hobby_ids: list[int]) -> dict[int, np.ndarray]:
+    """
+    Read stored embeddings for the given hobbies, skipping any that are not stored yet.
+
+    :param conn: DB-API connection to the hobbies database.
+    :param hobby_ids: Ids of the hobbies to read.
+    :return: Mapping of hobby id to its embedding.
+    """
+    model = get_backend().name
+    found = {}
+    for chunk in _chunks(list(hobby_ids)):
+        placeholders = ", ".join("?" * len(chunk))
+        rows = conn.execute(
+            "SELECT hobby_id, vector FROM hobby_embedding "
+            f"WHERE model = ? AND hobby_id IN ({placeholders})",
+            (model, *chunk),
+        )
+        found.update({hobby_id: _from_blob(vector) for hobby_id, vector in rows})
+    return found
+
+
+def write_embeddings(conn, hobby_ids: list[int], embeddings: np.ndarray) -> None:
+    """Store the embeddings of the given hobbies, replacing any previous vector."""
+    model = get_backend().name
+    conn.executemany(
+        "INSERT OR REPLACE INTO hobby_embedding (hobby_id, model, vector) VALUES (?, ?, ?)",
+        (
+            (int(hobby_id), model, np.asarray(vector, dtype=np.float32).tobytes())
+            for hobby_id, vector in zip(hobby_ids, embeddings, strict=True)
+        ),
+    )
+
+
+def get_embeddings(conn, hobbies: list[tuple[int, str]], batch_size: int = 256) -> np.ndarray:
+    """
+    Return the embeddings for a list of hobbies, looking in the in-process LRU first,
+    then in the hobby_embedding table, and only running the model for hobbies that
+    have never been encoded, through the embedding service when there is one.
+
+    :param conn: DB-API connection to the hobbies database.
+    :param hobbies: (id, name) pairs of the hobbies to embed.
+    :param batch_size: Number of hobbies passed to the model per forward pass.
+    :return: float32 numpy array with one row per hobby, in the given order.
+    """
+    model = get_backend().name
+    vectors = {}
+    for hobby_id, _ in hobbies:
+        vector = embedding_cache.get((model, hobby_id))
+        if vector is not None:
+            vectors[hobby_id] = vector
+
+    missing = [hobby_id for hobby_id, _ in hobbies if hobby_id not in vectors]
+    vectors.update(read_embeddings(conn, missing))
+
+    to_encode = [(hobby_id, name) for hobby_id, name in hobbies if hobby_id not in vectors]
+    if to_encode:
+        ids = [hobby_id for hobby_id, _ in to_encode]
+        encoded = embedding_client.encode([name for _, name in to_encode], batch_size=batch_size)
+        write_embeddings(conn, ids, encoded)
+        vectors.update(zip(ids, encoded, strict=True))
+
+    for hobby_id, _ in hobbies:
+        embedding_cache.put((model, hobby_id), vectors[hobby_id])
+
+    if not hobbies:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.stack([vectors[hobby_id] for hobby_id, _ in hobbies])
+
+
+def find_embedding(conn, hobby_id: int) -> np.ndarray | None:
+    """Return the cached or stored embedding of a hobby without ever running the model."""
+    model = get_backend().name
+    vector = embedding_cache.get((model, hobby_id))
+    if vector is None:
+        vector = read_embeddings(conn, [hobby_id]).get(hobby_id)
+        if vector is not None:
+            embedding_cache.put((model, hobby_id), vector)
+    return vector
+
+
+def load_all_embeddings(conn) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Load every stored embedding of the current backend in a single read.
+
+    :param conn: DB-API connection to the hobbies database.
+    :return: (ids, embeddings) sorted by hobby id.
+    """
+    rows = conn.execute(
+        "SELECT hobby_id, vector FROM hobby_embedding WHERE model = ? ORDER BY hobby_id",
+        (get_backend().name,),
+    ).fetchall()
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+
+    ids = np.fromiter((hobby_id for hobby_id, _ in rows), dtype=np.int64, count=len(rows))
+    embeddings = _from_blob(b"".join(vector for _, vector in rows)).reshape(len(rows), -1)
+    return ids, embeddings
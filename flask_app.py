@@ -1,13 +1,23 @@
+import functools
+import hmac
 import logging
 from datetime import datetime
 from math import ceil
 
 import pytz
-from flask import Flask, jsonify, redirect, render_template, request, url_for
+from flask import Flask, Response, jsonify, redirect, render_template, request, url_for
 from flask_login import LoginManager, current_user, login_required, login_user, logout_user
 
+from embedding_service import embedding_client
+from embedding_store import embedding_cache
 from helpers import UserException
-from user_db import DbManager, User
+from jobs import BackgroundJobQueue
+from metrics import metrics
+from password_hashing import PasswordHasherBusy
+from query_counter import QueryBudgetExceeded, query_counter
+from request_logging import setup_logging
+from shared_cache import shared_cache
+from user_db import DEFAULT_MEETING_MINUTES, DEFAULT_SQLITE_PRAGMAS, DbManager, Hobby, OneOnOne, User
 
 app = Flask(__name__)
 app.secret_key = "your_secret_key"  # Needed for session handling
@@ -16,49 +26,79 @@ app.secret_key = "your_secret_key"  # Needed for session handling
 app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DbManager.FILE_NAME}"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+# SQLite pragmas applied to every connection, see user_db.DEFAULT_SQLITE_PRAGMAS
+app.config["SQLITE_PRAGMAS"] = DEFAULT_SQLITE_PRAGMAS
+
+# Maximum number of SQL queries per request, set QUERY_BUDGET_STRICT to fail instead of warn
+app.config["QUERY_BUDGET"] = 20
+app.config["QUERY_BUDGET_STRICT"] = False
+
+# bcrypt cost, and the process pool that hashes passwords off the request thread
+app.config["BCRYPT_ROUNDS"] = 12
+app.config["PASSWORD_HASH_WORKERS"] = 2
+app.config["PASSWORD_HASH_MAX_PENDING"] = 8
+
+# Users loaded for authenticated requests are cached per worker, see user_db.USER_CACHE_TTL
+app.config["USER_CACHE_SIZE"] = 1024
+app.config["USER_CACHE_TTL"] = 60.0
+
+# Set REDIS_URL to keep sessions in Redis and share cached lookups between workers, see shared_cache.py
+app.config["REDIS_URL"] = None
+
+# Maintenance routes such as /recount_hobbies need this value in the X-Maintenance-Token header,
+# and are disabled while it is unset. `poe recount-hobbies` needs no token
+app.config["MAINTENANCE_TOKEN"] = None
+
+# Any of the settings above can be overridden with an environment variable named FLASK_<setting>
+app.config.from_prefixed_env()
+
+# Server-side sessions and the shared cache, when REDIS_URL is set
+shared_cache.init_app(app)
+
+# Request and SQL metrics served at /metrics, set METRICS_DIR to add up several workers, see metrics.py
+metrics.init_app(app)
+
+# Encode hobbies in the embedding service when EMBEDDING_SERVICE_SOCKET is set, see embedding_service.py
+embedding_client.init_app(app)
+
 # Initialize the database
 DbManager.init_db(app)
 
+# Most hobbies added or removed by one request to /hobbies
+MAX_HOBBY_CHANGES = 50
+
+# Computes the independent parts of /home_state side by side
+home_state_jobs = BackgroundJobQueue("home-state", max_workers=4)
+
 # Initialize the LoginManager
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = "login"
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s: %(message)s",
-    handlers=[logging.FileHandler("app.log"), logging.StreamHandler()],
-)
 
-
-# Log each request
+# Count the queries of each request
 @app.before_request
-def log_request_info():
-    ip = request.remote_addr
-    user_agent = request.headers.get("User-Agent")
-    referrer = request.referrer
-    user = current_user.username if current_user.is_authenticated else "Anonymous"
-    timestamp = datetime.now().isoformat()
-    logging.info(
-        f"Request from {ip} by {user} at {timestamp}: {request.method} {request.url} - "
-        f"User-Agent: {user_agent} - Referrer: {referrer} - Data: {request.get_data()}"
-    )
+def start_query_count():
+    query_counter.start()
 
 
-# Log each response
 @app.after_request
-def log_response_info(response):
-    ip = request.remote_addr
-    user = current_user.username if current_user.is_authenticated else "Anonymous"
-    try:
-        response_data = response.get_data()
-    except RuntimeError:
-        response_data = b""
-    logging.info(f"Response to {ip} by {user}: {response.status} - Data: {response_data}")
+def check_query_count(response):
+    count = query_counter.stop()
+    budget = app.config["QUERY_BUDGET"]
+    response.headers["X-Query-Count"] = str(count)
+    if count > budget:
+        message = f"{request.method} {request.path} executed {count} queries, the budget is {budget}."
+        if app.config["QUERY_BUDGET_STRICT"]:
+            raise QueryBudgetExceeded(message)
+        logging.warning(message)
     return response
 
 
+# Configure logging, records are written by a background thread
+setup_logging(app)
+
+
 @login_manager.user_loader
 def load_user(user_id) -> User:
     """
@@ -70,7 +110,22 @@ def load_user(user_id) -> User:
     Returns:
         User: The user object.
     """
-    return DbManager.get_user_by_id(user_id)
+    return DbManager.get_cached_user(int(user_id))
+
+
+def maintenance_token_required(view):
+    """Answer 403 unless the request carries MAINTENANCE_TOKEN, and 404 when none is configured."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = app.config["MAINTENANCE_TOKEN"]
+        if not token:
+            return jsonify(success=False, message="Not found."), 404
+        if not hmac.compare_digest(request.headers.get("X-Maintenance-Token", ""), token):
+            return jsonify(success=False, message="Invalid maintenance token."), 403
+        return view(*args, **kwargs)
+
+    return wrapper
 
 
 @app.route("/")
@@ -112,6 +167,65 @@ def get_current_user():
     return jsonify(success=False, user="")
 
 
+def _in_app_context(fn, *args):
+    """
+    Call fn on a pool thread with an app context, and so a database session, of its own.
+    Return its result, or None for a UserException, with the number of queries it executed.
+    """
+    with app.app_context():
+        query_counter.start()
+        try:
+            return fn(*args), query_counter.stop()
+        except UserException:
+            return None, query_counter.stop()
+
+
+@app.route("/home_state", methods=["GET"])
+@login_required
+def home_state():
+    """
+    Get everything the home page shows in one response: the current user, their hobbies and
+    upcoming meetings, their matches and the first page of popular hobbies. Parts that need
+    the database are computed concurrently, matches come from the shared cache when possible.
+
+    Returns:
+        Response: A JSON response with the state of the home page.
+    """
+    user_id, limit = current_user.id, 20
+    parts = {
+        "hobbies": lambda: _hobbies_json(DbManager.get_user_hobbies(user_id)),
+        "upcoming": lambda: _one_on_ones_page(DbManager.get_upcoming_one_on_ones(user_id, limit), limit),
+    }
+    match_getters = {
+        "most_common_user": DbManager.get_most_common_user,
+        "never_met_user": DbManager.get_most_common_user_never_met,
+    }
+    matches = {}
+    for kind, match_id in DbManager.get_cached_match_ids(user_id).items():
+        if match_id is None:
+            parts[kind] = functools.partial(_match_json, match_getters[kind], user_id)
+        else:
+            matches[kind] = _user_json(DbManager.get_cached_user(match_id) if match_id else None)
+
+    futures = {name: home_state_jobs.submit(_in_app_context, part) for name, part in parts.items()}
+    popular = _popular_hobbies_page(1, None)
+    results = {}
+    for name, future in futures.items():
+        results[name], queries = future.result()
+        query_counter.add(queries)
+    matches.update((kind, results[kind]) for kind in match_getters if kind in parts)
+
+    return jsonify(
+        success=True,
+        user=_user_json(current_user),
+        hobbies=results["hobbies"],
+        one_on_ones=results["upcoming"],
+        most_common_user=matches["most_common_user"],
+        most_common_user_never_met=matches["never_met_user"],
+        popular_hobbies=popular,
+    )
+
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     """
@@ -131,6 +245,8 @@ def login():
                 logging.info(f"User {username} logged in from {request.remote_addr} at {datetime.now()}")
                 return redirect(url_for("home"))
             raise UserException("Invalid username or password! Try again.")
+        except PasswordHasherBusy as e:
+            return render_template("login.html", message=str(e)), 503, {"Retry-After": "1"}
         except UserException as e:
             return render_template("login.html", message=str(e))
     return render_template("login.html")
@@ -165,6 +281,8 @@ def register():
             DbManager.add_user(username, password)
             return redirect(url_for("login"))
         return render_template("register.html")
+    except PasswordHasherBusy as e:
+        return render_template("register.html", message=str(e)), 503, {"Retry-After": "1"}
     except UserException as e:
         return render_template("register.html", message=str(e))
 
@@ -207,31 +325,113 @@ def remove_hobby_route(hobby_id):
         return jsonify(success=False, message=str(e))
 
 
+def _user_json(user: User | None) -> dict | None:
+    return {"id": user.id, "username": user.username} if user else None
+
+
+def _hobbies_json(hobbies: list[Hobby]) -> list[dict]:
+    return [{"name": hobby.name, "id": hobby.id} for hobby in hobbies]
+
+
+def _match_json(get_match, user_id: int) -> dict | None:
+    return _user_json(get_match(user_id))
+
+
+def _popular_hobbies_page(page_num: int, after: tuple[int, int] | None, per_page: int = 5) -> dict:
+    """Return a page of the popular hobby ranking, as served by /popular_hobbies."""
+    hobbies, start = DbManager.get_popular_hobbies_page(per_page, after=after, page_num=page_num)
+    last = hobbies[-1] if hobbies else None
+    return {
+        "hobbies": [
+            {"name": name, "user_count": user_count, "id": hobby_id}
+            for user_count, hobby_id, name in hobbies
+        ],
+        "total_pages": ceil(DbManager.popular_hobbies.total / per_page),
+        "start": str(start + 1),
+        "next_cursor": f"{last[0]}:{last[1]}" if last else None,
+    }
+
+
+def _one_on_ones_page(meetings: list[tuple[OneOnOne, User]], limit: int) -> dict:
+    """Return a page of one-on-one meetings and the cursor of the next page, if it may not be empty."""
+    last = meetings[-1][0] if len(meetings) == limit else None
+    return {
+        "one_on_ones": [
+            {
+                "date": str(one_on_one.date),
+                "duration_minutes": one_on_one.duration_minutes,
+                "user": {"username": meeting_partner.username, "id": meeting_partner.id},
+                "id": one_on_one.id,
+            }
+            for one_on_one, meeting_partner in meetings
+        ],
+        "next_cursor": f"{last.date.isoformat()},{last.id}" if last else None,
+    }
+
+
+@app.route("/hobbies", methods=["POST"])
+@login_required
+def change_hobbies():
+    """
+    Add and remove several hobbies of the current user in one transaction. If any change
+    fails, none is applied.
+
+    JSON Body:
+        add (list[str]): Names of the hobbies to add.
+        remove (list[int]): IDs of the hobbies to remove.
+
+    Returns:
+        Response: A JSON response with the added hobbies and every hobby of the current user.
+    """
+    changes = request.get_json(silent=True) or {}
+    add, remove = changes.get("add", []), changes.get("remove", [])
+    if (
+        not isinstance(add, list)
+        or not isinstance(remove, list)
+        or not all(isinstance(name, str) for name in add)
+        or not all(isinstance(hobby_id, int) for hobby_id in remove)
+    ):
+        return jsonify(success=False, message="Expected lists of hobby names and hobby IDs."), 400
+    if len(add) + len(remove) > MAX_HOBBY_CHANGES:
+        return jsonify(success=False, message=f"At most {MAX_HOBBY_CHANGES} changes at once."), 400
+
+    try:
+        added = DbManager.apply_hobby_changes(current_user.id, add, remove)
+        hobbies = DbManager.get_user_hobbies(current_user.id)
+        return jsonify(success=True, added=_hobbies_json(added), hobbies=_hobbies_json(hobbies))
+    except UserException as e:
+        return jsonify(success=False, message=str(e))
+
+
 @app.route("/popular_hobbies/<int:page_num>", methods=["GET"])
 def popular_hobbies(page_num):
     """
-    Get a list of the most popular hobbies, paginated.
+    Get a list of the most popular hobbies, paginated. Pages are served from a cached
+    ranking, and carry an ETag so unchanged pages are answered with a 304.
 
     Args:
-        page_num (int): The page number to retrieve.
+        page_num (int): The page number to retrieve, used when no cursor is given.
+
+    Query Args:
+        after (str): "user_count:id" cursor of the last hobby of the previous page.
 
     Returns:
         Response: A JSON response with the list of popular hobbies.
     """
+    try:
+        after = request.args.get("after")
+        cursor = None
+        if after:
+            # unpacking raises ValueError too unless there are exactly two parts
+            user_count, hobby_id = after.split(":")
+            cursor = (int(user_count), int(hobby_id))
+    except ValueError:
+        return jsonify(success=False, message="Invalid cursor."), 400
 
-    page = int(page_num)
-    per_page = 5
-    offset = (page - 1) * per_page
-
-    hobbies = DbManager.get_most_popular_hobbies(limit=per_page, offset=offset)
-
-    return jsonify(
-        hobbies=[
-            {"name": hobby.name, "user_count": hobby.user_count, "id": hobby.id} for hobby in hobbies
-        ],
-        total_pages=ceil(DbManager.number_of_hobbies() / per_page),
-        start=str(offset + 1),
-    )
+    response = jsonify(**_popular_hobbies_page(page_num, cursor))
+    response.headers["Cache-Control"] = "no-cache"
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @app.route("/hobby/<int:hobby_id>")
@@ -248,7 +448,30 @@ def hobby(hobby_id):
 
     hobby = DbManager.get_hobby(hobby_id)
     users = DbManager.get_users_by_hobby(hobby_id)
-    return render_template("hobby.html", hobby=hobby, users=users)
+    similar_hobbies = [similar for similar, _ in DbManager.get_similar_hobbies(hobby_id, limit=5)]
+    return render_template("hobby.html", hobby=hobby, users=users, similar_hobbies=similar_hobbies)
+
+
+@app.route("/similar_hobbies/<int:hobby_id>", methods=["GET"])
+def similar_hobbies(hobby_id):
+    """
+    Get the hobbies most similar to a specific hobby, answered from the nearest neighbour index.
+
+    Args:
+        hobby_id (int): The ID of the hobby to find similar hobbies for.
+
+    Returns:
+        Response: A JSON response with the list of similar hobbies.
+    """
+    limit = min(request.args.get("limit", 10, type=int), 100)
+    similar = DbManager.get_similar_hobbies(hobby_id, limit=limit)
+    return jsonify(
+        success=True,
+        hobbies=[
+            {"name": hobby.name, "id": hobby.id, "similarity": round(similarity, 4)}
+            for hobby, similarity in similar
+        ],
+    )
 
 
 @app.route("/user/<string:username>")
@@ -284,7 +507,7 @@ def get_user_hobbies(user_id):
     try:
         user = DbManager.get_user_by_id(user_id)
         hobbies = DbManager.get_user_hobbies(user.id)
-        return jsonify(success=True, hobbies=[{"name": hobby.name, "id": hobby.id} for hobby in hobbies])
+        return jsonify(success=True, hobbies=_hobbies_json(hobbies))
     except UserException as e:
         return jsonify(success=False, message=str(e))
 
@@ -335,6 +558,9 @@ def schedule_one_on_one(user_id, datetime_str):
         user_id (int): The ID of the user to schedule the meeting with.
         datetime_str (str): The date and time of the meeting
 
+    Query Args:
+        duration (int): Length of the meeting in minutes, 30 by default.
+
     Returns:
         Response: A JSON response indicating success or failure.
     """
@@ -346,15 +572,52 @@ def schedule_one_on_one(user_id, datetime_str):
         if utc_time < datetime.now(pytz.UTC):
             raise UserException("Meeting must be scheduled in the future.")
 
-        # Schedule the one-on-one meeting
-        DbManager.add_one_on_one(current_user.id, user_id, utc_time)
-        return jsonify(success=True)
+        # Schedule the one-on-one meeting, unless it overlaps another meeting of either user
+        duration = request.args.get("duration", DEFAULT_MEETING_MINUTES, type=int)
+        one_on_one_id = DbManager.add_one_on_one(current_user.id, user_id, utc_time, duration)
+        return jsonify(success=True, id=one_on_one_id)
     except ValueError:
         return jsonify(success=False, message="Invalid date and time format. Use 'YYYY-MM-DD-HH-MM'.")
     except UserException as e:
         return jsonify(success=False, message=str(e))
 
 
+@app.route("/free_slots/<int:user_id>", methods=["GET"])
+@login_required
+def free_slots(user_id):
+    """
+    Get the next times at which both the current user and another user are free.
+
+    Args:
+        user_id (int): The ID of the user to meet.
+
+    Query Args:
+        duration (int): Length of the meeting in minutes, 30 by default.
+        count (int): Number of slots, at most 20.
+        after (str): Earliest start as an ISO date and time in UTC, now by default.
+
+    Returns:
+        Response: A JSON response with the UTC start of each free slot.
+    """
+    duration = request.args.get("duration", DEFAULT_MEETING_MINUTES, type=int)
+    count = min(request.args.get("count", 5, type=int), 20)
+    try:
+        after = request.args.get("after")
+        if after:
+            after = datetime.fromisoformat(after)
+            # naive times are UTC, like in schedule_one_on_one, rather than the server's local time
+            if after.tzinfo is not None:
+                after = after.astimezone(pytz.UTC).replace(tzinfo=None)
+    except ValueError:
+        return jsonify(success=False, message="Invalid date and time format."), 400
+
+    try:
+        slots = DbManager.get_free_slots(current_user.id, user_id, duration, after=after, count=count)
+        return jsonify(success=True, slots=[str(slot) for slot in slots])
+    except UserException as e:
+        return jsonify(success=False, message=str(e))
+
+
 @app.route("/cancel_one_on_one/<int:one_on_one_id>", methods=["DELETE"])
 @login_required
 def cancel_one_on_one(one_on_one_id):
@@ -392,16 +655,11 @@ def get_user_one_on_ones(user_id):
         Response: A JSON response with the list of one-on-one hobbies.
     """
     try:
-        user = DbManager.get_user_by_id(user_id)
-        one_on_ones = DbManager.get_user_one_on_ones(user.id)
-
         ret = []
-        for one_on_one in one_on_ones:
-            meeting_partner = DbManager.get_user_by_id(
-                one_on_one.user_id1 if one_on_one.user_id1 != current_user.id else one_on_one.user_id2
-            )
+        for one_on_one, meeting_partner in DbManager.get_user_one_on_ones_with_partners(user_id):
             ret.append({
                 "date": str(one_on_one.date),
+                "duration_minutes": one_on_one.duration_minutes,
                 "user": {"username": meeting_partner.username, "id": meeting_partner.id},
                 "id": one_on_one.id,
             })
@@ -410,17 +668,118 @@ def get_user_one_on_ones(user_id):
         return jsonify(success=False, message=str(e))
 
 
-@app.route("/recount_hobbies")
+@app.route("/get_user_one_on_ones/<int:user_id>/<any(upcoming, past):window>", methods=["GET"])
 @login_required
+def get_user_one_on_ones_window(user_id, window):
+    """
+    Get a page of a user's upcoming meetings, soonest first, or past meetings, latest first.
+
+    Args:
+        user_id (int): The ID of the user to retrieve one-on-one meetings for.
+        window (str): "upcoming" or "past".
+
+    Query Args:
+        limit (int): Number of meetings per page, at most 100.
+        cursor (str): next_cursor of the previous page.
+
+    Returns:
+        Response: A JSON response with a page of one-on-one meetings and the cursor of the next page.
+    """
+    limit = min(request.args.get("limit", 20, type=int), 100)
+    try:
+        cursor = request.args.get("cursor")
+        if cursor:
+            date, meeting_id = cursor.rsplit(",", 1)
+            cursor = (datetime.fromisoformat(date), int(meeting_id))
+    except ValueError:
+        return jsonify(success=False, message="Invalid cursor."), 400
+
+    if window == "upcoming":
+        meetings = DbManager.get_upcoming_one_on_ones(user_id, limit=limit, after=cursor)
+    else:
+        meetings = DbManager.get_past_one_on_ones(user_id, limit=limit, before=cursor)
+    return jsonify(success=True, **_one_on_ones_page(meetings, limit))
+
+
+@app.route("/recount_hobbies", methods=["POST"])
+@maintenance_token_required
 def recount_hobbies():
     """
-    Recount hobby participants for all hobbies.
+    Queue a recount of hobby participants for all hobbies, as a background job.
+
+    Query Args:
+        dry_run (bool): Only report the hobbies whose count has drifted.
+
+    Returns:
+        Response: A JSON response with the status of the recount job.
+    """
+    dry_run = request.args.get("dry_run", "false").lower() in ("1", "true", "yes")
+    return jsonify(success=True, job=DbManager.enqueue_recount_hobbies(dry_run=dry_run)), 202
+
+
+@app.route("/recount_hobbies/status", methods=["GET"])
+@maintenance_token_required
+def recount_hobbies_status():
+    """
+    Get the progress of the last hobby recount, and its drift report.
+
+    Returns:
+        Response: A JSON response with the status of the recount job.
+    """
+    return jsonify(success=True, job=DbManager.get_recount_status())
+
+
+@app.route("/job_stats", methods=["GET"])
+@login_required
+def job_stats():
+    """
+    Get the queue depth and latency of the background jobs, and the batching of the embedding
+    service.
 
     Returns:
-        Response: A redirect to the home page.
+        Response: A JSON response with the stats of each job queue, and of the embedding service
+            or null without one.
     """
-    DbManager.recount_hobbies()
-    return redirect(url_for("home"))
+    return jsonify(
+        success=True,
+        jobs=[
+            DbManager.relation_jobs.stats(),
+            DbManager.maintenance_jobs.stats(),
+            home_state_jobs.stats(),
+        ],
+        embedding_service=embedding_client.service_stats(),
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_route():
+    """
+    Get request latency, status codes and SQL statement timings of every worker, for Prometheus
+    to scrape.
+
+    Returns:
+        Response: The metrics in the Prometheus text format.
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/cache_stats", methods=["GET"])
+@login_required
+def cache_stats():
+    """
+    Get the size and hit rate of this worker's caches.
+
+    Returns:
+        Response: A JSON response with the stats of each cache.
+    """
+    return jsonify(
+        success=True,
+        caches={
+            "users": DbManager.user_cache.stats(),
+            "embeddings": embedding_cache.stats(),
+            "shared": shared_cache.stats(),
+        },
+    )
 
 
 # track redirects
@@ -1,2 +1,62 @@
+import os
+import tempfile
+
+from embedding_backends import get_backend
+from embedding_service import detach_embedding_service, start_embedding_service, stop_embedding_service
+from metrics import clear_metrics_dir
+
 bind = "0.0.0.0:8000"
 workers = 4
+
+# every worker writes its metrics to this directory, and /metrics adds them up
+metrics_dir = os.environ.setdefault(
+    "FLASK_METRICS_DIR", os.path.join(tempfile.gettempdir(), "web_hobbies_metrics")
+)
+
+# the workers share app.log, which logrotate rotates rather than the first worker to fill it, e.g.
+#   /path/to/app.log { daily; rotate 5; compress; missingok }
+os.environ.setdefault("FLASK_LOG_ROTATION", "external")
+
+# one process loads the embedding model and encodes for every worker, unless the backend is
+# cheap to load. Set FLASK_EMBEDDING_SERVICE_SOCKET to an empty value to load it in each worker
+if get_backend().share_between_workers:
+    os.environ.setdefault(
+        "FLASK_EMBEDDING_SERVICE_SOCKET",
+        os.path.join(tempfile.gettempdir(), "web_hobbies_embedding.sock"),
+    )
+embedding_socket = os.environ.get("FLASK_EMBEDDING_SERVICE_SOCKET")
+embedding_process = None
+
+
+def on_starting(server):
+    """
+    Start the metrics from zero on each server start, and start the embedding service, before
+    the workers are forked. Returns once the model is loaded, so no request waits for it.
+    """
+    global embedding_process
+    clear_metrics_dir(metrics_dir)
+    if embedding_socket:
+        embedding_process = start_embedding_service(embedding_socket)
+
+
+def pre_fork(server, worker):
+    """
+    Restart the embedding service if it died, before forking a worker that would use it, so
+    a crashed service does not leave every worker encoding by itself.
+    """
+    global embedding_process
+    if embedding_process is not None and not embedding_process.is_alive():
+        server.log.warning(
+            "Embedding service exited with code %s, restarting it", embedding_process.exitcode
+        )
+        embedding_process = start_embedding_service(embedding_socket)
+
+
+def post_fork(server, worker):
+    if embedding_process is not None:
+        detach_embedding_service(embedding_process)
+
+
+def on_exit(server):
+    if embedding_process is not None:
+        stop_embedding_service(embedding_process)
@@ -1,8 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+
+from embedding_backends import get_backend
+
+
 class UserException(Exception):
     pass
 
 
-model = None
+class LRUCache:
+    """
+    A small thread safe least-recently-used cache with a bounded size. Entries expire
+    ttl seconds after they were put, when a ttl is given.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (value, expiry time or None)
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.monotonic():
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = (value, None if self.ttl is None else time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """Return the size of the cache and its hit and miss counts since it was created."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+def encode_hobbies(hobby_names: list[str], batch_size: int = 256):
+    """
+    Encodes a list of hobbies into unit length embeddings in batches, with the embedding
+    backend chosen by WEB_HOBBIES_EMBEDDING_BACKEND, see embedding_backends.py.
+
+    :param hobby_names: Hobbies to encode.
+    :param batch_size: Number of hobbies passed to the model per forward pass.
+    :return: float32 numpy array of shape (len(hobby_names), dim).
+    """
+    return get_backend().encode(list(hobby_names), batch_size=batch_size)
 
 
 def hobby_similarity(hobby1: str, hobby2: str) -> float:
@@ -14,19 +91,11 @@ def hobby_similarity(hobby1: str, hobby2: str) -> float:
     :return: Similarity score between 0 and 1.
     """
 
-    # Load the embedding model, which takes a moment
-    global model
-    if model is None:
-        from sentence_transformers import SentenceTransformer, util
-
-        model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
-
-    # Convert hobbies to embeddings
-    emb1 = model.encode(hobby1, convert_to_tensor=True)
-    emb2 = model.encode(hobby2, convert_to_tensor=True)
+    # Convert both hobbies to embeddings in a single forward pass
+    emb1, emb2 = encode_hobbies([hobby1, hobby2])
 
-    # return cosine similarity
-    return util.cos_sim(emb1, emb2).item()
+    # embeddings are normalized, so the dot product is the cosine similarity
+    return float(emb1 @ emb2)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,208 @@
+import contextlib
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from embedding_backends import get_backend
+
+try:
+    import hnswlib
+except ImportError:  # pragma: no cover - optional dependency
+    hnswlib = None
+
+INDEX_DIR_NAME = "hobby_index"
+# file naming the version directory of the saved index, replaced in one rename
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = "lock"
+
+# keep only the k most similar hobbies per hobby in HobbyRelation, 0 keeps every pair
+RELATION_TOP_K = int(os.environ.get("WEB_HOBBIES_RELATION_TOP_K", 0))
+
+
+def index_directory(instance_path) -> Path:
+    """Return where the index of the current embedding backend is saved, one directory per backend."""
+    return Path(instance_path) / INDEX_DIR_NAME / get_backend().key
+
+
+@contextlib.contextmanager
+def write_lock(directory: Path):
+    """
+    Hold an exclusive lock on the saved index in directory, shared by every process, so that
+    one worker's read-modify-save of the index cannot overwrite another's.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / LOCK_FILE, "a+b") as lock_file:
+        if os.name == "nt":
+            import msvcrt
+
+            lock_file.seek(0)
+            # LK_LOCK retries for 10 seconds before giving up
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class HobbyIndex:
+    """
+    Nearest neighbour index over unit length hobby embeddings.
+
+    Uses an HNSW graph when hnswlib is installed (the ann extra), and falls back to an exact
+    matrix-vector scan otherwise. Both can be saved to and loaded from disk.
+    """
+
+    def __init__(self, dim: int, use_hnsw: bool | None = None, hnsw_path: Path | None = None):
+        self.dim = dim
+        self.use_hnsw = hnswlib is not None if use_hnsw is None else use_hnsw
+        self._lock = threading.Lock()
+        self._ids = np.empty(0, dtype=np.int64)
+        self._embeddings = np.empty((0, dim), dtype=np.float32)
+        self._hnsw = None
+        if self.use_hnsw:
+            self._hnsw = hnswlib.Index(space="ip", dim=dim)
+            if hnsw_path is None:
+                self._hnsw.init_index(max_elements=1024, ef_construction=200, M=16)
+            else:
+                self._hnsw.load_index(str(hnsw_path))
+            self._hnsw.set_ef(64)
+
+    @classmethod
+    def build(
+        cls, ids: np.ndarray, embeddings: np.ndarray, use_hnsw: bool | None = None
+    ) -> "HobbyIndex":
+        """Build an index from (ids, embeddings) as returned by load_all_embeddings."""
+        if not len(ids):
+            return cls(0, use_hnsw=False)
+        index = cls(embeddings.shape[1], use_hnsw=use_hnsw)
+        index.add(ids, embeddings)
+        return index
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, ids: np.ndarray, embeddings: np.ndarray) -> None:
+        """Add or replace the vectors of the given hobbies."""
+        ids = np.asarray(ids, dtype=np.int64)
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), self.dim)
+        with self._lock:
+            if self._hnsw is not None:
+                needed = self._hnsw.get_current_count() + len(ids)
+                if needed > self._hnsw.get_max_elements():
+                    self._hnsw.resize_index(max(needed, 2 * self._hnsw.get_max_elements()))
+                self._hnsw.add_items(embeddings, ids)
+                self._ids = np.union1d(self._ids, ids)
+                return
+
+            keep = ~np.isin(self._ids, ids)
+            self._ids = np.concatenate([self._ids[keep], ids])
+            self._embeddings = np.concatenate([self._embeddings[keep], embeddings])
+
+    def query_many(self, vectors: np.ndarray, k: int = 10) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Return the k hobbies closest to each of the given vectors.
+
+        :param vectors: Unit length query embeddings, one per row.
+        :param k: Number of neighbours to return per query, capped at the size of the index.
+        :return: (ids, similarities) arrays of shape (len(vectors), k), most similar first.
+        """
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        k = min(k, len(self))
+        if k == 0:
+            return np.empty((len(vectors), 0), dtype=np.int64), np.empty((len(vectors), 0), np.float32)
+
+        with self._lock:
+            if self._hnsw is not None:
+                labels, distances = self._hnsw.knn_query(vectors, k=k)
+                # inner product space reports 1 - <a, b> as the distance
+                return labels.astype(np.int64), 1.0 - distances
+
+            similarities = vectors @ self._embeddings.T
+            top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+            top_similarities = np.take_along_axis(similarities, top, axis=1)
+            order = np.argsort(-top_similarities, axis=1)
+            return self._ids[np.take_along_axis(top, order, axis=1)], np.take_along_axis(
+                top_similarities, order, axis=1
+            )
+
+    def query(
+        self, vector: np.ndarray, k: int = 10, exclude: int | None = None
+    ) -> list[tuple[int, float]]:
+        """
+        Return the k hobbies closest to the given vector.
+
+        :param vector: Unit length query embedding.
+        :param k: Number of neighbours to return.
+        :param exclude: Hobby id to leave out of the results, usually the queried hobby.
+        :return: (hobby id, cosine similarity) pairs, most similar first.
+        """
+        labels, similarities = self.query_many(vector, k + (exclude is not None))
+        neighbours = zip(labels[0].tolist(), similarities[0].tolist(), strict=True)
+        return [(hobby_id, sim) for hobby_id, sim in neighbours if hobby_id != exclude][:k]
+
+    def save(self, directory: Path) -> str:
+        """
+        Save the index into a new version directory inside directory, then point CURRENT at it
+        with one atomic rename, so readers load either the old or the new files, never a mix.
+        Versions older than the one replaced are removed. Concurrent writers must hold
+        write_lock(directory).
+
+        :return: The new version, see version().
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        version = f"v{time.time_ns()}-{os.getpid()}"
+        version_dir = directory / version
+        version_dir.mkdir()
+        with self._lock:
+            if self._hnsw is not None:
+                self._hnsw.save_index(str(version_dir / "hnsw.bin"))
+            else:
+                np.save(version_dir / "vectors.npy", self._embeddings)
+            np.save(version_dir / "ids.npy", self._ids)
+            meta = {"dim": self.dim, "use_hnsw": self.use_hnsw}
+            (version_dir / "meta.json").write_text(json.dumps(meta))
+
+        previous = self.version(directory)
+        (directory / f"{CURRENT_FILE}.tmp").write_text(version)
+        os.replace(directory / f"{CURRENT_FILE}.tmp", directory / CURRENT_FILE)
+
+        # the replaced version may still be loading in another process, older ones are unused
+        for path in directory.glob("v*"):
+            if path.is_dir() and path.name not in (version, previous):
+                shutil.rmtree(path, ignore_errors=True)
+        return version
+
+    @classmethod
+    def load(cls, directory: Path) -> "HobbyIndex":
+        """Load the current version saved with save(). Exact indexes are memory-mapped, not read."""
+        directory = Path(directory) / cls.version(directory)
+        meta = json.loads((directory / "meta.json").read_text())
+        index = cls(meta["dim"], use_hnsw=meta["use_hnsw"], hnsw_path=directory / "hnsw.bin")
+        index._ids = np.load(directory / "ids.npy")
+        if not index.use_hnsw:
+            index._embeddings = np.load(directory / "vectors.npy", mmap_mode="r")
+        return index
+
+    @staticmethod
+    def version(directory: Path) -> str | None:
+        """Return the version of the index saved in directory, or None if there is none."""
+        try:
+            return (Path(directory) / CURRENT_FILE).read_text().strip() or None
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,66 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class BackgroundJobQueue:
+    """
+    A thread pool owned by the app that runs slow work off the request thread, and keeps
+    track of how many jobs are waiting and how long they take.
+    """
+
+    def __init__(self, name: str, max_workers: int = 1):
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._completed = 0
+        self._failed = 0
+        self._total_latency = 0.0
+        self._last_latency = 0.0
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """Queue fn(*args, **kwargs) and return immediately."""
+        enqueued_at = time.perf_counter()
+        with self._lock:
+            self._pending += 1
+
+        def run():
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                logging.exception(f"Background job {fn.__name__} in {self.name} failed")
+                self._finish(enqueued_at, failed=True)
+                raise
+            self._finish(enqueued_at, failed=False)
+            return result
+
+        return self._executor.submit(run)
+
+    def _finish(self, enqueued_at: float, failed: bool) -> None:
+        latency = time.perf_counter() - enqueued_at
+        with self._lock:
+            self._pending -= 1
+            self._last_latency = latency
+            self._total_latency += latency
+            if failed:
+                self._failed += 1
+            else:
+                self._completed += 1
+
+    def stats(self) -> dict:
+        """Return the queue depth and job latency (from enqueue to completion) in milliseconds."""
+        with self._lock:
+            finished = self._completed + self._failed
+            return {
+                "name": self.name,
+                "queue_depth": self._pending,
+                "completed": self._completed,
+                "failed": self._failed,
+                "last_latency_ms": round(self._last_latency * 1000, 3),
+                "avg_latency_ms": round(self._total_latency / finished * 1000, 3) if finished else 0.0,
+            }
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,67 @@
+import bisect
+import threading
+import time
+from collections.abc import Callable
+
+
+class PopularHobbiesCache:
+    """
+    In-process ranking of hobbies by user count, refreshed from the database when its TTL
+    expires or when counts change, and paged with (user_count, id) keyset cursors.
+    """
+
+    def __init__(self, ttl: float = 30.0, min_refresh_interval: float = 1.0):
+        self.ttl = ttl
+        # counts can change on every request, so refreshes caused by changes are rate limited
+        self.min_refresh_interval = min_refresh_interval
+        self._lock = threading.Lock()
+        # (ranking, keys) replaced as one tuple, so readers never pair the keys of one refresh
+        # with the ranking of another
+        self._snapshot: tuple[list[tuple[int, int, str]], list[tuple[int, int]]] = ([], [])
+        self._loaded_at: float | None = None
+        self._stale = True
+
+    def invalidate(self) -> None:
+        """Mark the ranking as outdated, it is reloaded on the next read."""
+        self._stale = True
+
+    def _needs_refresh(self) -> bool:
+        if self._loaded_at is None:
+            return True
+        age = time.monotonic() - self._loaded_at
+        return age > self.ttl or (self._stale and age > self.min_refresh_interval)
+
+    def refresh_if_needed(self, loader: Callable[[], list[tuple[int, int, str]]]) -> None:
+        """Reload the ranking with loader, which returns (user_count, id, name) sorted by rank."""
+        if not self._needs_refresh():
+            return
+        with self._lock:
+            if not self._needs_refresh():
+                return
+            self._stale = False
+            ranking = [tuple(row) for row in loader()]
+            keys = [(-user_count, hobby_id) for user_count, hobby_id, _ in ranking]
+            self._snapshot = (ranking, keys)
+            self._loaded_at = time.monotonic()
+
+    @property
+    def total(self) -> int:
+        """Number of hobbies in the ranking, used instead of a COUNT(*) for the page count."""
+        return len(self._snapshot[0])
+
+    def page(
+        self, per_page: int, after: tuple[int, int] | None = None, page_num: int | None = None
+    ) -> tuple[list[tuple[int, int, str]], int]:
+        """
+        Return a page of the ranking and the rank of its first hobby (0 based).
+
+        :param per_page: Number of hobbies per page.
+        :param after: (user_count, id) of the last hobby of the previous page.
+        :param page_num: 1 based page number, used when no cursor is given.
+        """
+        ranking, keys = self._snapshot
+        if after is not None:
+            start = bisect.bisect_right(keys, (-after[0], after[1]))
+        else:
+            start = (max(page_num or 1, 1) - 1) * per_page
+        return ranking[start : start + per_page], start
@@ -0,0 +1,251 @@
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from flask import g, request
+from sqlalchemy import event
+
+DEFAULT_CONFIG = {
+    "METRICS_ENABLED": True,
+    # directory shared by the gunicorn workers, each writes its metrics to metrics_<pid>.json there
+    # and /metrics adds them up. None keeps the metrics of this process only
+    "METRICS_DIR": None,
+    # seconds between two writes of this worker's metrics, /metrics also writes them first
+    "METRICS_FLUSH_INTERVAL": 5.0,
+}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    "http_requests_total": ("counter", "Requests by endpoint, method and status code.", None),
+    "http_request_duration_seconds": ("histogram", "Request latency by endpoint.", LATENCY_BUCKETS),
+    "http_request_queries": (
+        "histogram",
+        "SQL statements per request by endpoint.",
+        QUERY_COUNT_BUCKETS,
+    ),
+    "db_query_duration_seconds": (
+        "histogram",
+        "SQL statement latency by endpoint, background work is labelled endpoint=background.",
+        QUERY_LATENCY_BUCKETS,
+    ),
+}
+
+# endpoint label of queries run outside a request, e.g. by background jobs
+BACKGROUND = "background"
+
+
+class MetricsCollector:
+    """
+    Counters and histograms of one process, kept in memory and written to a file of its own
+    so that several processes can be added up without sharing memory.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, labels) -> value, or [bucket counts..., sum] for histograms
+        self._counters: dict[tuple[str, tuple], float] = {}
+        self._histograms: dict[tuple[str, tuple], list[float]] = {}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def inc(self, name: str, labels: tuple, value: float = 1) -> None:
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float) -> None:
+        buckets = METRICS[name][2]
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # one count per bucket, one for +Inf, then the sum
+                histogram = self._histograms[key] = [0] * (len(buckets) + 2)
+            histogram[bisect.bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": [
+                    [name, list(labels), value] for (name, labels), value in self._counters.items()
+                ],
+                "histograms": [
+                    [name, list(labels), list(values)]
+                    for (name, labels), values in self._histograms.items()
+                ],
+            }
+
+    def flush(self, directory: str) -> None:
+        """Write the snapshot to directory/metrics_<pid>.json, replacing it atomically."""
+        path = Path(directory) / f"metrics_{os.getpid()}.json"
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.snapshot()))
+        os.replace(tmp_path, path)
+
+
+def merge_snapshots(snapshots) -> dict:
+    """Add up the snapshots of several processes."""
+    counters: dict[tuple[str, tuple], float] = {}
+    histograms: dict[tuple[str, tuple], list[float]] = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snapshot["histograms"]:
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                merged[i] += value
+    return {"counters": counters, "histograms": histograms}
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def render_prometheus(merged: dict) -> str:
+    """Render merged metrics in the Prometheus text exposition format."""
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        if kind == "counter":
+            for (metric, labels), value in sorted(merged["counters"].items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            continue
+        for (metric, labels), values in sorted(merged["histograms"].items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip((*buckets, "+Inf"), values[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels((*labels, ('le', bound)))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {values[-1]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+class Metrics:
+    """
+    Records request latency, status codes and SQL statements of the app with Flask and
+    SQLAlchemy hooks. Each recording is a few dictionary updates under a lock, so the
+    hooks can stay on in production.
+    """
+
+    def __init__(self):
+        self.collector = MetricsCollector()
+        self.directory: str | None = None
+        self.enabled = False
+        self.flush_interval = DEFAULT_CONFIG["METRICS_FLUSH_INTERVAL"]
+        self._last_flush = 0.0
+        self._local = threading.local()
+        # a forked worker starts from zero instead of counting its parent's requests again
+        os.register_at_fork(after_in_child=self.collector.reset)
+
+    def init_app(self, app) -> None:
+        """Register the request hooks, and the directory metrics are shared through."""
+        for key, value in DEFAULT_CONFIG.items():
+            app.config.setdefault(key, value)
+        self.enabled = app.config["METRICS_ENABLED"]
+        if not self.enabled:
+            return
+        self.directory = app.config["METRICS_DIR"]
+        self.flush_interval = app.config["METRICS_FLUSH_INTERVAL"]
+        if self.directory:
+            Path(self.directory).mkdir(parents=True, exist_ok=True)
+            atexit.register(self.flush)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def install(self, engine) -> None:
+        """Time the statements executed by the given engine."""
+        if not self.enabled or event.contains(
+            engine, "before_cursor_execute", self._before_cursor_execute
+        ):
+            return
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def _before_request(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_queries = 0
+        self._local.endpoint = request.endpoint or "unmatched"
+
+    def _after_request(self, response):
+        endpoint = self._local.endpoint
+        self.collector.inc(
+            "http_requests_total",
+            (("endpoint", endpoint), ("method", request.method), ("status", response.status_code)),
+        )
+        self.collector.observe(
+            "http_request_duration_seconds",
+            (("endpoint", endpoint),),
+            time.perf_counter() - g.metrics_start,
+        )
+        self.collector.observe("http_request_queries", (("endpoint", endpoint),), g.metrics_queries)
+        if self.directory and time.monotonic() - self._last_flush > self.flush_interval:
+            self.flush()
+        return response
+
+    def _teardown_request(self, exc):
+        self._local.endpoint = None
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_start", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["metrics_start"].pop()
+        endpoint = getattr(self._local, "endpoint", None)
+        if endpoint is None:
+            endpoint = BACKGROUND
+        else:
+            g.metrics_queries += 1
+        self.collector.observe("db_query_duration_seconds", (("endpoint", endpoint),), elapsed)
+
+    def flush(self) -> None:
+        if self.directory:
+            self._last_flush = time.monotonic()
+            self.collector.flush(self.directory)
+
+    def render(self) -> str:
+        """Return the metrics of every worker sharing METRICS_DIR, or of this one, as Prometheus text."""
+        if not self.directory:
+            return render_prometheus(merge_snapshots([self.collector.snapshot()]))
+        self.flush()
+        snapshots = []
+        for path in Path(self.directory).glob("metrics_*.json"):
+            try:
+                snapshots.append(json.loads(path.read_text()))
+            except (OSError, ValueError):
+                # a worker replaced or removed its file while it was read
+                continue
+        return render_prometheus(merge_snapshots(snapshots))
+
+
+def clear_metrics_dir(directory: str) -> None:
+    """Remove the files of a previous server run, call it once before the workers start."""
+    path = Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+    for file in path.glob("metrics_*"):
+        file.unlink(missing_ok=True)
+
+
+metrics = Metrics()
@@ -0,0 +1,115 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+from helpers import UserException
+
+DEFAULT_CONFIG = {
+    # bcrypt cost factor, stored hashes with another cost are rehashed on the next login
+    "BCRYPT_ROUNDS": 12,
+    # processes that hash passwords, 0 hashes on the request thread instead
+    "PASSWORD_HASH_WORKERS": 2,
+    # hashes waiting for or running in the pool, further logins fail fast with PasswordHasherBusy
+    "PASSWORD_HASH_MAX_PENDING": 8,
+    "PASSWORD_HASH_TIMEOUT": 10.0,
+}
+
+
+class PasswordHasherBusy(UserException):
+    pass
+
+
+def _hash_password(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check_password(password: bytes, hashed: bytes) -> bool:
+    return bcrypt.checkpw(password, hashed)
+
+
+def hash_rounds(hashed: str) -> int:
+    """Return the cost factor of a bcrypt hash such as $2b$12$..."""
+    return int(hashed.split("$")[2])
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt in a small process pool, so a burst of logins cannot occupy every web
+    worker, and turns requests away once too many hashes are already pending.
+    """
+
+    def __init__(self):
+        self.config = dict(DEFAULT_CONFIG)
+        self._executor: ProcessPoolExecutor | None = None
+        self._slots = threading.BoundedSemaphore(self.config["PASSWORD_HASH_MAX_PENDING"])
+        self._lock = threading.Lock()
+
+    def init_app(self, app) -> None:
+        """Read the hashing settings from the app config, using DEFAULT_CONFIG for missing keys."""
+        for key, value in DEFAULT_CONFIG.items():
+            self.config[key] = app.config.setdefault(key, value)
+        self._slots = threading.BoundedSemaphore(self.config["PASSWORD_HASH_MAX_PENDING"])
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # started on first use, so each gunicorn worker gets its own pool after forking
+        with self._lock:
+            if self._executor is None:
+                # forking a web worker copies its threads' locks, forkserver starts from a clean process
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context(
+                    "forkserver" if "forkserver" in methods else "spawn"
+                )
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.config["PASSWORD_HASH_WORKERS"], mp_context=context
+                )
+            return self._executor
+
+    def _run(self, fn, *args):
+        if not self.config["PASSWORD_HASH_WORKERS"]:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy("Too many logins at once, please try again in a moment.")
+        try:
+            executor = self._get_executor()
+            return executor.submit(fn, *args).result(timeout=self.config["PASSWORD_HASH_TIMEOUT"])
+        except TimeoutError as e:
+            raise PasswordHasherBusy("Logins are slow right now, please try again in a moment.") from e
+        except BrokenProcessPool as e:
+            # a hashing process died, e.g. to the OOM killer, and the pool refuses all further work
+            self._discard_executor(executor)
+            raise PasswordHasherBusy("Logins are unavailable, please try again in a moment.") from e
+        finally:
+            self._slots.release()
+
+    def _discard_executor(self, executor: ProcessPoolExecutor) -> None:
+        """Replace a broken pool with a new one on next use, unless another thread already did."""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def hash(self, password: str) -> str:
+        """Hash a password with the configured cost."""
+        return self._run(_hash_password, password.encode("utf-8"), self.config["BCRYPT_ROUNDS"]).decode(
+            "utf-8"
+        )
+
+    def check(self, password: str, hashed: str) -> bool:
+        """Check a password against a stored hash."""
+        return self._run(_check_password, password.encode("utf-8"), hashed.encode("utf-8"))
+
+    def needs_rehash(self, hashed: str) -> bool:
+        """Return whether a stored hash was made with another cost than the configured one."""
+        return hash_rounds(hashed) != self.config["BCRYPT_ROUNDS"]
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+password_hasher = PasswordHasher()
@@ -1,11 +1,76 @@
 import argparse
+import base64
+import contextlib
+import csv
+import functools
+import gzip
+import itertools
 import sqlite3
+import tempfile
+import time
+from datetime import UTC, datetime, timedelta
 from pathlib import Path
 
+import bcrypt
+import numpy as np
 import pandas as pd
+from flask import Flask
+from sqlalchemy import LargeBinary, create_engine, event
+from sqlalchemy.schema import CreateColumn
+
+from embedding_backends import BACKENDS, use_backend
+from embedding_store import get_embeddings
+from helpers import UserException
+from hobby_index import RELATION_TOP_K, HobbyIndex, index_directory, write_lock
+from password_hashing import DEFAULT_CONFIG as PASSWORD_HASH_CONFIG
+from user_db import (
+    DEFAULT_SQLITE_PRAGMAS,
+    USER_OVERLAP_COUNTS_SQL,
+    DbManager,
+    Hobby,
+    apply_sqlite_pragmas,
+    db,
+    recount_hobby_counts,
+)
+
+# every column that references a hobby, used when hobbies are merged
+HOBBY_ID_COLUMNS = (
+    ("user_hobby", "hobby_id"),
+    ("hobby_relation", "hobby_id1"),
+    ("hobby_relation", "hobby_id2"),
+    ("hobby_embedding", "hobby_id"),
+    ("hobby", "id"),
+)
+
+
+def connect_db(db_path):
+    """Connect to the database with the same pragmas as the web app, so commands wait for locks."""
+    conn = sqlite3.connect(db_path)
+    apply_sqlite_pragmas(conn, DEFAULT_SQLITE_PRAGMAS)
+    return conn
+
+
+def create_missing_tables(db_path):
+    """Create any table defined in user_db that does not exist yet in the given database."""
+    engine = create_engine(f"sqlite:///{db_path}")
+    db.metadata.create_all(engine)
+    engine.dispose()
 
-from helpers import hobby_similarity
-from user_db import DbManager
+
+def add_missing_columns(db_path):
+    """Add the columns defined in user_db that existing tables lack, filled with their defaults."""
+    engine = create_engine(f"sqlite:///{db_path}")
+    added = []
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info("{table.name}")')}
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                    conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN {ddl}')
+                    added.append(f"{table.name}.{column.name}")
+    engine.dispose()
+    return added
 
 
 def delete_db(directory):
@@ -24,85 +89,819 @@ def delete_db(directory):
             print(f"'{db_file}' is not a valid database file.")
 
 
-def export_db_to_excel(directory, output_file):
+EXPORT_FORMATS = ("xlsx", "csv", "parquet")
+EXPORT_COMPRESSIONS = ("gzip", "zstd")
+EXPORT_CHUNKSIZE = 10_000
+# rows of an Excel sheet, including the header
+EXCEL_MAX_ROWS = 1_048_576
+
+
+def _export_tables(conn):
+    """Return (table, [(column, declared type), ...]) for every table but SQLite's own."""
+    names = [
+        row[0]
+        for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' "
+            "ORDER BY name"
+        )
+    ]
+    return [
+        (name, [(row[1], row[2].upper()) for row in conn.execute(f'PRAGMA table_info("{name}")')])
+        for name in names
+    ]
+
+
+def _iter_chunks(conn, table, columns, chunksize, blobs_as_text=False):
+    """
+    Yield the rows of a table chunksize at a time, so memory use does not grow with the table.
+
+    :param blobs_as_text: Base64 encode BLOB columns, for formats that only hold text.
+    """
+    select = ", ".join(f'"{name}"' for name, _ in columns)
+    blob_columns = [i for i, (_, declared) in enumerate(columns) if "BLOB" in declared]
+    cursor = conn.execute(f'SELECT {select} FROM "{table}"')
+    while rows := cursor.fetchmany(chunksize):
+        if blobs_as_text and blob_columns:
+            rows = [list(row) for row in rows]
+            for row in rows:
+                for i in blob_columns:
+                    if row[i] is not None:
+                        row[i] = base64.b64encode(row[i]).decode("ascii")
+        yield rows
+
+
+def _open_text_output(path, compression):
+    if compression == "gzip":
+        return gzip.open(path, "wt", compresslevel=6, encoding="utf-8", newline="")
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise SystemExit(
+                "zstd compression needs the export extra: poetry install --extras export"
+            ) from None
+        return zstandard.open(path, "wt", encoding="utf-8", newline="")
+    return open(path, "w", encoding="utf-8", newline="")
+
+
+def _parquet_type(pa, declared):
+    # the affinity rules of SQLite, dates are stored as text and stay text
+    if "INT" in declared:
+        return pa.int64()
+    if any(name in declared for name in ("REAL", "FLOA", "DOUB")):
+        return pa.float64()
+    if "BLOB" in declared:
+        return pa.binary()
+    return pa.string()
+
+
+def _export_excel(conn, tables, output, chunksize):
+    from openpyxl import Workbook
+
+    for table, _ in tables:
+        (rows,) = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()
+        if rows >= EXCEL_MAX_ROWS:
+            raise SystemExit(
+                f"Table '{table}' has {rows} rows, more than an Excel sheet holds, "
+                "export to csv or parquet instead."
+            )
+
+    # write-only sheets stream their rows to temporary files instead of keeping them in memory
+    workbook = Workbook(write_only=True)
+    counts = {}
+    for table, columns in tables:
+        sheet = workbook.create_sheet(table)
+        sheet.append([name for name, _ in columns])
+        counts[table] = 0
+        for rows in _iter_chunks(conn, table, columns, chunksize, blobs_as_text=True):
+            for row in rows:
+                sheet.append(row)
+            counts[table] += len(rows)
+    workbook.save(output)
+    return counts
+
+
+def _export_csv(conn, tables, output, chunksize, compression):
+    suffix = {None: ".csv", "gzip": ".csv.gz", "zstd": ".csv.zst"}[compression]
+    counts = {}
+    for table, columns in tables:
+        with _open_text_output(Path(output) / f"{table}{suffix}", compression) as file:
+            writer = csv.writer(file)
+            writer.writerow([name for name, _ in columns])
+            counts[table] = 0
+            for rows in _iter_chunks(conn, table, columns, chunksize, blobs_as_text=True):
+                writer.writerows(rows)
+                counts[table] += len(rows)
+    return counts
+
+
+def _export_parquet(conn, tables, output, chunksize, compression):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit(
+            "Parquet export needs the export extra: poetry install --extras export"
+        ) from None
+
+    counts = {}
+    for table, columns in tables:
+        schema = pa.schema([(name, _parquet_type(pa, declared)) for name, declared in columns])
+        # each chunk becomes one row group, compressed by parquet itself
+        with pq.ParquetWriter(
+            Path(output) / f"{table}.parquet", schema, compression=compression or "snappy"
+        ) as writer:
+            counts[table] = 0
+            for rows in _iter_chunks(conn, table, columns, chunksize):
+                arrays = [
+                    pa.array(values, type=field.type)
+                    for values, field in zip(zip(*rows), schema, strict=True)
+                ]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                counts[table] += len(rows)
+    return counts
+
+
+def export_db(directory, output, fmt=None, compression=None, chunksize=EXPORT_CHUNKSIZE):
+    """
+    Export every table of the database, reading chunksize rows at a time, so memory use stays
+    the same however large the tables are.
+
+    :param directory: Directory of the database.
+    :param output: The Excel file for xlsx, or a directory that gets one file per table for
+        csv (<table>.csv, .csv.gz or .csv.zst) and parquet (<table>.parquet).
+    :param fmt: One of EXPORT_FORMATS, by default xlsx unless output ends in .csv or .parquet.
+    :param compression: None, gzip or zstd. Parquet compresses its pages with it, csv the whole
+        file. xlsx files are zip archives already.
+    :param chunksize: Rows read per fetch, and rows per parquet row group.
+    :return: Rows exported per table.
+    """
+    db_path = Path(directory) / DbManager.FILE_NAME
+    if not db_path.exists() or not db_path.is_file():
+        print(f"Database '{db_path}' does not exist.")
+        return None
+
+    fmt = fmt or {".csv": "csv", ".parquet": "parquet"}.get(Path(output).suffix, "xlsx")
+    if fmt not in EXPORT_FORMATS:
+        raise SystemExit(f"Unknown export format '{fmt}', expected one of {', '.join(EXPORT_FORMATS)}.")
+    if compression not in (None, *EXPORT_COMPRESSIONS):
+        raise SystemExit(f"Unknown compression '{compression}', expected gzip or zstd.")
+    if fmt == "xlsx" and compression:
+        raise SystemExit("xlsx files are compressed already, export to csv or parquet to compress them.")
+
+    conn = connect_db(db_path)
+    # one pass over each table gains nothing from mapping the file, and mapped pages count
+    # toward the memory of the process
+    conn.execute("PRAGMA mmap_size = 0")
+    tables = _export_tables(conn)
+    start = time.perf_counter()
+    try:
+        if fmt == "xlsx":
+            counts = _export_excel(conn, tables, output, chunksize)
+        else:
+            Path(output).mkdir(parents=True, exist_ok=True)
+            if fmt == "csv":
+                counts = _export_csv(conn, tables, output, chunksize, compression)
+            else:
+                counts = _export_parquet(conn, tables, output, chunksize, compression)
+    finally:
+        conn.close()
+    elapsed = time.perf_counter() - start
+
+    for table, rows in counts.items():
+        print(f"{table}: {rows} rows")
+    print(f"Database exported to '{output}' in {elapsed:.1f}s.")
+    return counts
+
+
+def export_db_to_excel(directory, output_file, chunksize=EXPORT_CHUNKSIZE):
+    return export_db(directory, output_file, "xlsx", chunksize=chunksize)
+
+
+def _lower_triangle_pairs(ids, embeddings, tile_size):
+    """Yield (hobby_id1, hobby_id2, similarity) for every pair with hobby_id1 > hobby_id2.
+
+    The cosine matrix is computed one block of rows at a time, so memory use is bounded
+    by tile_size * len(ids) instead of len(ids) ** 2.
+    """
+    n = len(ids)
+    for start in range(0, n, tile_size):
+        end = min(start + tile_size, n)
+        block = embeddings[start:end] @ embeddings[:end].T
+
+        # keep only the columns left of the diagonal, ids are sorted ascending
+        rows, cols = np.nonzero(np.arange(end)[None, :] < np.arange(start, end)[:, None])
+        yield from zip(
+            ids[rows + start].tolist(), ids[cols].tolist(), block[rows, cols].tolist(), strict=True
+        )
+
+
+def _top_k_pairs(index, ids, embeddings, top_k, tile_size):
+    """Yield (hobby_id1, hobby_id2, similarity) for the top_k neighbours of every hobby.
+
+    Pairs are ordered so that hobby_id1 > hobby_id2, like the dense table, and a pair may be
+    yielded twice when both hobbies are in each other's top_k.
+    """
+    for start in range(0, len(ids), tile_size):
+        end = min(start + tile_size, len(ids))
+        labels, similarities = index.query_many(embeddings[start:end], top_k + 1)
+
+        # drop each hobby from its own neighbours
+        rows, cols = np.nonzero(labels != ids[start:end, None])
+        hobby_ids, neighbour_ids = ids[start:end][rows], labels[rows, cols]
+        yield from zip(
+            np.maximum(hobby_ids, neighbour_ids).tolist(),
+            np.minimum(hobby_ids, neighbour_ids).tolist(),
+            similarities[rows, cols].tolist(),
+            strict=True,
+        )
+
+
+def calculate_all_hobby_relations(
+    batch_size=256, tile_size=1024, top_k=RELATION_TOP_K, directory="instance"
+):
     db_path = Path(directory) / DbManager.FILE_NAME
     if not db_path.exists() or not db_path.is_file():
         print(f"Database '{db_path}' does not exist.")
         return
 
     # Connect to the SQLite database
-    conn = sqlite3.connect(db_path)
-
-    # Get the list of tables
-    tables = pd.read_sql_query("SELECT name FROM sqlite_master WHERE type='table'", conn)
-
-    # Write each table to a separate sheet in the Excel file
-    with pd.ExcelWriter(output_file) as writer:
-        for table_name in tables["name"]:
-            df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
-            df.to_excel(writer, sheet_name=table_name, index=False)
-
-    print(f"Database exported to '{output_file}' successfully.")
+    create_missing_tables(db_path)
+    conn = connect_db(db_path)
+
+    # get list of hobbies, sorted so that the lower triangle holds hobby_id1 > hobby_id2
+    hobbies = pd.read_sql_query("SELECT id, name FROM hobby ORDER BY id", conn)
+    ids = hobbies["id"].to_numpy()
+    n_pairs = len(ids) * (len(ids) - 1) // 2
+
+    # encode every hobby once, in batches, reusing the vectors stored by previous runs
+    start_time = time.perf_counter()
+    with conn:
+        embeddings = get_embeddings(
+            conn, list(zip(ids.tolist(), hobbies["name"], strict=True)), batch_size=batch_size
+        )
+    encode_time = time.perf_counter() - start_time
+
+    # save the nearest neighbour index used by /similar_hobbies
+    index = HobbyIndex.build(ids, embeddings)
+    directory = index_directory(db_path.parent)
+    with write_lock(directory):
+        index.save(directory)
+
+    # save the similarity scores in the hobby_relation table in a single transaction
+    if top_k:
+        pairs = _top_k_pairs(index, ids, embeddings, top_k, tile_size)
+    else:
+        pairs = _lower_triangle_pairs(ids, embeddings, tile_size)
+    with conn:
+        if top_k:
+            conn.execute("DELETE FROM hobby_relation")
+        conn.executemany(
+            "INSERT OR REPLACE INTO hobby_relation (hobby_id1, hobby_id2, similarity) VALUES (?, ?, ?)",
+            pairs,
+        )
+    if top_k:
+        n_pairs = conn.execute("SELECT COUNT(*) FROM hobby_relation").fetchone()[0]
+    total_time = time.perf_counter() - start_time
+
+    print(
+        f"Calculated {n_pairs} relations for {len(ids)} hobbies in {total_time:.2f}s "
+        f"(encoding {encode_time:.2f}s, {n_pairs / max(total_time - encode_time, 1e-9):.0f} pairs/sec)."
+    )
 
-    # Close the connection
     conn.close()
 
 
-def calculate_all_hobby_relations():
-    db_path = Path("instance") / DbManager.FILE_NAME
+def rebuild_user_overlap(directory, verify_only=False):
+    """Compare the user_overlap table against UserHobby, and rebuild it when it has drifted."""
+    db_path = Path(directory) / DbManager.FILE_NAME
     if not db_path.exists() or not db_path.is_file():
         print(f"Database '{db_path}' does not exist.")
-        return
+        return None
+
+    create_missing_tables(db_path)
+    conn = connect_db(db_path)
+
+    # rows that are missing or wrong, and rows that should not exist
+    columns = "user_id, other_user_id, shared_count"
+    stored = f"SELECT {columns} FROM user_overlap"
+    missing = conn.execute(
+        f"SELECT COUNT(*) FROM ({USER_OVERLAP_COUNTS_SQL} EXCEPT {stored})"
+    ).fetchone()[0]
+    extra = conn.execute(f"SELECT COUNT(*) FROM ({stored} EXCEPT {USER_OVERLAP_COUNTS_SQL})").fetchone()[
+        0
+    ]
+    print(f"user_overlap drift: {missing} missing or outdated rows, {extra} stale rows.")
+
+    if (missing or extra) and not verify_only:
+        with conn:
+            conn.execute("DELETE FROM user_overlap")
+            conn.execute(f"INSERT INTO user_overlap ({columns}) {USER_OVERLAP_COUNTS_SQL}")
+        print("user_overlap rebuilt successfully.")
 
-    # Connect to the SQLite database
-    conn = sqlite3.connect(db_path)
-
-    # get list of hobbies
-    hobbies = pd.read_sql_query("SELECT id, name FROM hobby", conn).values
+    conn.close()
+    return missing + extra
 
-    for h1_id, h1_name in hobbies:
-        for h2_id, h2_name in hobbies:
-            if h1_id <= h2_id:
-                continue
 
-            similarity = hobby_similarity(h1_name, h2_name)
+def recount_hobbies(directory, dry_run=False, batch_size=1000):
+    """Recount the users of every hobby, or with dry_run only report the hobbies that drifted."""
+    db_path = Path(directory) / DbManager.FILE_NAME
+    if not db_path.exists() or not db_path.is_file():
+        print(f"Database '{db_path}' does not exist.")
+        return None
 
-            # save the similarity score in the database in hobby_relations table
-            conn.execute(
-                "INSERT INTO hobby_relation (hobby_id1, hobby_id2, similarity) VALUES (?, ?, ?)",
-                (h1_id, h2_id, similarity),
-            )
+    def progress(report):
+        print(f"Checked {report['processed']}/{report['total']} hobbies, {report['drifted']} drifted.")
 
-    conn.commit()
+    conn = connect_db(db_path)
+    report = recount_hobby_counts(conn, dry_run=dry_run, batch_size=batch_size, progress=progress)
     conn.close()
 
-
-def import_excel_to_db(directory, input_file):
+    for hobby in report["drift"]:
+        print(f"  {hobby['id']} {hobby['name']!r}: stored {hobby['stored']}, actual {hobby['actual']}")
+    if report["drifted"] > len(report["drift"]):
+        print(f"  ... and {report['drifted'] - len(report['drift'])} more.")
+    print("Dry run, nothing was updated." if dry_run else f"Updated {report['drifted']} hobbies.")
+    return report
+
+
+def _merge_duplicate_hobbies(conn):
+    """Normalize hobby names, and merge hobbies that have the same name once normalized."""
+    kept_ids = {}
+    merged, renamed = [], []
+    for hobby_id, name in conn.execute("SELECT id, name FROM hobby ORDER BY id").fetchall():
+        normalized = DbManager.normalize_hobby_name(name)
+        if normalized in kept_ids:
+            merged.append((kept_ids[normalized], hobby_id))
+        else:
+            kept_ids[normalized] = hobby_id
+            if normalized != name:
+                renamed.append((normalized, hobby_id))
+
+    # move users to the hobby that is kept, then drop every row of the duplicates
+    conn.executemany(
+        "INSERT OR IGNORE INTO user_hobby (user_id, hobby_id) "
+        "SELECT user_id, ? FROM user_hobby WHERE hobby_id = ?",
+        merged,
+    )
+    duplicate_ids = [(duplicate_id,) for _, duplicate_id in merged]
+    for table, column in HOBBY_ID_COLUMNS:
+        conn.executemany(f"DELETE FROM {table} WHERE {column} = ?", duplicate_ids)
+    conn.executemany("UPDATE hobby SET name = ? WHERE id = ?", renamed)
+    if merged:
+        conn.execute(
+            "UPDATE hobby SET user_count = (SELECT COUNT(*) FROM user_hobby WHERE hobby_id = hobby.id)"
+        )
+    return len(merged)
+
+
+def _capture_db_manager_queries(schema_db_path):
+    """Run every DbManager query against a small database and return the SQL it executed."""
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{Path(schema_db_path).resolve()}"
+    DbManager.init_db(app)
+
+    statements = []
+    with app.app_context():
+
+        @event.listens_for(db.engine, "before_cursor_execute")
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            # executemany passes a list of parameter sets, one of them is enough to explain
+            if parameters and isinstance(parameters[0], (list, tuple, dict)):
+                parameters = parameters[0]
+            statements.append((statement, parameters))
+
+        DbManager.add_user("explain_user1", "password")
+        DbManager.add_user("explain_user2", "password")
+        user1, user2 = DbManager.get_user("explain_user1"), DbManager.get_user("explain_user2")
+        DbManager.get_user_by_id(user1.id)
+
+        # hobbies are inserted directly so that no relation job is queued
+        db.session.add_all([Hobby(name="explain hobby1"), Hobby(name="explain hobby2")])
+        db.session.commit()
+        hobby = DbManager.add_hobby_to_user(user1.id, "explain hobby1")
+        DbManager.add_hobby_to_user(user2.id, "explain hobby1")
+        DbManager.add_hobby_to_user(user2.id, "explain hobby2")
+
+        DbManager.get_user_hobbies(user1.id)
+        DbManager.number_of_hobbies()
+        DbManager.get_most_popular_hobbies()
+        DbManager.get_hobby(hobby.id)
+        DbManager.get_users_by_hobby(hobby.id)
+        DbManager.get_most_common_user(user1.id)
+        DbManager.get_most_common_user_never_met(user1.id)
+        with contextlib.suppress(UserException):
+            DbManager.get_most_similar_user(user1.id, never_met=True)
+
+        DbManager.add_one_on_one(user1.id, user2.id, datetime(2100, 1, 1))
+        DbManager.find_conflicts(user1.id, user2.id, datetime(2100, 1, 1))
+        DbManager.availability.invalidate(user1.id, user2.id)
+        DbManager.get_free_slots(user1.id, user2.id)
+        (one_on_one, _), *_ = DbManager.get_user_one_on_ones_with_partners(user1.id)
+        DbManager.get_upcoming_one_on_ones(user1.id)
+        DbManager.get_upcoming_one_on_ones(user1.id, after=(datetime(2000, 1, 1), 0))
+        DbManager.get_past_one_on_ones(user1.id)
+        DbManager.get_past_one_on_ones(user1.id, before=(datetime(2100, 1, 1), 0))
+        DbManager.get_one_on_one(one_on_one.id)
+        DbManager.cancel_one_on_one(one_on_one.id)
+        DbManager.remove_hobby_from_user(user2.id, hobby.id)
+        DbManager.apply_hobby_changes(user1.id, ["explain hobby2"], [hobby.id])
+        db.session.remove()
+        db.engine.dispose()
+
+    return statements
+
+
+def verify_query_plans(db_path):
+    """
+    Check every DbManager query with EXPLAIN QUERY PLAN against the schema of the given
+    database, and return the queries that scan a whole table instead of using an index.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        schema_db_path = Path(tmp_dir) / DbManager.FILE_NAME
+        with sqlite3.connect(db_path) as source, sqlite3.connect(schema_db_path) as schema_db:
+            for (sql,) in source.execute(
+                "SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'"
+            ):
+                schema_db.execute(sql)
+
+        statements = _capture_db_manager_queries(schema_db_path)
+
+        failures = []
+        conn = sqlite3.connect(schema_db_path)
+        for statement, parameters in statements:
+            if not statement.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE")):
+                continue
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+            subqueries = {
+                detail.split()[-1]
+                for *_, detail in plan
+                if detail.startswith(("CO-ROUTINE", "MATERIALIZE"))
+            }
+            scans = [
+                detail
+                for *_, detail in plan
+                if detail.startswith("SCAN ")
+                and " USING " not in detail
+                and detail.split()[1] not in subqueries
+                and detail != "SCAN CONSTANT ROW"
+            ]
+            if scans:
+                failures.append((" ".join(statement.split()), scans))
+        conn.close()
+    return failures
+
+
+def migrate_db(directory):
+    """Bring an existing database up to the current schema and indexes, then verify its query plans."""
     db_path = Path(directory) / DbManager.FILE_NAME
     if not db_path.exists() or not db_path.is_file():
         print(f"Database '{db_path}' does not exist.")
         return
 
-    input_file = Path(input_file)
-    if not input_file.exists() or not input_file.is_file():
-        print(f"Excel file '{input_file}' does not exist.")
-        return
+    create_missing_tables(db_path)
+    for column in add_missing_columns(db_path):
+        print(f"Added column {column}.")
+    # the connection's context manager only commits, closing() also closes it
+    with contextlib.closing(connect_db(db_path)) as conn, conn:
+        merged = _merge_duplicate_hobbies(conn)
+    print(f"Merged {merged} duplicate hobbies.")
+
+    engine = create_engine(f"sqlite:///{db_path}")
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+    engine.dispose()
+    print("Indexes created successfully.")
+
+    rebuild_user_overlap(directory)
+
+    failures = verify_query_plans(db_path)
+    for statement, scans in failures:
+        print(f"Full table scan ({'; '.join(scans)}) in: {statement}")
+    if failures:
+        raise SystemExit(f"{len(failures)} queries do not use an index.")
+    print("Every DbManager query uses an index.")
+
+
+def seed_db(
+    directory,
+    users=1000,
+    hobbies=200,
+    hobbies_per_user=5,
+    meetings_per_user=4,
+    zipf_exponent=1.1,
+    seed=0,
+    password="password",
+):
+    """
+    Fill an empty database with synthetic data: users who each have a few hobbies, with
+    hobby popularity following a Zipf distribution, and a history of past and upcoming
+    one-on-ones. Rows are bulk inserted in one transaction, and user_count and user_overlap
+    are computed in SQL afterwards.
+
+    :param directory: Directory of the database, created if needed.
+    :param users: Number of users, named user1, user2, ... with the given password.
+    :param hobbies: Number of hobbies, "hobby 1" being the most popular.
+    :param hobbies_per_user: Average number of hobbies per user.
+    :param meetings_per_user: Average number of one-on-ones per user.
+    :param zipf_exponent: The n-th most popular hobby is picked with a weight of n ** -zipf_exponent.
+    :param seed: Seed of the random generator, the same seed gives the same data.
+    :return: Rows and rows/sec per table, or None if the database already has users.
+    """
+    db_path = Path(directory) / DbManager.FILE_NAME
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    create_missing_tables(db_path)
+    conn = connect_db(db_path)
+    if conn.execute("SELECT 1 FROM user LIMIT 1").fetchone():
+        print(f"Database '{db_path}' already has users, not seeding it.")
+        conn.close()
+        return None
+
+    rng = np.random.default_rng(seed)
+    # every user has the same password, so one hash with the app's cost is enough
+    rounds = PASSWORD_HASH_CONFIG["BCRYPT_ROUNDS"]
+    password_hash = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+    ranks = np.arange(1, hobbies + 1)
+    weights = ranks.astype(float) ** -zipf_exponent
+    counts = np.clip(rng.poisson(hobbies_per_user, users), 1, hobbies)
+    user_ids = np.repeat(np.arange(1, users + 1), counts)
+    user_hobbies = np.unique(
+        np.stack([user_ids, rng.choice(ranks, size=len(user_ids), p=weights / weights.sum())], axis=1),
+        axis=0,
+    )
 
-    # open the excel file
-    df = pd.read_excel(input_file, sheet_name=None)
+    # one meeting per user per hour at most, during working hours, from 180 days ago to 30 days ahead
+    today = datetime.now(UTC).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    draws = users * meetings_per_user // 2
+    pairs = rng.integers(1, users + 1, size=(draws, 2))
+    slots = rng.integers(-180, 30, size=draws) * 24 + rng.integers(9, 17, size=draws)
+    durations = rng.choice([30, 45, 60], size=draws)
+    busy = set()
+    meetings = []
+    for (user_id1, user_id2), slot, duration in zip(pairs.tolist(), slots.tolist(), durations.tolist()):
+        if user_id1 == user_id2 or (user_id1, slot) in busy or (user_id2, slot) in busy:
+            continue
+        busy.update(((user_id1, slot), (user_id2, slot)))
+        date = (today + timedelta(hours=slot)).strftime("%Y-%m-%d %H:%M:%S.%f")
+        meetings.append((user_id1, user_id2, date, duration))
+
+    report = {}
+
+    def timed(table, statement, rows=None):
+        start = time.perf_counter()
+        cursor = conn.executemany(statement, rows) if rows is not None else conn.execute(statement)
+        elapsed = time.perf_counter() - start
+        report[table] = {
+            "rows": cursor.rowcount,
+            "seconds": round(elapsed, 3),
+            "rows_per_sec": round(cursor.rowcount / elapsed) if elapsed else None,
+        }
+
+    with conn:
+        timed(
+            "user",
+            "INSERT INTO user (id, username, password, email) VALUES (?, ?, ?, ?)",
+            [(i, f"user{i}", password_hash, f"user{i}@example.com") for i in range(1, users + 1)],
+        )
+        timed(
+            "hobby",
+            "INSERT INTO hobby (id, name, user_count) VALUES (?, ?, 0)",
+            [(i, f"hobby {i}") for i in range(1, hobbies + 1)],
+        )
+        timed(
+            "user_hobby",
+            "INSERT INTO user_hobby (user_id, hobby_id) VALUES (?, ?)",
+            user_hobbies.tolist(),
+        )
+        timed(
+            "one_on_one",
+            "INSERT INTO one_on_one (user_id1, user_id2, date, duration_minutes) VALUES (?, ?, ?, ?)",
+            meetings,
+        )
+        timed(
+            "hobby.user_count",
+            "UPDATE hobby SET user_count = (SELECT COUNT(*) FROM user_hobby WHERE hobby_id = hobby.id)",
+        )
+        columns = "user_id, other_user_id, shared_count"
+        timed("user_overlap", f"INSERT INTO user_overlap ({columns}) {USER_OVERLAP_COUNTS_SQL}")
+    conn.execute("ANALYZE")
+    conn.close()
 
-    # Connect to the SQLite database
-    conn = sqlite3.connect(db_path)
+    for table, stats in report.items():
+        print(f"{table}: {stats['rows']} rows in {stats['seconds']}s ({stats['rows_per_sec']} rows/sec)")
+    return report
+
+
+def _open_text_input(path):
+    if path.name.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    if path.name.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise SystemExit(
+                "zstd compression needs the export extra: poetry install --extras export"
+            ) from None
+        return zstandard.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, encoding="utf-8", newline="")
+
+
+def _read_csv(path):
+    with _open_text_input(path) as file:
+        reader = csv.reader(file)
+        yield next(reader, [])
+        # csv has no NULL, export_db writes it as an empty field
+        for row in reader:
+            yield [value if value != "" else None for value in row] if "" in row else row
+
+
+def _read_parquet(path, chunksize):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit(
+            "Parquet import needs the export extra: poetry install --extras export"
+        ) from None
+
+    parquet_file = pq.ParquetFile(path)
+    yield parquet_file.schema_arrow.names
+    for batch in parquet_file.iter_batches(batch_size=chunksize):
+        yield from zip(*(column.to_pylist() for column in batch.columns), strict=True)
+
+
+def _read_excel_sheet(workbook, name):
+    rows = workbook[name].iter_rows(values_only=True)
+    yield next(rows, ())
+    for row in rows:
+        # read-only sheets can end in rows of empty cells
+        if any(value is not None for value in row):
+            yield row
+
+
+def _import_sources(input_path, chunksize):
+    """
+    Return {table: callable returning an iterator of rows, the header first} for an Excel
+    file, or for a directory of <table>.csv[.gz|.zst] and <table>.parquet files.
+    """
+    input_path = Path(input_path)
+    if input_path.is_file():
+        from openpyxl import load_workbook
+
+        # read-only workbooks parse each sheet as it is iterated instead of loading it
+        workbook = load_workbook(input_path, read_only=True, data_only=True)
+        return {
+            name: functools.partial(_read_excel_sheet, workbook, name) for name in workbook.sheetnames
+        }
+
+    sources = {}
+    for path in sorted(input_path.iterdir()):
+        for suffix in (".csv", ".csv.gz", ".csv.zst"):
+            if path.name.endswith(suffix):
+                sources[path.name.removesuffix(suffix)] = functools.partial(_read_csv, path)
+        if path.name.endswith(".parquet"):
+            sources[path.name.removesuffix(".parquet")] = functools.partial(
+                _read_parquet, path, chunksize
+            )
+    return sources
 
-    # Write each sheet to a separate table in the database
-    for table_name, data in df.items():
-        data.to_sql(table_name, conn, if_exists="append", index=False)
 
-    print(f"Excel file imported to '{db_path}' successfully.")
+def _upsert_sql(table, header):
+    """INSERT of the given columns that updates the row with the same primary key instead of failing."""
+    primary_key = [column.name for column in table.primary_key]
+    columns = ", ".join(f'"{name}"' for name in header)
+    placeholders = ", ".join("?" for _ in header)
+    updates = ", ".join(f'"{name}" = excluded."{name}"' for name in header if name not in primary_key)
+    conflict = f"ON CONFLICT ({', '.join(primary_key)}) " + (
+        f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+    )
+    return f'INSERT INTO "{table.name}" ({columns}) VALUES ({placeholders}) {conflict}'
+
+
+def _check_import_header(table, header):
+    """Stop when the header names columns the table lacks, or lacks its primary key."""
+    unknown = [name for name in header if name not in table.columns]
+    if unknown:
+        raise SystemExit(f"Table '{table.name}' has no column {', '.join(unknown)}.")
+    missing = [column.name for column in table.primary_key if column.name not in header]
+    if missing:
+        raise SystemExit(f"Table '{table.name}' is missing its primary key column {', '.join(missing)}.")
+
+
+def _decode_blobs(chunk, blob_columns):
+    # export_db writes BLOBs as base64 in text formats
+    chunk = [list(row) for row in chunk]
+    for row in chunk:
+        for i in blob_columns:
+            if isinstance(row[i], str):
+                row[i] = base64.b64decode(row[i])
+    return chunk
+
+
+def _import_table(conn, table, rows, chunksize):
+    """
+    Upsert the rows of one table in one transaction, with its non-unique indexes dropped during
+    the load and rebuilt afterwards. Unique indexes stay, they are needed to detect conflicts.
+
+    :return: Number of rows read.
+    """
+    header = list(next(rows))
+    _check_import_header(table, header)
+    blob_columns = [
+        i for i, name in enumerate(header) if isinstance(table.columns[name].type, LargeBinary)
+    ]
+    statement = _upsert_sql(table, header)
+    indexes = conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL "
+        "AND sql NOT LIKE 'CREATE UNIQUE%'",
+        (table.name,),
+    ).fetchall()
+    count = 0
+    conn.execute("BEGIN")
+    try:
+        for name, _ in indexes:
+            conn.execute(f'DROP INDEX "{name}"')
+        while chunk := list(itertools.islice(rows, chunksize)):
+            try:
+                conn.executemany(
+                    statement, _decode_blobs(chunk, blob_columns) if blob_columns else chunk
+                )
+            except sqlite3.Error as e:
+                raise SystemExit(
+                    f"Import of '{table.name}' failed in rows {count + 1}-{count + len(chunk)}, "
+                    f"nothing was imported into it: {e}"
+                ) from None
+            count += len(chunk)
+        for _, sql in indexes:
+            conn.execute(sql)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return count
+
+
+def import_db(directory, input_path, chunksize=EXPORT_CHUNKSIZE):
+    """
+    Load an export of export_db into the database, streaming chunksize rows at a time. Rows
+    are upserted on their primary key, so importing the same export twice leaves the
+    database unchanged. Each table is loaded in one transaction, a table that fails is rolled
+    back and stops the import, the tables before it stay imported.
+
+    Afterwards every hobby's user_count is recomputed. user_overlap is left to
+    rebuild_user_overlap when user_hobby is imported without it.
+
+    :param directory: Directory of the database, created with its tables if needed.
+    :param input_path: An xlsx file, or a directory of csv or parquet files, one per table.
+    :param chunksize: Rows per executemany.
+    :return: Rows, seconds and rows/sec per table.
+    """
+    input_path = Path(input_path)
+    if not input_path.exists():
+        print(f"Import '{input_path}' does not exist.")
+        return None
 
-    # Close the connection
+    db_path = Path(directory) / DbManager.FILE_NAME
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    create_missing_tables(db_path)
+    sources = _import_sources(input_path, chunksize)
+    for name in sources.keys() - db.metadata.tables.keys():
+        print(f"Skipping '{name}', the database has no such table.")
+
+    conn = connect_db(db_path)
+    report = {}
+    # referenced tables first
+    for table in db.metadata.sorted_tables:
+        if table.name not in sources:
+            continue
+        start = time.perf_counter()
+        rows = _import_table(conn, table, sources[table.name](), chunksize)
+        elapsed = time.perf_counter() - start
+        report[table.name] = {
+            "rows": rows,
+            "seconds": round(elapsed, 3),
+            "rows_per_sec": round(rows / elapsed) if elapsed else None,
+        }
+
+    recount_hobby_counts(conn)
+    conn.execute("ANALYZE")
     conn.close()
 
+    for table, stats in report.items():
+        print(f"{table}: {stats['rows']} rows in {stats['seconds']}s ({stats['rows_per_sec']} rows/sec)")
+    if "user_hobby" in report and "user_overlap" not in report:
+        # every pair of users sharing a hobby, this can take far longer than the import itself
+        print("user_overlap was not imported, run poe rebuild-user-overlap to bring it up to date.")
+    print(f"'{input_path}' imported to '{db_path}' successfully.")
+    return report
+
+
+def import_excel_to_db(directory, input_file, chunksize=EXPORT_CHUNKSIZE):
+    return import_db(directory, input_file, chunksize)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Helper script for managing the database.")
@@ -113,27 +912,104 @@ if __name__ == "__main__":
         "--export-db",
         type=str,
         nargs=2,
-        help="Path to the directory containing the database file and the output Excel file.",
+        help=(
+            "Path to the directory containing the database file, and the output Excel file or directory."
+        ),
+    )
+    parser.add_argument(
+        "--format",
+        choices=EXPORT_FORMATS,
+        help="Export format, by default xlsx unless the output ends in .csv or .parquet.",
+    )
+    parser.add_argument(
+        "--compression", choices=EXPORT_COMPRESSIONS, help="Compress csv or parquet exports."
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=EXPORT_CHUNKSIZE,
+        help="Rows read or written at a time by exports and imports.",
     )
     parser.add_argument(
         "--import-db",
         type=str,
         nargs=2,
-        help="Path to the directory containing the database file and the input Excel file.",
+        help=(
+            "Path to the directory containing the database file, and the Excel file or directory "
+            "of csv or parquet files to import."
+        ),
     )
     parser.add_argument(
         "--calculate-all-hobby-relations",
         action="store_true",
         help="Calculate the similarity score between all hobbies.",
     )
+    parser.add_argument(
+        "--batch-size", type=int, default=256, help="Number of hobbies encoded per forward pass."
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=RELATION_TOP_K,
+        help="Only keep the k most similar hobbies of each hobby, 0 keeps every pair.",
+    )
+    parser.add_argument(
+        "--tile-size", type=int, default=1024, help="Number of rows in each block of the cosine matrix."
+    )
+    parser.add_argument(
+        "--embedding-backend",
+        choices=BACKENDS,
+        help="Embedding backend, by default the one named by WEB_HOBBIES_EMBEDDING_BACKEND.",
+    )
+    parser.add_argument(
+        "--rebuild-user-overlap",
+        type=str,
+        help="Path to the directory containing the database file. Rebuilds user_overlap if it drifted.",
+    )
+    parser.add_argument(
+        "--recount-hobbies",
+        type=str,
+        help="Path to the directory containing the database file. Recounts the users of every hobby.",
+    )
+    parser.add_argument(
+        "--verify-only",
+        action="store_true",
+        help="Only report drift, do not repair it.",
+    )
+    parser.add_argument(
+        "--seed-db",
+        type=str,
+        help="Path to the directory containing the database file. Fills an empty one with test data.",
+    )
+    parser.add_argument("--users", type=int, default=1000, help="Number of users to seed.")
+    parser.add_argument("--hobbies", type=int, default=200, help="Number of hobbies to seed.")
+    parser.add_argument(
+        "--meetings-per-user", type=int, default=4, help="Average number of one-on-ones per seeded user."
+    )
+    parser.add_argument(
+        "--migrate-db",
+        type=str,
+        help="Path to the directory containing the database file. Adds missing tables and indexes.",
+    )
 
     args = parser.parse_args()
 
+    if args.embedding_backend:
+        use_backend(args.embedding_backend)
+
     if args.delete_db:
         delete_db(args.delete_db)
     elif args.export_db:
-        export_db_to_excel(args.export_db[0], args.export_db[1])
+        export_db(args.export_db[0], args.export_db[1], args.format, args.compression, args.chunksize)
     elif args.import_db:
-        import_excel_to_db(args.import_db[0], args.import_db[1])
+        import_db(args.import_db[0], args.import_db[1], args.chunksize)
     elif args.calculate_all_hobby_relations:
-        calculate_all_hobby_relations()
+        calculate_all_hobby_relations(args.batch_size, args.tile_size, args.top_k)
+    elif args.rebuild_user_overlap:
+        rebuild_user_overlap(args.rebuild_user_overlap, args.verify_only)
+    elif args.recount_hobbies:
+        recount_hobbies(args.recount_hobbies, dry_run=args.verify_only)
+    elif args.migrate_db:
+        migrate_db(args.migrate_db)
+    elif args.seed_db:
+        seed_db(args.seed_db, args.users, args.hobbies, meetings_per_user=args.meetings_per_user)
@@ -0,0 +1,59 @@
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryCounter:
+    """
+    Counts the SQL statements executed by the current thread between start() and stop(),
+    using SQLAlchemy's before_cursor_execute event.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def install(self, engine) -> None:
+        """Start listening to the statements executed by the given engine."""
+        if not event.contains(engine, "before_cursor_execute", self._before_cursor_execute):
+            event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if getattr(self._local, "count", None) is not None:
+            self._local.count += 1
+
+    def start(self) -> None:
+        self._local.count = 0
+
+    def stop(self) -> int:
+        """Stop counting and return the number of statements executed since start()."""
+        count = getattr(self._local, "count", None) or 0
+        self._local.count = None
+        return count
+
+    def add(self, count: int) -> None:
+        """Count statements that another thread executed on behalf of this one."""
+        if getattr(self._local, "count", None) is not None:
+            self._local.count += count
+
+    @property
+    def count(self) -> int:
+        return getattr(self._local, "count", None) or 0
+
+    @contextmanager
+    def budget(self, max_queries: int):
+        """Raise QueryBudgetExceeded if the wrapped block executes more than max_queries statements."""
+        self.start()
+        try:
+            yield self
+        finally:
+            count = self.stop()
+        if count > max_queries:
+            raise QueryBudgetExceeded(f"Executed {count} queries, the budget is {max_queries}.")
+
+
+query_counter = QueryCounter()
@@ -0,0 +1,123 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import time
+from datetime import UTC, datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, WatchedFileHandler
+
+from flask import current_app, g, request
+from flask_login import current_user
+
+DEFAULT_CONFIG = {
+    "LOG_FILE": "app.log",
+    # "size" rotates app.log itself, which only one process may do. With "external", for several
+    # gunicorn workers, every worker appends to app.log and reopens it once logrotate moved it
+    "LOG_ROTATION": "size",
+    # with "size", rotate app.log once it reaches LOG_MAX_BYTES, keeping LOG_BACKUP_COUNT old files
+    "LOG_MAX_BYTES": 10 * 1024 * 1024,
+    "LOG_BACKUP_COUNT": 5,
+    # fraction of requests that are logged, per endpoint name with LOG_SAMPLE_RATE as the default
+    "LOG_SAMPLE_RATE": 1.0,
+    "LOG_SAMPLE_RATES": {"static": 0.0},
+    # request bodies are truncated to LOG_BODY_BYTES, 0 disables body logging
+    "LOG_BODY_BYTES": 256,
+    "LOG_REDACT_FIELDS": ("password",),
+}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line, including the fields passed in extra."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, UTC).isoformat(),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(app) -> QueueListener:
+    """
+    Send every log record through a queue to a background listener thread, which writes
+    JSON lines to app.log and plain text to the console.
+    """
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+
+    if app.config["LOG_ROTATION"] == "external":
+        file_handler: logging.FileHandler = WatchedFileHandler(app.config["LOG_FILE"])
+    else:
+        file_handler = RotatingFileHandler(
+            app.config["LOG_FILE"],
+            maxBytes=app.config["LOG_MAX_BYTES"],
+            backupCount=app.config["LOG_BACKUP_COUNT"],
+        )
+    file_handler.setFormatter(JsonFormatter())
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s: %(message)s"))
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.handlers = [QueueHandler(log_queue)]
+
+    app.before_request(log_request_info)
+    app.after_request(log_response_info)
+    return listener
+
+
+def _redacted_body(app) -> dict | str | None:
+    """Return the request body truncated to LOG_BODY_BYTES, with sensitive form fields redacted."""
+    limit = app.config["LOG_BODY_BYTES"]
+    if not limit or not request.content_length:
+        return None
+    if request.form:
+        redact = app.config["LOG_REDACT_FIELDS"]
+        return {key: "***" if key in redact else value[:limit] for key, value in request.form.items()}
+    return request.get_data()[:limit].decode("utf-8", errors="replace")
+
+
+def log_request_info():
+    """Decide whether this request is sampled, and remember when it started."""
+    rates = current_app.config["LOG_SAMPLE_RATES"]
+    rate = rates.get(request.endpoint, current_app.config["LOG_SAMPLE_RATE"])
+    g.log_sampled = rate >= 1.0 or random.random() < rate
+    g.log_start = time.perf_counter()
+
+
+def log_response_info(response):
+    """Log one structured line per sampled request, the write itself happens off-thread."""
+    if not g.get("log_sampled"):
+        return response
+
+    logging.info(
+        f"{request.method} {request.path} {response.status_code}",
+        extra={
+            "fields": {
+                "method": request.method,
+                "path": request.path,
+                "endpoint": request.endpoint,
+                "status": response.status_code,
+                "duration_ms": round((time.perf_counter() - g.log_start) * 1000, 3),
+                "ip": request.remote_addr,
+                "user": current_user.username if current_user.is_authenticated else "Anonymous",
+                "user_agent": request.headers.get("User-Agent"),
+                "referrer": request.referrer,
+                "request_body": _redacted_body(current_app),
+                "response_bytes": response.content_length,
+            }
+        },
+    )
+    return response
@@ -0,0 +1,135 @@
+import json
+import logging
+import threading
+
+DEFAULT_CONFIG = {
+    # e.g. redis://localhost:6379/0, or fakeredis:// for an in-process stand-in. None disables
+    # Redis, and sessions stay in signed cookies
+    "REDIS_URL": None,
+    "REDIS_MAX_CONNECTIONS": 20,
+    "SHARED_CACHE_PREFIX": "web_hobbies:",
+    # default lifetime of shared cache entries, in seconds
+    "SHARED_CACHE_TTL": 60,
+}
+
+
+def create_redis_client(url: str, max_connections: int):
+    """Return a Redis client with a connection pool of its own, or a FakeRedis for fakeredis:// urls."""
+    if url.startswith("fakeredis://"):
+        import fakeredis
+
+        return fakeredis.FakeRedis()
+
+    import redis
+
+    pool = redis.ConnectionPool.from_url(url, max_connections=max_connections)
+    return redis.Redis(connection_pool=pool)
+
+
+class SharedCache:
+    """
+    JSON values cached in Redis, shared by every gunicorn worker. Reads of several keys
+    go through one pipeline. Without Redis, or when Redis fails, every read is a miss and
+    writes are dropped, so callers always fall back to the database.
+    """
+
+    def __init__(self):
+        self.client = None
+        self.prefix = DEFAULT_CONFIG["SHARED_CACHE_PREFIX"]
+        self.ttl = DEFAULT_CONFIG["SHARED_CACHE_TTL"]
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app, client=None) -> None:
+        """
+        Connect to REDIS_URL, or use the given client, and move the app's sessions to Redis.
+        Does nothing when neither is set.
+        """
+        for key, value in DEFAULT_CONFIG.items():
+            app.config.setdefault(key, value)
+        self.prefix = app.config["SHARED_CACHE_PREFIX"]
+        self.ttl = app.config["SHARED_CACHE_TTL"]
+        if client is None and app.config["REDIS_URL"]:
+            client = create_redis_client(app.config["REDIS_URL"], app.config["REDIS_MAX_CONNECTIONS"])
+        self.client = client
+        if client is None:
+            return
+
+        from flask_session import Session
+
+        app.config["SESSION_TYPE"] = "redis"
+        app.config["SESSION_REDIS"] = client
+        app.config.setdefault("SESSION_KEY_PREFIX", f"{self.prefix}session:")
+        Session(app)
+
+    @property
+    def enabled(self) -> bool:
+        return self.client is not None
+
+    def get_many(self, keys: list[str]) -> list:
+        """Return the cached value of each key, None for misses, in one round trip."""
+        if self.client is None or not keys:
+            return [None] * len(keys)
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for key in keys:
+                pipe.get(self.prefix + key)
+            raw = pipe.execute()
+        except Exception:
+            logging.warning("Shared cache read failed", exc_info=True)
+            raw = [None] * len(keys)
+
+        values = [None if value is None else json.loads(value) for value in raw]
+        hits = sum(value is not None for value in values)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return values
+
+    def get(self, key: str):
+        return self.get_many([key])[0]
+
+    def set_many(self, values: dict, ttl: float | None = None) -> None:
+        """Cache several values for ttl seconds, SHARED_CACHE_TTL by default."""
+        if self.client is None or not values:
+            return
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for key, value in values.items():
+                pipe.set(self.prefix + key, json.dumps(value), ex=int(ttl or self.ttl))
+            pipe.execute()
+        except Exception:
+            logging.warning("Shared cache write failed", exc_info=True)
+
+    def set(self, key: str, value, ttl: float | None = None) -> None:
+        self.set_many({key: value}, ttl)
+
+    def get_or_set(self, key: str, loader, ttl: float | None = None):
+        """Return the cached value of key, or cache and return the result of loader()."""
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            self.set(key, value, ttl)
+        return value
+
+    def delete(self, *keys: str) -> None:
+        if self.client is None or not keys:
+            return
+        try:
+            self.client.delete(*(self.prefix + key for key in keys))
+        except Exception:
+            logging.warning("Shared cache delete failed", exc_info=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+shared_cache = SharedCache()
@@ -24,26 +24,34 @@ function get_current_user() {
 
 document.addEventListener("DOMContentLoaded", () => {
     console.log("DOM loaded");
-    // get the current user using the /get_current_user
-    get_current_user().then(user => {
-        if (user) {
-            // add the username to the h2-welcome element
-            const h2Welcome = document.getElementById('h2-welcome');
-            h2Welcome.textContent = `Welcome, ${user.username}!`;
-
-            // Refresh user hobbies and most common user
-            refreshUserHobbies();
-            refreshMostCommonUser();
-            refreshMostCommonUserNeverMet();
-            fetchOneOnOnes();
+    // everything the page shows on load comes from a single /home_state request
+    fetch("/home_state")
+    .then(response => response.json())
+    .then(state => {
+        if (!state.success) {
+            console.error(state.message);
+            return;
         }
-    });
+        current_user = state.user;
+        // add the username to the h2-welcome element
+        const h2Welcome = document.getElementById('h2-welcome');
+        h2Welcome.textContent = `Welcome, ${current_user.username}!`;
+
+        renderUserHobbies(state.hobbies);
+        renderMostCommonUser(state.most_common_user);
+        renderMostCommonUserNeverMet(state.most_common_user_never_met);
+        renderOneOnOnes(state.one_on_ones, false);
+        renderPopularHobbies(1, state.popular_hobbies);
+    })
+    .catch(error => console.error("Error fetching home state:", error));
 });
 
 
+// keyset cursor of each page of popular hobbies, the first page needs none
+const popularHobbyCursors = [null, ''];
+
 document.addEventListener('DOMContentLoaded', () => {
     let currentPage = 1;
-    loadPopularHobbies(currentPage);
 
     document.getElementById('prev-page').addEventListener('click', () => {
         if (currentPage > 1) {
@@ -58,24 +66,34 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 });
 
-function fetchOneOnOnes() {
-    fetch(`/get_user_one_on_ones/${current_user.id}`)
+// cursor of the next page of upcoming meetings, null once every meeting is shown
+let oneOnOnesCursor = null;
+
+function fetchOneOnOnes(more = false) {
+    const cursor = more && oneOnOnesCursor ? `&cursor=${encodeURIComponent(oneOnOnesCursor)}` : '';
+    fetch(`/get_user_one_on_ones/${current_user.id}/upcoming?limit=20${cursor}`)
         .then(response => response.json())
-        .then(data => {
-            const oneOnOneList = document.getElementById('one-on-one-list');
-            oneOnOneList.innerHTML = '';
-            data.one_on_ones.forEach(meeting => {
-                const utcDate = new Date(meeting.date + 'Z'); // Ensure the date string is treated as UTC
-                const localDate = utcDate.toLocaleString(); // convert UTC back to Local
-                const li = document.createElement('li');
-                li.className = 'list-group-item d-flex justify-content-between align-items-center';
-                li.innerHTML = `
-                    ${localDate} with <a href="/user/${meeting.user.username}">${meeting.user.username}</a>
-                    <button class="btn btn-danger btn-sm" onclick="cancelOneOnOne(${meeting.id})">Cancel</button>
-                `;
-                oneOnOneList.appendChild(li);
-            });
-        });
+        .then(data => renderOneOnOnes(data, more));
+}
+
+function renderOneOnOnes(page, more) {
+    const oneOnOneList = document.getElementById('one-on-one-list');
+    if (!more) {
+        oneOnOneList.innerHTML = '';
+    }
+    oneOnOnesCursor = page.next_cursor;
+    document.getElementById('more-one-on-ones').hidden = !oneOnOnesCursor;
+    page.one_on_ones.forEach(meeting => {
+        const utcDate = new Date(meeting.date + 'Z'); // Ensure the date string is treated as UTC
+        const localDate = utcDate.toLocaleString(); // convert UTC back to Local
+        const li = document.createElement('li');
+        li.className = 'list-group-item d-flex justify-content-between align-items-center';
+        li.innerHTML = `
+            ${localDate} (${meeting.duration_minutes} min) with <a href="/user/${meeting.user.username}">${meeting.user.username}</a>
+            <button class="btn btn-danger btn-sm" onclick="cancelOneOnOne(${meeting.id})">Cancel</button>
+        `;
+        oneOnOneList.appendChild(li);
+    });
 }
 
 
@@ -114,11 +132,7 @@ function refreshUserHobbies() {
         .then(response => response.json())
         .then(data => {
             if (data.success) {
-                const hobbyList = document.getElementById('hobby-list');
-                hobbyList.innerHTML = '';
-                data.hobbies.forEach(hobby => {
-                    addHobbyToList(hobby.name, hobby.id);
-                });
+                renderUserHobbies(data.hobbies);
             } else {
                 console.error(data.message);
             }
@@ -126,6 +140,14 @@ function refreshUserHobbies() {
         .catch(error => console.error("Error fetching user hobbies:", error));
 }
 
+function renderUserHobbies(hobbies) {
+    const hobbyList = document.getElementById('hobby-list');
+    hobbyList.innerHTML = '';
+    hobbies.forEach(hobby => {
+        addHobbyToList(hobby.name, hobby.id);
+    });
+}
+
 function removeHobby(hobbyId) {
     fetch(`/remove_hobby/${hobbyId}`, {
         method: 'DELETE',
@@ -151,20 +173,7 @@ function refreshMostCommonUser() {
         .then(response => response.json())
         .then(data => {
             if (data.success) {
-                const mostCommonUser = data.user;
-                const mostCommonUserElement = document.getElementById("most-common-user");
-
-                // Remove existing child if it exists
-                while (mostCommonUserElement.firstChild) {
-                    mostCommonUserElement.removeChild(mostCommonUserElement.firstChild);
-                }
-
-                // Create and append the new link
-                const userLink = document.createElement('a');
-                userLink.href = `/user/${mostCommonUser.username}`;
-                userLink.textContent = mostCommonUser.username;
-                mostCommonUserElement.textContent = 'Most common user: ';
-                mostCommonUserElement.appendChild(userLink);
+                renderMostCommonUser(data.user);
             } else {
                 console.error(data.message);
             }
@@ -172,25 +181,31 @@ function refreshMostCommonUser() {
         .catch(error => console.error("Error fetching most common user:", error));
 }
 
+function renderMostCommonUser(mostCommonUser) {
+    if (!mostCommonUser) {
+        return;
+    }
+    const mostCommonUserElement = document.getElementById("most-common-user");
+
+    // Remove existing child if it exists
+    while (mostCommonUserElement.firstChild) {
+        mostCommonUserElement.removeChild(mostCommonUserElement.firstChild);
+    }
+
+    // Create and append the new link
+    const userLink = document.createElement('a');
+    userLink.href = `/user/${mostCommonUser.username}`;
+    userLink.textContent = mostCommonUser.username;
+    mostCommonUserElement.textContent = 'Most common user: ';
+    mostCommonUserElement.appendChild(userLink);
+}
+
 function refreshMostCommonUserNeverMet() {
     fetch("/most_common_user_never_met")
     .then(response => response.json())
     .then(data => {
         if (data.success) {
-            const mostCommonUserNeverMet = data.user;
-            const mostCommonUserNeverMetElement = document.getElementById("most-common-user-never-met");
-
-            // Remove existing child if it exists
-            while (mostCommonUserNeverMetElement.firstChild) {
-                mostCommonUserNeverMetElement.removeChild(mostCommonUserNeverMetElement.firstChild);
-            }
-
-            // Create and append the new link
-            const userLink = document.createElement('a');
-            userLink.href = `/user/${mostCommonUserNeverMet.username}`;
-            userLink.textContent = mostCommonUserNeverMet.username;
-            mostCommonUserNeverMetElement.textContent = 'Most common user never met: ';
-            mostCommonUserNeverMetElement.appendChild(userLink);
+            renderMostCommonUserNeverMet(data.user);
         } else {
             console.error(data.message);
         }
@@ -198,20 +213,43 @@ function refreshMostCommonUserNeverMet() {
     .catch(error => console.error("Error fetching most common user never met:", error));
 }
 
+function renderMostCommonUserNeverMet(mostCommonUserNeverMet) {
+    if (!mostCommonUserNeverMet) {
+        return;
+    }
+    const mostCommonUserNeverMetElement = document.getElementById("most-common-user-never-met");
+
+    // Remove existing child if it exists
+    while (mostCommonUserNeverMetElement.firstChild) {
+        mostCommonUserNeverMetElement.removeChild(mostCommonUserNeverMetElement.firstChild);
+    }
+
+    // Create and append the new link
+    const userLink = document.createElement('a');
+    userLink.href = `/user/${mostCommonUserNeverMet.username}`;
+    userLink.textContent = mostCommonUserNeverMet.username;
+    mostCommonUserNeverMetElement.textContent = 'Most common user never met: ';
+    mostCommonUserNeverMetElement.appendChild(userLink);
+}
+
 function addHobby(event) {
     event.preventDefault();
     const hobbyInput = document.getElementById('hobby');
-    const hobbyName = hobbyInput.value;
-    const encodedHobbyName = encodeURIComponent(hobbyName);
+    // several hobbies can be added at once, one per line, as names may contain commas
+    const hobbyNames = hobbyInput.value.split('\n').filter(name => name.trim());
 
-    fetch(`/add_hobby/${encodedHobbyName}`, {
-        method: 'POST'
+    fetch('/hobbies', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({add: hobbyNames})
     })
     .then(response => response.json())
     .then(data => {
         if (data.success) {
-            addHobbyToList(hobbyName, data.hobby_id);
-            hobbyInput.value = ''; // Clear the input field after adding the hobby
+            renderUserHobbies(data.hobbies);
+            hobbyInput.value = ''; // Clear the input field after adding the hobbies
             refreshMostCommonUser();
             refreshMostCommonUserNeverMet();
         } else {
@@ -222,40 +260,46 @@ function addHobby(event) {
 }
 
 function loadPopularHobbies(page) {
-    fetch(`/popular_hobbies/${page}`)
+    const cursor = popularHobbyCursors[page];
+    const url = cursor ? `/popular_hobbies/${page}?after=${encodeURIComponent(cursor)}` : `/popular_hobbies/${page}`;
+    fetch(url)
     .then(response => response.json())
-    .then(data => {
-        const popularHobbyList = document.getElementById('popular-hobby-list');
-        popularHobbyList.innerHTML = '';
-
-        // set start variable of ol
-        popularHobbyList.start = data.start;
-
-        data.hobbies.forEach(hobby => {
-            const hobbyItem = document.createElement('li');
-            const hobbyLink = document.createElement('a');
-            hobbyItem.classList.add('list-group-item'); // Add the class li-hobby
-            hobbyLink.classList.add('class="text-decoration-none'); // Add the class li-hobby
-            hobbyLink.href = `/hobby/${hobby.id}`;
-            hobbyLink.textContent = `${hobby.name} (${hobby.user_count} users)`;
-            hobbyItem.appendChild(hobbyLink);
-            popularHobbyList.appendChild(hobbyItem);
-        });
-
-        // set page number, update buttons
-        document.getElementById('page-number').textContent = page;
-
-        if (page === 1) {
-            document.getElementById('prev-page').disabled = true;
-        } else {
-            document.getElementById('prev-page').disabled = false;
-        } 
-        
-        if (page == data.total_pages) {
-            document.getElementById('next-page').disabled = true;
-        } else {
-            document.getElementById('next-page').disabled = false;
-        }
-    })
+    .then(data => renderPopularHobbies(page, data))
     .catch(error => console.error("Error fetching popular hobbies:", error));
 }
+
+function renderPopularHobbies(page, data) {
+    popularHobbyCursors[page + 1] = data.next_cursor;
+
+    const popularHobbyList = document.getElementById('popular-hobby-list');
+    popularHobbyList.innerHTML = '';
+
+    // set start variable of ol
+    popularHobbyList.start = data.start;
+
+    data.hobbies.forEach(hobby => {
+        const hobbyItem = document.createElement('li');
+        const hobbyLink = document.createElement('a');
+        hobbyItem.classList.add('list-group-item'); // Add the class li-hobby
+        hobbyLink.classList.add('class="text-decoration-none'); // Add the class li-hobby
+        hobbyLink.href = `/hobby/${hobby.id}`;
+        hobbyLink.textContent = `${hobby.name} (${hobby.user_count} users)`;
+        hobbyItem.appendChild(hobbyLink);
+        popularHobbyList.appendChild(hobbyItem);
+    });
+
+    // set page number, update buttons
+    document.getElementById('page-number').textContent = page;
+
+    if (page === 1) {
+        document.getElementById('prev-page').disabled = true;
+    } else {
+        document.getElementById('prev-page').disabled = false;
+    } 
+    
+    if (page == data.total_pages) {
+        document.getElementById('next-page').disabled = true;
+    } else {
+        document.getElementById('next-page').disabled = false;
+    }
+}
@@ -0,0 +1,49 @@
+import os
+import tempfile
+import time
+
+import pytest
+
+# flask_app configures itself on import, so point it at a scratch instance directory first
+INSTANCE_PATH = tempfile.mkdtemp(prefix="web-hobbies-tests-")
+os.environ["FLASK_SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{INSTANCE_PATH}/tables.db"
+os.environ["FLASK_LOG_FILE"] = os.path.join(INSTANCE_PATH, "app.log")
+os.environ["FLASK_PASSWORD_HASH_WORKERS"] = "0"
+os.environ["FLASK_BCRYPT_ROUNDS"] = "4"
+# needs no model download, see embedding_backends.py
+os.environ["WEB_HOBBIES_EMBEDDING_BACKEND"] = "ngram-hash"
+
+import flask_app  # noqa: E402
+from user_db import DbManager  # noqa: E402
+
+flask_app.app.instance_path = INSTANCE_PATH
+flask_app.app.config["TESTING"] = True
+
+PASSWORD = "password"
+
+
+@pytest.fixture
+def app():
+    with flask_app.app.app_context():
+        yield flask_app.app
+
+
+@pytest.fixture
+def login(app):
+    """Return a function that registers a user and returns a test client logged in as them."""
+
+    def login(username: str):
+        client = app.test_client()
+        client.post("/register", data={"username": username, "password": PASSWORD})
+        client.post("/login", data={"username": username, "password": PASSWORD})
+        return client
+
+    return login
+
+
+def wait_for_relation_jobs(timeout: float = 30.0) -> None:
+    """Wait until the hobby relations queued by add_hobby_to_user are stored."""
+    deadline = time.monotonic() + timeout
+    while DbManager.relation_jobs.stats()["queue_depth"]:
+        assert time.monotonic() < deadline, "relation jobs did not finish"
+        time.sleep(0.01)
@@ -0,0 +1,71 @@
+import random
+import threading
+
+from flask_app import app as flask_app
+from helpers import UserException
+from tests.conftest import PASSWORD, wait_for_relation_jobs
+from user_db import USER_OVERLAP_COUNTS_SQL, DbManager, Hobby, db
+
+USERS = 8
+HOBBY_NAMES = [f"Stress Hobby {i}" for i in range(6)]
+THREADS = 8
+OPERATIONS = 40
+
+
+def _add_and_remove_hobbies(user_ids: list[int], seed: int, errors: list) -> None:
+    rng = random.Random(seed)
+    with flask_app.app_context():
+        for _ in range(OPERATIONS):
+            user_id = rng.choice(user_ids)
+            name = rng.choice(HOBBY_NAMES)
+            try:
+                if rng.random() < 0.6:
+                    # differently cased names are the same hobby
+                    DbManager.add_hobby_to_user(user_id, rng.choice([name, name.upper(), f" {name} "]))
+                else:
+                    hobby = Hobby.query.filter_by(name=DbManager.normalize_hobby_name(name)).first()
+                    if hobby is not None:
+                        DbManager.remove_hobby_from_user(user_id, hobby.id)
+            except UserException:
+                db.session.rollback()
+            except Exception as e:
+                errors.append(e)
+
+
+def test_concurrent_hobby_changes_keep_counts_exact(app):
+    user_ids = []
+    for i in range(USERS):
+        DbManager.add_user(f"stress-{i}", PASSWORD)
+        user_ids.append(DbManager.get_user(f"stress-{i}").id)
+
+    errors: list[Exception] = []
+    threads = [
+        threading.Thread(target=_add_and_remove_hobbies, args=(user_ids, seed, errors))
+        for seed in range(THREADS)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wait_for_relation_jobs()
+    assert not errors
+
+    conn = DbManager.sql_connection()
+    duplicates = conn.execute("SELECT name FROM hobby GROUP BY name HAVING COUNT(*) > 1").fetchall()
+    assert duplicates == []
+    names = {name for (name,) in conn.execute("SELECT name FROM hobby WHERE name LIKE 'stress hobby %'")}
+    assert names <= {DbManager.normalize_hobby_name(name) for name in HOBBY_NAMES}
+
+    drifted = conn.execute(
+        "SELECT hobby.id, hobby.user_count, COUNT(user_hobby.user_id) FROM hobby "
+        "LEFT JOIN user_hobby ON user_hobby.hobby_id = hobby.id "
+        "GROUP BY hobby.id HAVING hobby.user_count != COUNT(user_hobby.user_id)"
+    ).fetchall()
+    assert drifted == []
+
+    stored = conn.execute(
+        "SELECT user_id, other_user_id, shared_count FROM user_overlap WHERE shared_count != 0"
+    ).fetchall()
+    expected = conn.execute(USER_OVERLAP_COUNTS_SQL).fetchall()
+    assert expected
+    assert sorted(map(tuple, stored)) == sorted(map(tuple, expected))
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from embedding_backends import EmbeddingBackend, NgramHashingBackend, get_backend
+
+
+def test_backend_without_encode_cannot_be_created():
+    class Incomplete(EmbeddingBackend):
+        key = name = "incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_ngram_hashing_embeddings_are_unit_length_and_spelling_aware():
+    backend = NgramHashingBackend(dim=256)
+
+    embeddings = backend.encode(["football", "foosball", "knitting", ""], batch_size=2)
+
+    assert embeddings.shape == (4, 256)
+    assert embeddings.dtype == np.float32
+    assert np.allclose(np.linalg.norm(embeddings[:3], axis=1), 1.0)
+    assert embeddings[0] @ embeddings[1] > embeddings[0] @ embeddings[2]
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        get_backend("unknown")
@@ -0,0 +1,55 @@
+import logging
+import multiprocessing.util
+import os
+import types
+
+import pytest
+
+from embedding_service import start_embedding_service, stop_embedding_service
+
+
+@pytest.fixture
+def gunicorn_config(monkeypatch, tmp_path):
+    # importing the config sets these for the workers it configures
+    monkeypatch.setenv("FLASK_METRICS_DIR", str(tmp_path / "metrics"))
+    monkeypatch.setenv("FLASK_LOG_ROTATION", "external")
+    import gunicorn_config
+
+    socket_path = str(tmp_path / "embedding.sock")
+    monkeypatch.setattr(gunicorn_config, "embedding_socket", socket_path)
+    process = start_embedding_service(socket_path, backend="ngram-hash")
+    monkeypatch.setattr(gunicorn_config, "embedding_process", process)
+    yield gunicorn_config
+    stop_embedding_service(gunicorn_config.embedding_process)
+
+
+def _fork_worker_and_exit(post_fork) -> None:
+    """Fork a process that exits the way a gunicorn worker does, running the atexit handlers."""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            post_fork(None, None)
+            multiprocessing.util._exit_function()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+
+def test_exiting_worker_leaves_the_service_running(gunicorn_config):
+    _fork_worker_and_exit(gunicorn_config.post_fork)
+
+    gunicorn_config.embedding_process.join(timeout=1)
+    assert gunicorn_config.embedding_process.is_alive()
+
+
+def test_dead_service_is_restarted_before_the_next_worker_is_forked(gunicorn_config):
+    # without the post_fork hook the exiting worker terminates the service
+    _fork_worker_and_exit(lambda server, worker: None)
+    process = gunicorn_config.embedding_process
+    process.join(timeout=10)
+    assert not process.is_alive()
+
+    gunicorn_config.pre_fork(types.SimpleNamespace(log=logging.getLogger("gunicorn")), None)
+
+    assert gunicorn_config.embedding_process is not process
+    assert gunicorn_config.embedding_process.is_alive()
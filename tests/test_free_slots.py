@@ -0,0 +1,28 @@
+import time
+
+import pytest
+
+from user_db import DbManager
+
+
+@pytest.fixture
+def local_timezone(monkeypatch):
+    """Run the server in a timezone other than UTC."""
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.mark.parametrize(
+    "after", ["2030-01-01T10:00:00", "2030-01-01T10:00:00+00:00", "2030-01-01T12:00:00+02:00"]
+)
+def test_after_is_utc_unless_it_has_an_offset(local_timezone, login, after):
+    login("free-slots-partner")
+    partner = DbManager.get_user("free-slots-partner")
+    client = login("free-slots")
+
+    response = client.get(f"/free_slots/{partner.id}", query_string={"after": after, "count": 1})
+
+    assert response.json["slots"] == ["2030-01-01 10:00:00"]
@@ -0,0 +1,18 @@
+def test_one_failing_name_rolls_back_the_whole_batch(login):
+    client = login("hobby-batch")
+    assert client.post("/hobbies", json={"add": ["Chess"]}).json["success"]
+
+    response = client.post("/hobbies", json={"add": ["Arts, crafts", "Pottery", "chess"]})
+
+    assert not response.json["success"]
+    assert response.json["message"].startswith("No changes were applied")
+    hobbies = client.post("/hobbies", json={}).json["hobbies"]
+    assert [hobby["name"] for hobby in hobbies] == ["chess"]
+
+
+def test_names_with_commas_are_added_whole(login):
+    client = login("hobby-comma")
+
+    response = client.post("/hobbies", json={"add": ["Arts, crafts"]})
+
+    assert [hobby["name"] for hobby in response.json["hobbies"]] == ["arts, crafts"]
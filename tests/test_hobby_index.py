@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from hobby_index import HobbyIndex, hnswlib
+
+
+def _embeddings(n: int, dim: int = 16) -> tuple[np.ndarray, np.ndarray]:
+    vectors = np.random.default_rng(0).standard_normal((n, dim)).astype(np.float32)
+    return np.arange(1, n + 1), vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize(
+    "use_hnsw",
+    [
+        False,
+        pytest.param(True, marks=pytest.mark.skipif(hnswlib is None, reason="needs the ann extra")),
+    ],
+)
+def test_save_and_load_round_trip(tmp_path, use_hnsw):
+    ids, embeddings = _embeddings(200)
+    index = HobbyIndex.build(ids, embeddings, use_hnsw=use_hnsw)
+    expected = index.query(embeddings[0], k=5, exclude=1)
+
+    version = index.save(tmp_path)
+    loaded = HobbyIndex.load(tmp_path)
+
+    assert HobbyIndex.version(tmp_path) == version
+    assert loaded.use_hnsw == use_hnsw
+    assert len(loaded) == len(ids)
+    assert [hobby_id for hobby_id, _ in loaded.query(embeddings[0], k=5, exclude=1)] == [
+        hobby_id for hobby_id, _ in expected
+    ]
+
+
+@pytest.mark.skipif(hnswlib is None, reason="needs the ann extra")
+def test_hnsw_finds_the_exact_neighbours():
+    ids, embeddings = _embeddings(500)
+    exact = HobbyIndex.build(ids, embeddings, use_hnsw=False)
+    hnsw = HobbyIndex.build(ids, embeddings, use_hnsw=True)
+
+    for vector in embeddings[:20]:
+        assert {i for i, _ in hnsw.query(vector, k=5)} == {i for i, _ in exact.query(vector, k=5)}
+
+
+def test_save_keeps_the_previous_version_only(tmp_path):
+    ids, embeddings = _embeddings(10)
+    index = HobbyIndex.build(ids, embeddings, use_hnsw=False)
+    versions = [index.save(tmp_path) for _ in range(3)]
+
+    assert sorted(path.name for path in tmp_path.glob("v*")) == sorted(versions[1:])
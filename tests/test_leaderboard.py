@@ -0,0 +1,23 @@
+from leaderboard import PopularHobbiesCache
+
+RANKING = [(5, 1, "a"), (5, 2, "b"), (3, 3, "c"), (1, 4, "d")]
+
+
+def test_pages_by_number_and_by_cursor():
+    cache = PopularHobbiesCache()
+    cache.refresh_if_needed(lambda: RANKING)
+
+    assert cache.page(2, page_num=2) == (RANKING[2:], 2)
+    assert cache.page(2, after=(5, 2)) == (RANKING[2:], 2)
+    assert cache.total == 4
+
+
+def test_refresh_replaces_ranking_and_keys_together():
+    cache = PopularHobbiesCache(ttl=0, min_refresh_interval=0)
+    cache.refresh_if_needed(lambda: RANKING)
+    cache.refresh_if_needed(lambda: RANKING[2:])
+
+    ranking, keys = cache._snapshot
+    assert ranking == RANKING[2:]
+    assert keys == [(-3, 3), (-1, 4)]
+    assert cache.page(1, after=(3, 3)) == ([(1, 4, "d")], 1)
@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+from user_db import MAINTENANCE_JOB_TIMEOUT, RECOUNT_JOB, DbManager, db, save_maintenance_job
+
+TOKEN = "maintenance-secret"
+
+
+@pytest.fixture
+def maintenance_token(app):
+    app.config["MAINTENANCE_TOKEN"] = TOKEN
+    yield TOKEN
+    app.config["MAINTENANCE_TOKEN"] = None
+
+
+def test_recount_is_disabled_without_a_configured_token(login):
+    client = login("recount-disabled")
+
+    assert client.post("/recount_hobbies").status_code == 404
+    assert client.get("/recount_hobbies/status").status_code == 404
+
+
+def test_recount_needs_the_token_even_when_logged_in(maintenance_token, login):
+    client = login("recount-user")
+
+    assert client.post("/recount_hobbies").status_code == 403
+    assert client.post("/recount_hobbies", headers={"X-Maintenance-Token": "wrong"}).status_code == 403
+
+
+def test_recount_with_the_token(maintenance_token, app):
+    client = app.test_client()
+    headers = {"X-Maintenance-Token": maintenance_token}
+
+    response = client.post("/recount_hobbies", query_string={"dry_run": "true"}, headers=headers)
+
+    assert response.status_code == 202
+    assert client.get("/recount_hobbies/status", headers=headers).status_code == 200
+
+
+def _wait_for_recount(client, headers, timeout: float = 10.0) -> dict:
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.get("/recount_hobbies/status", headers=headers).json["job"]
+        if job["state"] in ("done", "failed") or time.monotonic() > deadline:
+            return job
+        time.sleep(0.01)
+
+
+def test_recount_state_is_shared_through_the_database(maintenance_token, app):
+    client = app.test_client()
+    headers = {"X-Maintenance-Token": maintenance_token}
+    _wait_for_recount(client, headers)
+    completed = DbManager.maintenance_jobs.stats()["completed"]
+
+    # a recount another worker is running
+    conn = db.engine.raw_connection()
+    save_maintenance_job(conn.driver_connection, RECOUNT_JOB, "running", {"processed": 3})
+    conn.close()
+    response = client.post("/recount_hobbies", headers=headers)
+
+    assert response.json["job"] == {"state": "running", "processed": 3}
+    assert client.get("/recount_hobbies/status", headers=headers).json["job"]["state"] == "running"
+
+    # the other worker died without finishing
+    db.session.execute(
+        db.text("UPDATE maintenance_job SET updated_at = :at WHERE name = :name"),
+        {"at": time.time() - MAINTENANCE_JOB_TIMEOUT - 1, "name": RECOUNT_JOB},
+    )
+    db.session.commit()
+    client.post("/recount_hobbies", headers=headers)
+
+    assert _wait_for_recount(client, headers)["state"] == "done"
+    assert DbManager.maintenance_jobs.stats()["completed"] == completed + 1
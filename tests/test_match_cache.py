@@ -0,0 +1,40 @@
+import fakeredis
+import pytest
+
+from helpers import UserException
+from shared_cache import shared_cache
+from user_db import NO_MATCH_MESSAGE, DbManager
+
+
+@pytest.fixture
+def redis_cache(monkeypatch):
+    monkeypatch.setattr(shared_cache, "client", fakeredis.FakeRedis())
+
+
+def test_users_without_a_match_are_cached(redis_cache, monkeypatch, app):
+    DbManager.add_user("no-match", "password")
+    user_id = DbManager.get_user("no-match").id
+    searches = []
+    find = DbManager._find_most_common_user
+    monkeypatch.setattr(
+        DbManager, "_find_most_common_user", lambda user_id: searches.append(user_id) or find(user_id)
+    )
+
+    for _ in range(2):
+        with pytest.raises(UserException, match=NO_MATCH_MESSAGE):
+            DbManager.get_most_common_user(user_id)
+
+    assert searches == [user_id]
+    assert DbManager.get_cached_match_ids(user_id)["most_common_user"] == 0
+
+
+def test_cached_no_match_is_answered_like_a_search(redis_cache, login):
+    client = login("no-match-route")
+
+    responses = [client.get("/most_common_user") for _ in range(2)]
+
+    assert [response.json for response in responses] == [
+        {"success": False, "message": NO_MATCH_MESSAGE}
+    ] * 2
+    assert int(responses[1].headers["X-Query-Count"]) < int(responses[0].headers["X-Query-Count"])
+    assert client.get("/home_state").json["most_common_user"] is None
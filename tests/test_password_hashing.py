@@ -0,0 +1,36 @@
+import os
+import time
+
+import pytest
+
+from password_hashing import PasswordHasher, PasswordHasherBusy
+
+
+def _sleep(seconds: float) -> float:
+    time.sleep(seconds)
+    return seconds
+
+
+def _exit() -> None:
+    os._exit(1)
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher()
+    hasher.config.update(PASSWORD_HASH_WORKERS=1, PASSWORD_HASH_TIMEOUT=5.0)
+    yield hasher
+    hasher.shutdown()
+
+
+def test_timeout_is_busy(hasher):
+    hasher.config["PASSWORD_HASH_TIMEOUT"] = 0.2
+    with pytest.raises(PasswordHasherBusy):
+        hasher._run(_sleep, 1)
+
+
+def test_broken_pool_is_busy_and_replaced(hasher):
+    with pytest.raises(PasswordHasherBusy):
+        hasher._run(_exit)
+
+    assert hasher._run(_sleep, 0) == 0
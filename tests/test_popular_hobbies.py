@@ -0,0 +1,15 @@
+import pytest
+
+
+@pytest.mark.parametrize("after", ["5", "5:", ":5", "5:1:2", "a:b"])
+def test_invalid_cursor_is_rejected(app, after):
+    response = app.test_client().get("/popular_hobbies/1", query_string={"after": after})
+
+    assert response.status_code == 400
+    assert response.json == {"success": False, "message": "Invalid cursor."}
+
+
+def test_valid_cursor_is_accepted(app):
+    response = app.test_client().get("/popular_hobbies/1", query_string={"after": "0:0"})
+
+    assert response.status_code == 200
@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from flask_app import app as flask_app
+from query_counter import query_counter
+from tests.conftest import PASSWORD, wait_for_relation_jobs
+from user_db import DbManager, db
+
+# enough rows that one query per row would blow every bound below
+USERS = 30
+HOBBIES = 30
+MEETINGS = 12
+
+
+@pytest.fixture(scope="module")
+def seeded():
+    """A user sharing each of their hobbies with every other user, with meetings with some of them."""
+    with flask_app.app_context():
+        DbManager.add_user("counted", PASSWORD)
+        user = DbManager.get_user("counted")
+        hobbies = [DbManager.add_hobby_to_user(user.id, f"counted hobby {i}") for i in range(HOBBIES)]
+        others = []
+        for i in range(USERS):
+            DbManager.add_user(f"counted-{i}", PASSWORD)
+            other = DbManager.get_user(f"counted-{i}")
+            for hobby in hobbies[: i + 1]:
+                DbManager.add_hobby_to_user(other.id, hobby.name)
+            others.append(other)
+
+        start = datetime.now().replace(microsecond=0) + timedelta(days=1)
+        for i, other in enumerate(others[:MEETINGS]):
+            DbManager.add_one_on_one(user.id, other.id, start + timedelta(hours=i))
+        wait_for_relation_jobs()
+        return {"user_id": user.id, "other": others[-1].username, "hobby_id": hobbies[0].id}
+
+
+@pytest.fixture
+def strict_budget(app):
+    app.config["QUERY_BUDGET_STRICT"] = True
+    yield
+    app.config["QUERY_BUDGET_STRICT"] = False
+
+
+@pytest.mark.parametrize(
+    ("path", "max_queries"),
+    [
+        ("/get_user_hobbies/{user_id}", 2),
+        ("/user/{other}", 3),
+        ("/hobby/{hobby_id}", 4),
+        ("/similar_hobbies/{hobby_id}", 2),
+        ("/most_common_user", 2),
+        ("/most_common_user_never_met", 2),
+        ("/get_user_one_on_ones/{user_id}", 2),
+        ("/get_user_one_on_ones/{user_id}/upcoming", 2),
+        ("/home_state", 6),
+    ],
+)
+def test_query_count_is_bounded(seeded, strict_budget, login, path, max_queries):
+    client = login("counted")
+    response = client.get(path.format(**seeded))
+
+    assert response.status_code == 200
+    assert int(response.headers["X-Query-Count"]) <= max_queries
+
+
+def test_sql_connection_statements_are_counted(app):
+    query_counter.start()
+    DbManager.sql_connection().execute("SELECT 1").fetchall()
+    DbManager.sql_connection().executemany("UPDATE hobby SET name = name WHERE id = ?", [(1,), (2,)])
+    db.session.rollback()
+
+    assert query_counter.stop() == 2
@@ -0,0 +1,38 @@
+import pytest
+from sqlalchemy import create_engine
+
+from user_db import create_hobby_name_index
+
+
+@pytest.fixture
+def old_database(tmp_path):
+    """A hobby table created before hobby names had a unique index."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'tables.db'}")
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            "CREATE TABLE hobby (id INTEGER PRIMARY KEY, name VARCHAR(150) NOT NULL, "
+            "user_count INTEGER NOT NULL)"
+        )
+        conn.exec_driver_sql("INSERT INTO hobby (name, user_count) VALUES ('chess', 1)")
+    yield engine
+    engine.dispose()
+
+
+def test_missing_index_is_created(old_database):
+    with old_database.begin() as conn:
+        create_hobby_name_index(conn)
+        create_hobby_name_index(conn)
+        conn.exec_driver_sql(
+            "INSERT INTO hobby (name, user_count) VALUES ('chess', 0) ON CONFLICT (name) DO NOTHING"
+        )
+        rows = conn.exec_driver_sql("SELECT name FROM hobby").fetchall()
+
+    assert rows == [("chess",)]
+
+
+def test_duplicate_names_point_to_migrate_db(old_database):
+    with old_database.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO hobby (name, user_count) VALUES ('chess', 1)")
+
+    with pytest.raises(RuntimeError, match="poe migrate-db"), old_database.begin() as conn:
+        create_hobby_name_index(conn)
@@ -0,0 +1,93 @@
+import fakeredis
+import pytest
+
+from shared_cache import SharedCache
+
+
+class CountingRedis(fakeredis.FakeRedis):
+    """FakeRedis that counts round trips, one per pipeline or command sent."""
+
+    round_trips = 0
+
+    def pipeline(self, *args, **kwargs):
+        pipe = super().pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def counted_execute(*args, **kwargs):
+            self.round_trips += 1
+            return execute(*args, **kwargs)
+
+        pipe.execute = counted_execute
+        return pipe
+
+    def delete(self, *names):
+        self.round_trips += 1
+        return super().delete(*names)
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def cache(server):
+    cache = SharedCache()
+    cache.client = CountingRedis(server=server)
+    return cache
+
+
+def test_set_many_and_get_many_use_one_round_trip_each(cache):
+    cache.set_many({"a": 1, "b": {"nested": [1, 2]}})
+    assert cache.client.round_trips == 1
+
+    assert cache.get_many(["a", "b", "missing"]) == [1, {"nested": [1, 2]}, None]
+    assert cache.client.round_trips == 2
+    assert cache.stats() == {"enabled": True, "hits": 2, "misses": 1, "hit_rate": 0.667}
+
+
+def test_values_are_stored_under_the_prefix_with_the_ttl(cache):
+    cache.set("key", "value", ttl=30)
+
+    assert cache.client.get(f"{cache.prefix}key") == b'"value"'
+    assert 0 < cache.client.ttl(f"{cache.prefix}key") <= 30
+
+
+def test_delete_invalidates(cache):
+    cache.set_many({"a": 1, "b": 2, "c": 3})
+    cache.delete("a", "b")
+
+    assert cache.get_many(["a", "b", "c"]) == [None, None, 3]
+
+
+def test_get_or_set_loads_once(cache):
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return 42
+
+    assert cache.get_or_set("answer", loader) == 42
+    assert cache.get_or_set("answer", loader) == 42
+    assert len(loads) == 1
+
+
+def test_redis_errors_are_misses(cache, server):
+    cache.set("a", 1)
+    server.connected = False
+
+    assert cache.get_many(["a", "b"]) == [None, None]
+    cache.set("a", 2)
+    cache.delete("a")
+    assert cache.get_or_set("a", lambda: 3) == 3
+
+    server.connected = True
+    assert cache.get("a") == 1
+
+
+def test_disabled_cache_always_misses():
+    cache = SharedCache()
+    cache.set("a", 1)
+
+    assert cache.get_many(["a"]) == [None]
+    assert not cache.stats()["enabled"]
@@ -1,13 +1,221 @@
-from datetime import datetime
+import functools
+import json
+import random
+import sqlite3
+import time
+from concurrent.futures import Future
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
 
-import bcrypt
+import numpy as np
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import make_transient_to_detached
 
-from helpers import UserException
+from availability import AvailabilityIndex, Meeting
+from embedding_store import MAX_SQL_PARAMS, find_embedding, get_embeddings, load_all_embeddings
+from helpers import LRUCache, UserException
+from hobby_index import RELATION_TOP_K, HobbyIndex, index_directory, write_lock
+from jobs import BackgroundJobQueue
+from leaderboard import PopularHobbiesCache
+from metrics import metrics
+from password_hashing import password_hasher
+from query_counter import query_counter
+from shared_cache import shared_cache
 
 db = SQLAlchemy()
 
+# Applied to every new SQLite connection, override with the SQLITE_PRAGMAS app config
+DEFAULT_SQLITE_PRAGMAS = {
+    # readers no longer block the writer, and the writer no longer blocks readers
+    "journal_mode": "WAL",
+    # with WAL, NORMAL only syncs at checkpoints and is still safe against corruption
+    "synchronous": "NORMAL",
+    # negative values are in KiB, 64MB of page cache per connection
+    "cache_size": -64000,
+    "mmap_size": 256 * 1024 * 1024,
+    # wait up to 5 seconds for a lock before failing with "database is locked"
+    "busy_timeout": 5000,
+}
+
+# Write transactions that still fail with "database is locked" are retried with backoff
+WRITE_RETRIES = 5
+WRITE_RETRY_DELAY = 0.05
+
+# Users loaded for every authenticated request are cached per worker, for at most USER_CACHE_TTL seconds
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 60.0
+USER_CACHE_COLUMNS = ("id", "username", "email")
+
+# Meetings last DEFAULT_MEETING_MINUTES unless scheduled otherwise, at most MAX_MEETING_MINUTES.
+# The maximum bounds how far back a conflict check looks, so it stays an index range read
+DEFAULT_MEETING_MINUTES = 30
+MAX_MEETING_MINUTES = 8 * 60
+
+# Matches are cached in the shared cache, when Redis is enabled, for at most MATCH_CACHE_TTL seconds
+MATCH_CACHE_TTL = 60
+MATCH_KINDS = ("most_common_user", "never_met_user")
+NO_MATCH_MESSAGE = "No other users share hobbies with the given user."
+
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas: dict) -> None:
+    """Apply the given pragmas to a DB-API SQLite connection."""
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+# Hobbies whose stored user_count differs from their number of UserHobby rows, in an id range
+HOBBY_COUNT_DRIFT_SQL = """
+    SELECT hobby.id, hobby.name, hobby.user_count, COUNT(user_hobby.user_id) AS actual_count
+    FROM hobby LEFT JOIN user_hobby ON user_hobby.hobby_id = hobby.id
+    WHERE hobby.id > :after AND hobby.id <= :until
+    GROUP BY hobby.id
+    HAVING hobby.user_count != actual_count
+"""
+_RECOUNT_HOBBIES_SQL = f"""
+    UPDATE hobby SET user_count = drift.actual_count
+    FROM ({HOBBY_COUNT_DRIFT_SQL}) AS drift
+    WHERE hobby.id = drift.id
+"""
+
+RECOUNT_BATCH_SIZE = 1000
+# the drift report lists at most this many hobbies, the counts always cover every hobby
+DRIFT_REPORT_LIMIT = 100
+
+
+# maintenance job that recounts Hobby.user_count, see DbManager.enqueue_recount_hobbies
+RECOUNT_JOB = "recount_hobbies"
+# a queued or running job without progress for this many seconds died with its worker, and
+# can be claimed again
+MAINTENANCE_JOB_TIMEOUT = 600
+
+# Queue a maintenance job unless a worker already queued or runs it. Returns the name when
+# this call claimed the job
+_CLAIM_MAINTENANCE_JOB_SQL = """
+    INSERT INTO maintenance_job (name, state, status, updated_at)
+    VALUES (:name, 'queued', :status, :now)
+    ON CONFLICT (name) DO UPDATE SET
+        state = excluded.state, status = excluded.status, updated_at = excluded.updated_at
+    WHERE state NOT IN ('queued', 'running') OR updated_at < :stale_before
+    RETURNING name
+"""
+
+
+def create_hobby_name_index(conn) -> None:
+    """
+    Create the unique index on hobby names that adding a hobby relies on, for databases
+    created before it existed, which create_all does not add to. Duplicate names need
+    `poe migrate-db` to merge them first.
+
+    :param conn: SQLAlchemy connection to the hobbies database.
+    """
+    try:
+        conn.exec_driver_sql("CREATE UNIQUE INDEX IF NOT EXISTS ix_hobby_name ON hobby (name)")
+    except IntegrityError as e:
+        raise RuntimeError(
+            "The hobby table has duplicate names, run `poe migrate-db` to merge them."
+        ) from e
+
+
+def save_maintenance_job(conn, name: str, state: str, status: dict) -> None:
+    """Publish the state and status of a maintenance job to every worker, in its own transaction."""
+    with conn:
+        conn.execute(
+            "INSERT INTO maintenance_job (name, state, status, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET "
+            "state = excluded.state, status = excluded.status, updated_at = excluded.updated_at",
+            (name, state, json.dumps(status, default=str), time.time()),
+        )
+
+
+def recount_hobby_counts(conn, dry_run=False, batch_size=RECOUNT_BATCH_SIZE, progress=None) -> dict:
+    """
+    Set every hobby's user_count to its number of UserHobby rows, one set-based UPDATE
+    per batch of hobby ids, so the write lock is only held for one batch at a time.
+
+    :param conn: DB-API SQLite connection.
+    :param dry_run: Only report the drift, without updating anything.
+    :param batch_size: Number of hobbies per batch.
+    :param progress: Called with the report after every batch.
+    :return: Report with the number of hobbies processed and drifted, and the drifted hobbies.
+    """
+    report = {
+        "dry_run": dry_run,
+        "total": conn.execute("SELECT COUNT(*) FROM hobby").fetchone()[0],
+        "processed": 0,
+        "drifted": 0,
+        "drift": [],
+    }
+    after = 0
+    while True:
+        batch = conn.execute(
+            "SELECT id FROM hobby WHERE id > ? ORDER BY id LIMIT ?", (after, batch_size)
+        ).fetchall()
+        if not batch:
+            break
+        bounds = {"after": after, "until": batch[-1][0]}
+        with conn:
+            drift = conn.execute(HOBBY_COUNT_DRIFT_SQL, bounds).fetchall()
+            if drift and not dry_run:
+                conn.execute(_RECOUNT_HOBBIES_SQL, bounds)
+
+        report["processed"] += len(batch)
+        report["drifted"] += len(drift)
+        report["drift"].extend(
+            {"id": hobby_id, "name": name, "stored": stored, "actual": actual}
+            for hobby_id, name, stored, actual in drift[: DRIFT_REPORT_LIMIT - len(report["drift"])]
+        )
+        after = bounds["until"]
+        if progress:
+            progress(report)
+    return report
+
+
+def retry_on_locked(fn):
+    """
+    Retry a DbManager write when SQLite reports the database as locked or busy, rolling
+    back the session and backing off exponentially between attempts.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        for attempt in range(WRITE_RETRIES):
+            try:
+                return fn(*args, **kwargs)
+            except (OperationalError, sqlite3.OperationalError) as e:
+                message = str(getattr(e, "orig", e)).lower()
+                if attempt == WRITE_RETRIES - 1 or ("locked" not in message and "busy" not in message):
+                    raise
+                db.session.rollback()
+                time.sleep(WRITE_RETRY_DELAY * 2**attempt * (1 + random.random()))
+        return None
+
+    return wrapper
+
+
+class SessionConnection:
+    """
+    The execute/executemany subset of a sqlite3 connection, running the statements through
+    the session's SQLAlchemy connection, for the embedding_store helpers that take a DB-API
+    connection. Unlike the driver connection, every statement fires before_cursor_execute,
+    so it counts in QueryCounter, X-Query-Count and the SQL metrics.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def execute(self, statement: str, parameters=()):
+        return self._connection.exec_driver_sql(statement, tuple(parameters))
+
+    def executemany(self, statement: str, seq_of_parameters) -> None:
+        rows = [tuple(parameters) for parameters in seq_of_parameters]
+        if rows:
+            self._connection.exec_driver_sql(statement, rows)
+
 
 class User(UserMixin, db.Model):
     """Master table for users, one record per user"""
@@ -18,24 +226,121 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(150), nullable=True)
 
 
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_cached_user(mapper, connection, user: User) -> None:
+    DbManager.invalidate_cached_user(user.id)
+    shared_cache.delete(f"user:{user.id}")
+
+
 class Hobby(db.Model):
     """Master table for Hobbies, one record per user"""
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # names are stored stripped and lower case, see DbManager.normalize_hobby_name
     name = db.Column(db.String(150), nullable=False)
     user_count = db.Column(db.Integer, nullable=False, default=0)
 
+    __table_args__ = (
+        db.Index("ix_hobby_name", "name", unique=True),
+        db.Index("ix_hobby_user_count", db.desc("user_count"), "id"),
+    )
+
 
 class UserHobby(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
     hobby_id = db.Column(db.Integer, db.ForeignKey("hobby.id"), primary_key=True)
 
+    __table_args__ = (db.Index("ix_user_hobby_hobby_id", "hobby_id", "user_id"),)
+
 
 class HobbyRelation(db.Model):
     hobby_id1 = db.Column(db.Integer, db.ForeignKey("hobby.id"), primary_key=True)
     hobby_id2 = db.Column(db.Integer, db.ForeignKey("hobby.id"), primary_key=True)
     similarity = db.Column(db.Float, nullable=False)
 
+    __table_args__ = (db.Index("ix_hobby_relation_hobby_id2", "hobby_id2", "hobby_id1"),)
+
+
+class HobbyEmbedding(db.Model):
+    """Cached sentence embedding of a hobby name, one record per hobby and model"""
+
+    hobby_id = db.Column(db.Integer, db.ForeignKey("hobby.id"), primary_key=True)
+    model = db.Column(db.String(150), primary_key=True)
+    vector = db.Column(db.LargeBinary, nullable=False)
+
+
+class UserOverlap(db.Model):
+    """
+    Number of hobbies two users share, kept up to date as hobbies are added and removed.
+    Stored in both directions so that the best match of a user is a single indexed read.
+    """
+
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    other_user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    shared_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index("ix_user_overlap_user_id_shared_count", "user_id", "shared_count"),
+        db.Index("ix_user_overlap_other_user_id", "other_user_id"),
+    )
+
+
+class MaintenanceJob(db.Model):
+    """
+    State of a maintenance job queued through the web app, shared by every gunicorn worker,
+    so that only one worker runs it and any worker can report its progress.
+    """
+
+    name = db.Column(db.String(50), primary_key=True)
+    # queued, running, done or failed
+    state = db.Column(db.String(20), nullable=False)
+    # JSON progress report of the job
+    status = db.Column(db.Text, nullable=False, default="{}")
+    # unix time of the last state or progress change
+    updated_at = db.Column(db.Float, nullable=False)
+
+
+# Every (user, other user, shared hobbies) triple, computed from scratch
+USER_OVERLAP_COUNTS_SQL = """
+    SELECT a.user_id, b.user_id AS other_user_id, COUNT(*) AS shared_count
+    FROM user_hobby a JOIN user_hobby b ON a.hobby_id = b.hobby_id AND a.user_id != b.user_id
+    GROUP BY a.user_id, b.user_id
+"""
+
+# Add or remove one shared hobby between a user and every other user who has the hobby
+_INCREMENT_OVERLAP_SQL = """
+    INSERT INTO user_overlap (user_id, other_user_id, shared_count)
+    SELECT :user_id, user_id, 1 FROM user_hobby WHERE hobby_id = :hobby_id AND user_id != :user_id
+    UNION ALL
+    SELECT user_id, :user_id, 1 FROM user_hobby WHERE hobby_id = :hobby_id AND user_id != :user_id
+    ON CONFLICT (user_id, other_user_id) DO UPDATE SET shared_count = shared_count + 1
+"""
+_DECREMENT_OVERLAP_SQL = """
+    UPDATE user_overlap SET shared_count = shared_count - 1
+    WHERE (user_id = :user_id AND other_user_id IN (
+            SELECT user_id FROM user_hobby WHERE hobby_id = :hobby_id
+        ))
+        OR (other_user_id = :user_id AND user_id IN (
+            SELECT user_id FROM user_hobby WHERE hobby_id = :hobby_id
+        ))
+"""
+# Add or remove a hobby of a user and its user_count in one write transaction. Conflicts on
+# the unique hobby name and the UserHobby key are resolved by SQLite, not by a prior SELECT
+_INSERT_HOBBY_SQL = """
+    INSERT INTO hobby (name, user_count) VALUES (:name, 0) ON CONFLICT (name) DO NOTHING RETURNING id
+"""
+_INSERT_USER_HOBBY_SQL = """
+    INSERT INTO user_hobby (user_id, hobby_id) SELECT id, :hobby_id FROM user WHERE id = :user_id
+    ON CONFLICT (user_id, hobby_id) DO NOTHING
+"""
+_DELETE_USER_HOBBY_SQL = """
+    DELETE FROM user_hobby WHERE user_id = :user_id AND hobby_id = :hobby_id
+"""
+_DELETE_EMPTY_OVERLAP_SQL = """
+    DELETE FROM user_overlap WHERE shared_count <= 0 AND (user_id = :user_id OR other_user_id = :user_id)
+"""
+
 
 class OneOnOne(db.Model):
     """
@@ -46,19 +351,69 @@ class OneOnOne(db.Model):
     user_id1 = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     user_id2 = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     date = db.Column(db.DateTime, nullable=False)
+    duration_minutes = db.Column(
+        db.Integer,
+        nullable=False,
+        default=DEFAULT_MEETING_MINUTES,
+        server_default=str(DEFAULT_MEETING_MINUTES),
+    )
 
-    __table_args__ = (db.UniqueConstraint("user_id1", "user_id2", "date", name="_user_meeting_uc"),)
+    __table_args__ = (
+        db.UniqueConstraint("user_id1", "user_id2", "date", name="_user_meeting_uc"),
+        db.Index("ix_one_on_one_user_id1_date", "user_id1", "date"),
+        db.Index("ix_one_on_one_user_id2_date", "user_id2", "date"),
+    )
 
 
 class DbManager:
     FILE_NAME = "tables.db"
+    app = None
+    relation_jobs = BackgroundJobQueue("hobby-relations")
+    popular_hobbies = PopularHobbiesCache()
+    maintenance_jobs = BackgroundJobQueue("maintenance")
+    # user id -> column values of the user, replaced in init_db with the configured size and TTL
+    user_cache = LRUCache(USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+    # calendars of recently active users, for conflict checks and free slots
+    availability = AvailabilityIndex()
+    _hobby_index: HobbyIndex | None = None
+    _hobby_index_version: str | None = None
 
     @classmethod
     def init_db(cls, app) -> None:
         """Initialize the database with the given Flask app."""
+        cls.app = app
         db.init_app(app)
+        pragmas = app.config.setdefault("SQLITE_PRAGMAS", DEFAULT_SQLITE_PRAGMAS)
+        password_hasher.init_app(app)
+        cls.user_cache = LRUCache(
+            app.config.setdefault("USER_CACHE_SIZE", USER_CACHE_SIZE),
+            ttl=app.config.setdefault("USER_CACHE_TTL", USER_CACHE_TTL),
+        )
         with app.app_context():
+            event.listen(db.engine, "connect", lambda conn, _: apply_sqlite_pragmas(conn, pragmas))
+            query_counter.install(db.engine)
+            metrics.install(db.engine)
             db.create_all()
+            with db.engine.begin() as conn:
+                create_hobby_name_index(conn)
+            cls._fill_user_overlap()
+
+    @classmethod
+    @retry_on_locked
+    def _fill_user_overlap(cls) -> None:
+        """Build the user_overlap table for databases created before it existed."""
+        if UserOverlap.query.first() or not UserHobby.query.first():
+            return
+        # checked again in the INSERT itself, as several workers can start at the same time
+        columns = "user_id, other_user_id, shared_count"
+        db.session.execute(
+            db.text(
+                f"INSERT INTO user_overlap ({columns}) "
+                f"SELECT {columns} FROM ({USER_OVERLAP_COUNTS_SQL}) "
+                "WHERE NOT EXISTS (SELECT 1 FROM user_overlap)"
+            )
+        )
+        db.session.commit()
 
     @classmethod
     def get_user(cls, username: str) -> User:
@@ -71,15 +426,44 @@ class DbManager:
         return User.query.get(user_id)
 
     @classmethod
+    def get_cached_user(cls, user_id: int) -> User | None:
+        """
+        Given a user_id, return the user object from this worker's user cache, then from the
+        shared cache, only reading the database when both miss. The password hash is not
+        cached, it is loaded when accessed.
+        """
+        values = cls.user_cache.get(user_id)
+        if values is None:
+            values = shared_cache.get(f"user:{user_id}")
+            if values is not None:
+                cls.user_cache.put(user_id, values)
+        if values is None:
+            user = db.session.get(User, user_id)
+            if user is not None:
+                values = {column: getattr(user, column) for column in USER_CACHE_COLUMNS}
+                cls.user_cache.put(user_id, values)
+                shared_cache.set(f"user:{user_id}", values)
+            return user
+
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    @classmethod
+    def invalidate_cached_user(cls, user_id: int) -> None:
+        """Drop a user from this worker's user cache, other workers drop it after USER_CACHE_TTL."""
+        cls.user_cache.pop(user_id)
+
+    @classmethod
+    @retry_on_locked
     def add_user(cls, username: str, password: str) -> None:
         """Given user details, add a new user."""
         if cls.get_user(username):
             raise UserException("Username already exists! Try again.")
 
-        hashed_password = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
         new_user = User(
             username=username,
-            password=hashed_password.decode("utf-8"),
+            password=password_hasher.hash(password),
             email=f"{username}@fake_email.com",
         )
         db.session.add(new_user)
@@ -87,75 +471,306 @@ class DbManager:
 
     @classmethod
     def check_user_password(cls, user: User, password: str) -> bool:
-        """Given a user object and a password, check if the password is correct."""
-        return bcrypt.checkpw(password.encode("utf-8"), user.password.encode("utf-8"))
+        """
+        Given a user object and a password, check if the password is correct. Hashes made with
+        another cost than BCRYPT_ROUNDS are replaced while the password is known.
+        """
+        if not password_hasher.check(password, user.password):
+            return False
+        if password_hasher.needs_rehash(user.password):
+            cls._rehash_password(user, password)
+        return True
+
+    @classmethod
+    @retry_on_locked
+    def _rehash_password(cls, user: User, password: str) -> None:
+        user.password = password_hasher.hash(password)
+        db.session.commit()
 
     @classmethod
-    def calculate_all_relations_for_hobby(cls, hobby: Hobby) -> None:
-        """Calculate all relations for a given hobby."""
-        # TODO: Implement this function
+    def sql_connection(cls) -> SessionConnection:
+        """Return a DB-API style connection running statements in the current session's transaction."""
+        return SessionConnection(db.session.connection())
 
     @classmethod
+    @retry_on_locked
+    def hobby_similarity(cls, hobby_id1: int, hobby_id2: int) -> float:
+        """Return the cosine similarity of two hobbies using their stored embeddings."""
+        hobbies = {hobby.id: hobby for hobby in Hobby.query.filter(Hobby.id.in_([hobby_id1, hobby_id2]))}
+        if hobby_id1 not in hobbies or hobby_id2 not in hobbies:
+            raise UserException("Hobby does not exist!")
+
+        emb1, emb2 = get_embeddings(
+            cls.sql_connection(),
+            [(hobby_id, hobbies[hobby_id].name) for hobby_id in (hobby_id1, hobby_id2)],
+        )
+        db.session.commit()
+        return float(emb1 @ emb2)
+
+    @classmethod
+    def calculate_all_relations_for_hobby(cls, hobby: Hobby) -> Future:
+        """Queue the calculation of all relations for a given hobby and return immediately."""
+        return cls.relation_jobs.submit(cls._calculate_relations_for_hobby_job, hobby.id, hobby.name)
+
+    @classmethod
+    def _calculate_relations_for_hobby_job(cls, hobby_id: int, hobby_name: str) -> int:
+        with cls.app.app_context():
+            return cls._calculate_relations_for_hobby(hobby_id, hobby_name)
+
+    @classmethod
+    @retry_on_locked
+    def _calculate_relations_for_hobby(cls, hobby_id: int, hobby_name: str) -> int:
+        """
+        Score one hobby against every stored embedding and upsert that row of HobbyRelation.
+        With RELATION_TOP_K, only its top k are stored, and the relations its neighbours no
+        longer need are trimmed so HobbyRelation stays the union of every hobby's top k. A
+        hobby whose top k the new one enters without being among the new one's top k only
+        gets that relation from the next calculate-hobby-relations.
+        """
+        conn = cls.sql_connection()
+        (vector,) = get_embeddings(conn, [(hobby_id, hobby_name)])
+        ids, embeddings = load_all_embeddings(conn)
+        others = ids != hobby_id
+        ids, similarities = ids[others], embeddings[others] @ vector
+        if RELATION_TOP_K:
+            top = np.argsort(-similarities)[:RELATION_TOP_K]
+            ids, similarities = ids[top], similarities[top]
+
+        # relations are stored with hobby_id1 > hobby_id2
+        conn.executemany(
+            "INSERT INTO hobby_relation (hobby_id1, hobby_id2, similarity) VALUES (?, ?, ?) "
+            "ON CONFLICT (hobby_id1, hobby_id2) DO UPDATE SET similarity = excluded.similarity",
+            (
+                (max(hobby_id, other_id), min(hobby_id, other_id), similarity)
+                for other_id, similarity in zip(ids.tolist(), similarities.tolist(), strict=True)
+            ),
+        )
+        if RELATION_TOP_K:
+            cls._trim_hobby_relations(conn, [hobby_id, *ids.tolist()], RELATION_TOP_K)
+        db.session.commit()
+        cls._add_to_hobby_index(hobby_id, vector)
+        return len(similarities)
+
+    @staticmethod
+    def _read_hobby_relations(conn, hobby_ids: set[int]) -> dict[int, list[tuple[float, int]]]:
+        """Return the (similarity, other hobby id) relations of each hobby, most similar first."""
+        relations = {hobby_id: [] for hobby_id in hobby_ids}
+        ordered = sorted(hobby_ids)
+        for start in range(0, len(ordered), MAX_SQL_PARAMS):
+            chunk = ordered[start : start + MAX_SQL_PARAMS]
+            placeholders = ", ".join("?" * len(chunk))
+            for column, other in (("hobby_id1", "hobby_id2"), ("hobby_id2", "hobby_id1")):
+                rows = conn.execute(
+                    f"SELECT {column}, {other}, similarity FROM hobby_relation "
+                    f"WHERE {column} IN ({placeholders})",
+                    chunk,
+                )
+                for hobby_id, other_id, similarity in rows:
+                    relations[hobby_id].append((similarity, other_id))
+        for pairs in relations.values():
+            pairs.sort(reverse=True)
+        return relations
+
+    @classmethod
+    def _trim_hobby_relations(cls, conn, hobby_ids: list[int], k: int) -> int:
+        """
+        Delete the relations of the given hobbies that are among the k most similar hobbies of
+        neither of their two hobbies, which calculate-hobby-relations --top-k would not store.
+
+        :return: Number of deleted relations.
+        """
+        relations = cls._read_hobby_relations(conn, set(hobby_ids))
+        beyond_top = {
+            (hobby_id, other_id) for hobby_id, pairs in relations.items() for _, other_id in pairs[k:]
+        }
+        others = {other_id for _, other_id in beyond_top} - relations.keys()
+        relations.update(cls._read_hobby_relations(conn, others))
+        top = {
+            hobby_id: {other_id for _, other_id in pairs[:k]} for hobby_id, pairs in relations.items()
+        }
+
+        # deleting pairs outside both top k leaves every top k as it was
+        stale = {
+            (max(hobby_id, other_id), min(hobby_id, other_id))
+            for hobby_id, other_id in beyond_top
+            if hobby_id not in top[other_id]
+        }
+        conn.executemany("DELETE FROM hobby_relation WHERE hobby_id1 = ? AND hobby_id2 = ?", stale)
+        return len(stale)
+
+    @classmethod
+    def hobby_index_directory(cls) -> Path:
+        return index_directory(cls.app.instance_path)
+
+    @classmethod
+    def get_hobby_index(cls) -> HobbyIndex:
+        """
+        Return the nearest neighbour index of this process, loading it from disk on first use
+        or when another process saved a newer one, and building it from the stored
+        embeddings when none was saved yet.
+        """
+        directory = cls.hobby_index_directory()
+        version = HobbyIndex.version(directory)
+        if cls._hobby_index is None or version != cls._hobby_index_version:
+            if version is None:
+                cls._hobby_index = HobbyIndex.build(*load_all_embeddings(cls.sql_connection()))
+            else:
+                cls._hobby_index = HobbyIndex.load(directory)
+            cls._hobby_index_version = version
+        return cls._hobby_index
+
+    @classmethod
+    def _add_to_hobby_index(cls, hobby_id: int, vector: np.ndarray) -> None:
+        # under the lock, get_hobby_index reloads the hobbies saved by other workers meanwhile,
+        # so that saving this index does not drop them
+        directory = cls.hobby_index_directory()
+        with write_lock(directory):
+            index = cls.get_hobby_index()
+            if not len(index):
+                index = HobbyIndex.build(np.array([hobby_id]), vector[None, :])
+            else:
+                index.add(np.array([hobby_id]), vector[None, :])
+            cls._hobby_index_version = index.save(directory)
+            cls._hobby_index = index
+
+    @classmethod
+    def get_similar_hobbies(cls, hobby_id: int, limit: int = 10) -> list[tuple[Hobby, float]]:
+        """Return the hobbies most similar to the given hobby, with their similarity."""
+        vector = find_embedding(cls.sql_connection(), hobby_id)
+        if vector is None:
+            return []
+
+        neighbours = cls.get_hobby_index().query(vector, k=limit, exclude=hobby_id)
+        hobbies = {
+            hobby.id: hobby for hobby in Hobby.query.filter(Hobby.id.in_([h for h, _ in neighbours]))
+        }
+        return [(hobbies[h], similarity) for h, similarity in neighbours if h in hobbies]
+
+    @staticmethod
+    def normalize_hobby_name(hobby_name: str) -> str:
+        """Return the form hobby names are stored in, which the unique index on Hobby.name relies on."""
+        return hobby_name.strip().lower()
+
+    @classmethod
+    @retry_on_locked
     def add_hobby_to_user(cls, user_id: int, hobby_name: str) -> Hobby:
         """Given a user and a hobby, create a new Hobby if it does not exist,
         link the user to the hobby in the UserHobby table.
         """
-        hobby_name = hobby_name.strip().lower()
+        hobby, created = cls._add_hobby_in_transaction(user_id, cls.normalize_hobby_name(hobby_name))
+        db.session.commit()
+        cls.invalidate_popular_hobbies()
+        cls.invalidate_cached_matches(user_id)
+
+        if created:
+            cls.calculate_all_relations_for_hobby(hobby)
+        return hobby
+
+    @classmethod
+    @retry_on_locked
+    def remove_hobby_from_user(cls, user_id: int, hobby_id: int) -> None:
+        """Given a user and a hobby, remove the hobby from the user."""
+        cls._remove_hobby_in_transaction(user_id, hobby_id)
+        db.session.commit()
+        cls.invalidate_popular_hobbies()
+        cls.invalidate_cached_matches(user_id)
+
+    @classmethod
+    @retry_on_locked
+    def apply_hobby_changes(cls, user_id: int, add: list[str], remove: list[int]) -> list[Hobby]:
+        """
+        Remove and add hobbies of a user in one transaction, so either every change is
+        applied or none is. Removals are applied first, and repeated names are added once.
+
+        :param user_id: The user whose hobbies change.
+        :param add: Names of the hobbies to add.
+        :param remove: IDs of the hobbies to remove.
+        :return: The added hobbies.
+        """
+        added, created = [], []
+        change = None
+        try:
+            for hobby_id in dict.fromkeys(remove):
+                change = f"removing hobby {hobby_id}"
+                cls._remove_hobby_in_transaction(user_id, hobby_id)
+            for hobby_name in dict.fromkeys(cls.normalize_hobby_name(name) for name in add):
+                change = f"adding {hobby_name!r}"
+                hobby, is_new = cls._add_hobby_in_transaction(user_id, hobby_name)
+                added.append(hobby)
+                if is_new:
+                    created.append(hobby)
+        except UserException as e:
+            # the failing change already rolled back the whole transaction
+            raise UserException(f"No changes were applied, {change} failed: {e}") from e
+        db.session.commit()
+        cls.invalidate_popular_hobbies()
+        cls.invalidate_cached_matches(user_id)
+
+        for hobby in created:
+            cls.calculate_all_relations_for_hobby(hobby)
+        return added
+
+    @classmethod
+    def _add_hobby_in_transaction(cls, user_id: int, hobby_name: str) -> tuple[Hobby, bool]:
+        """
+        Link a user to a hobby, given its normalized name, in the current transaction without
+        committing it. Return the hobby and whether it was created. Rolls back on errors.
+        """
         if not hobby_name:
+            db.session.rollback()
             raise UserException("Hobby name cannot be empty!")
 
-        # Check if User exists
-        user = User.query.get(user_id)
-        if not user:
-            raise UserException("User does not exist!")
-
-        # Check if Hobby exists
-        existing_hobby = Hobby.query.filter_by(name=hobby_name).first()
-        if not existing_hobby:
-            existing_hobby = Hobby(name=hobby_name)
-            db.session.add(existing_hobby)
-            db.session.commit()
-            cls.calculate_all_relations_for_hobby(existing_hobby)
-
-        # Ensure the hobby has a valid ID
-        if existing_hobby.id is None:
-            raise UserException("Failed to add hobby to the database!")
-
-        # Check if UserHobby already exists
-        existing_user_hobby = UserHobby.query.filter_by(
-            user_id=user_id, hobby_id=existing_hobby.id
-        ).first()
-        if existing_user_hobby:
-            raise UserException("Hobby already exists for this user!")
+        # the INSERT starts a write transaction, so no other writer can interleave
+        hobby_id = db.session.execute(db.text(_INSERT_HOBBY_SQL), {"name": hobby_name}).scalar()
+        created = hobby_id is not None
+        if not created:
+            hobby_id = db.session.execute(
+                db.select(Hobby.id).where(Hobby.name == hobby_name)
+            ).scalar_one()
 
-        existing_hobby.user_count += 1
-        new_user_hobby = UserHobby(user_id=user_id, hobby_id=existing_hobby.id)
-        db.session.add(new_user_hobby)
-        db.session.commit()
+        params = {"user_id": user_id, "hobby_id": hobby_id}
+        if not db.session.execute(db.text(_INSERT_USER_HOBBY_SQL), params).rowcount:
+            db.session.rollback()
+            if not db.session.get(User, user_id):
+                raise UserException("User does not exist!")
+            raise UserException("Hobby already exists for this user!")
 
-        return existing_hobby
+        hobby = db.session.scalars(
+            db.update(Hobby)
+            .where(Hobby.id == hobby_id)
+            .values(user_count=Hobby.user_count + 1)
+            .returning(Hobby)
+        ).one()
+        db.session.execute(db.text(_INCREMENT_OVERLAP_SQL), params)
+        # keep the returned row loaded, instead of it being expired and reloaded after the commit
+        db.session.expunge(hobby)
+        return hobby, created
 
     @classmethod
-    def remove_hobby_from_user(cls, user_id: int, hobby_id: int) -> None:
-        """Given a user and a hobby, remove the hobby from the user."""
-        hobby = Hobby.query.filter_by(id=hobby_id).first()
-        if not hobby:
-            raise UserException("Hobby does not exist!")
-        user_hobby = UserHobby.query.filter_by(user_id=user_id, hobby_id=hobby.id).first()
-        if not user_hobby:
+    def _remove_hobby_in_transaction(cls, user_id: int, hobby_id: int) -> None:
+        """Unlink a user from a hobby in the current transaction, rolling it back on errors."""
+        params = {"user_id": user_id, "hobby_id": hobby_id}
+        # the DELETE starts a write transaction, so no other writer can interleave
+        if not db.session.execute(db.text(_DELETE_USER_HOBBY_SQL), params).rowcount:
+            db.session.rollback()
+            if not db.session.get(Hobby, hobby_id):
+                raise UserException("Hobby does not exist!")
             raise UserException("User does not have this hobby!")
 
-        hobby = Hobby.query.get(hobby.id)
-        hobby.user_count -= 1
-        db.session.delete(user_hobby)
-        db.session.commit()
+        db.session.execute(
+            db.update(Hobby).where(Hobby.id == hobby_id).values(user_count=Hobby.user_count - 1)
+        )
+        db.session.execute(db.text(_DECREMENT_OVERLAP_SQL), params)
+        db.session.execute(db.text(_DELETE_EMPTY_OVERLAP_SQL), params)
 
     @classmethod
     def get_user_hobbies(cls, user_id: int) -> list[Hobby]:
         """Given a user, return a list of hobbies."""
-        user_hobbies = UserHobby.query.filter_by(user_id=user_id).all()
-        # Get the hobby names
-        return [Hobby.query.get(user_hobby.hobby_id) for user_hobby in user_hobbies]
+        return (
+            Hobby.query.join(UserHobby, UserHobby.hobby_id == Hobby.id)
+            .filter(UserHobby.user_id == user_id)
+            .all()
+        )
 
     @classmethod
     def number_of_hobbies(cls):
@@ -163,17 +778,113 @@ class DbManager:
         return Hobby.query.count()
 
     @classmethod
-    def get_most_popular_hobbies(cls, limit=15, offset=0):
-        """Return a list of the most popular hobbies."""
-        return Hobby.query.order_by(Hobby.user_count.desc()).limit(limit).offset(offset).all()
+    def get_most_popular_hobbies(cls, limit=15, after: tuple[int, int] | None = None):
+        """
+        Return a list of the most popular hobbies, starting after the (user_count, id) cursor
+        of the last hobby of the previous page.
+        """
+        query = Hobby.query.order_by(Hobby.user_count.desc(), Hobby.id)
+        if after is not None:
+            user_count, hobby_id = after
+            query = query.filter(
+                (Hobby.user_count < user_count)
+                | ((Hobby.user_count == user_count) & (Hobby.id > hobby_id))
+            )
+        return query.limit(limit).all()
 
     @classmethod
-    def recount_hobbies(cls):
-        """Recount the number of users for each hobby."""
-        hobbies = Hobby.query.all()
-        for hobby in hobbies:
-            hobby.user_count = UserHobby.query.filter_by(hobby_id=hobby.id).count()
+    def get_popular_hobbies_page(
+        cls, per_page: int, after: tuple[int, int] | None = None, page_num: int | None = None
+    ) -> tuple[list[tuple[int, int, str]], int]:
+        """
+        Return a page of (user_count, id, name) from the cached popular hobby ranking,
+        and the rank of its first hobby.
+        """
+        cls.popular_hobbies.refresh_if_needed(
+            lambda: shared_cache.get_or_set(
+                "popular_hobbies",
+                lambda: [
+                    tuple(row)
+                    for row in db.session.query(Hobby.user_count, Hobby.id, Hobby.name)
+                    .order_by(Hobby.user_count.desc(), Hobby.id)
+                    .all()
+                ],
+                ttl=cls.popular_hobbies.ttl,
+            )
+        )
+        return cls.popular_hobbies.page(per_page, after=after, page_num=page_num)
+
+    @classmethod
+    def invalidate_popular_hobbies(cls) -> None:
+        """Reload the popular hobby ranking on its next read, in this worker and in the shared cache."""
+        cls.popular_hobbies.invalidate()
+        shared_cache.delete("popular_hobbies")
+
+    @classmethod
+    def recount_hobbies(cls, dry_run: bool = False) -> dict:
+        """
+        Recount the number of users for each hobby, or only report the hobbies whose count
+        has drifted when dry_run is set. Progress is published in the maintenance_job table,
+        see get_recount_status.
+        """
+        status = {"started_at": str(datetime.now()), "dry_run": dry_run}
+        # a connection of its own, so batches and progress commit independently of the session
+        conn = db.engine.raw_connection()
+        driver_connection = conn.driver_connection
+
+        def publish(report):
+            status.update(report, drift=list(report["drift"]))
+            save_maintenance_job(driver_connection, RECOUNT_JOB, "running", status)
+
+        try:
+            save_maintenance_job(driver_connection, RECOUNT_JOB, "running", status)
+            report = recount_hobby_counts(driver_connection, dry_run=dry_run, progress=publish)
+            status["finished_at"] = str(datetime.now())
+            save_maintenance_job(driver_connection, RECOUNT_JOB, "done", status)
+        except Exception as e:
+            status["error"] = str(e)
+            save_maintenance_job(driver_connection, RECOUNT_JOB, "failed", status)
+            raise
+        finally:
+            conn.close()
+        if not dry_run:
+            cls.invalidate_popular_hobbies()
+        return report
+
+    @classmethod
+    @retry_on_locked
+    def enqueue_recount_hobbies(cls, dry_run: bool = False) -> dict:
+        """
+        Queue recount_hobbies as a maintenance job of this worker, unless a worker already
+        queued or runs a recount. The claim is one INSERT, so two workers never both run it.
+        """
+        now = time.time()
+        claimed = db.session.execute(
+            db.text(_CLAIM_MAINTENANCE_JOB_SQL),
+            {
+                "name": RECOUNT_JOB,
+                "status": json.dumps({"dry_run": dry_run}),
+                "now": now,
+                "stale_before": now - MAINTENANCE_JOB_TIMEOUT,
+            },
+        ).first()
         db.session.commit()
+        if claimed:
+            cls.maintenance_jobs.submit(cls._recount_hobbies_job, dry_run)
+        return cls.get_recount_status()
+
+    @classmethod
+    def get_recount_status(cls) -> dict:
+        """Return the state and progress of the last hobby recount, of whichever worker ran it."""
+        job = db.session.get(MaintenanceJob, RECOUNT_JOB)
+        if job is None:
+            return {"state": "idle"}
+        return {"state": job.state, **json.loads(job.status)}
+
+    @classmethod
+    def _recount_hobbies_job(cls, dry_run: bool) -> dict:
+        with cls.app.app_context():
+            return cls.recount_hobbies(dry_run=dry_run)
 
     @classmethod
     def get_hobby(cls, hobby_id: int) -> Hobby:
@@ -183,66 +894,140 @@ class DbManager:
     @classmethod
     def get_users_by_hobby(cls, hobby_id: int) -> list[User]:
         """Return a list of users who have a specific hobby."""
-        user_hobbies = UserHobby.query.filter_by(hobby_id=hobby_id).all()
-        return [User.query.get(user_hobby.user_id) for user_hobby in user_hobbies]
+        return (
+            User.query.join(UserHobby, UserHobby.user_id == User.id)
+            .filter(UserHobby.hobby_id == hobby_id)
+            .all()
+        )
+
+    @classmethod
+    def _cached_match(cls, kind: str, user_id: int, find_match) -> User:
+        """
+        Return the match of a user from the shared cache, or find it and cache its id, 0 for
+        users without a match. Raises UserException when there is no match, cached or not.
+        """
+        key = f"{kind}:{user_id}"
+        match_id = shared_cache.get(key)
+        if match_id is None:
+            try:
+                match = find_match(user_id)
+            except UserException:
+                shared_cache.set(key, 0, MATCH_CACHE_TTL)
+                raise
+            shared_cache.set(key, match.id, MATCH_CACHE_TTL)
+            return match
+
+        match = cls.get_cached_user(match_id) if match_id else None
+        if match is None:
+            raise UserException(NO_MATCH_MESSAGE)
+        return match
+
+    @classmethod
+    def get_cached_match_ids(cls, user_id: int) -> dict[str, int | None]:
+        """
+        Return the cached match id of each kind in MATCH_KINDS for a user, in one shared cache
+        round trip. Ids are 0 for users without a match, and None when nothing is cached.
+        """
+        return dict(
+            zip(MATCH_KINDS, shared_cache.get_many([f"{kind}:{user_id}" for kind in MATCH_KINDS]))
+        )
+
+    @classmethod
+    def invalidate_cached_matches(cls, *user_ids: int) -> None:
+        """Drop the cached matches of the given users, e.g. after their hobbies or meetings changed."""
+        shared_cache.delete(*(f"{kind}:{user_id}" for user_id in user_ids for kind in MATCH_KINDS))
 
     @classmethod
     def get_most_common_user(cls, user_id: int) -> User:
         """Search for the user with the most common hobbies with the given user."""
-        user_hobbies = UserHobby.query.filter_by(user_id=user_id).all()
-        user_hobby_ids = [user_hobby.hobby_id for user_hobby in user_hobbies]
-
-        # Find users who share the same hobbies
-        shared_hobbies = (
-            db.session.query(UserHobby.user_id, db.func.count(UserHobby.hobby_id).label("shared_count"))
-            .filter(UserHobby.hobby_id.in_(user_hobby_ids))
-            .filter(UserHobby.user_id != user_id)
-            .group_by(UserHobby.user_id)
-            .order_by(db.func.count(UserHobby.hobby_id).desc())
+        return cls._cached_match("most_common_user", user_id, cls._find_most_common_user)
+
+    @classmethod
+    def _find_most_common_user(cls, user_id: int) -> User:
+        most_common_user = (
+            User.query.join(UserOverlap, UserOverlap.other_user_id == User.id)
+            .filter(UserOverlap.user_id == user_id)
+            .order_by(UserOverlap.shared_count.desc())
             .first()
         )
 
-        if not shared_hobbies:
-            raise UserException("No other users share hobbies with the given user.")
+        # Fall back to the hobby similarity table when nobody shares an exact hobby
+        if not most_common_user:
+            return cls.get_most_similar_user(user_id)
+        return most_common_user
+
+    @classmethod
+    def _met_user_ids(cls, user_id: int):
+        """Return a subquery of the ids of users who had a one on one with the given user."""
+        return (
+            db.session.query(OneOnOne.user_id1)
+            .filter(OneOnOne.user_id2 == user_id)
+            .union(db.session.query(OneOnOne.user_id2).filter(OneOnOne.user_id1 == user_id))
+        )
+
+    @classmethod
+    def get_most_similar_user(cls, user_id: int, never_met: bool = False) -> User:
+        """
+        Search for the user whose hobbies are the most similar to the given user's hobbies,
+        scoring each candidate by the summed HobbyRelation similarity between their hobbies
+        and the given user's hobbies. The scoring is a single aggregated query.
+        """
+        mine = db.aliased(UserHobby)
+        theirs = db.aliased(UserHobby)
 
-        # TODO: if most_common_user is not found, we should use the hobby similarity
-        # table to find the most similar user.
+        def related_hobby_scores(hobby_column, related_column):
+            query = (
+                db.select(theirs.user_id, HobbyRelation.similarity)
+                .select_from(mine)
+                .join(HobbyRelation, hobby_column == mine.hobby_id)
+                .join(theirs, theirs.hobby_id == related_column)
+                .where(mine.user_id == user_id)
+                .where(theirs.user_id != user_id)
+            )
+            if never_met:
+                query = query.where(~theirs.user_id.in_(cls._met_user_ids(user_id)))
+            return query
 
-        # Get the user with the most shared hobbies
-        most_common_user_id = shared_hobbies.user_id
-        return User.query.get(most_common_user_id)
+        # relations are stored once per pair, so look them up in both directions
+        scores = db.union_all(
+            related_hobby_scores(HobbyRelation.hobby_id1, HobbyRelation.hobby_id2),
+            related_hobby_scores(HobbyRelation.hobby_id2, HobbyRelation.hobby_id1),
+        ).subquery()
+        score = db.func.sum(scores.c.similarity)
+
+        most_similar_user = (
+            db.session.query(User)
+            .join(scores, scores.c.user_id == User.id)
+            .group_by(User.id)
+            .order_by(score.desc())
+            .first()
+        )
+
+        if not most_similar_user:
+            raise UserException(NO_MATCH_MESSAGE)
+        return most_similar_user
 
     @classmethod
     def get_most_common_user_never_met(cls, user_id: int) -> User:
         """
         Search for the user with the most common hobbies with the given user who they have never met.
         """
-        user_hobbies = UserHobby.query.filter_by(user_id=user_id).all()
-        user_hobby_ids = [user_hobby.hobby_id for user_hobby in user_hobbies]
-
-        # Find users who share the same hobbies, make sure they have never met
-        shared_hobbies = (
-            db.session.query(UserHobby.user_id, db.func.count(UserHobby.hobby_id).label("shared_count"))
-            .filter(UserHobby.hobby_id.in_(user_hobby_ids))
-            .filter(UserHobby.user_id != user_id)
-            .filter(
-                ~UserHobby.user_id.in_(
-                    db.session.query(OneOnOne.user_id1)
-                    .filter(OneOnOne.user_id2 == user_id)
-                    .union(db.session.query(OneOnOne.user_id2).filter(OneOnOne.user_id1 == user_id))
-                )
-            )
-            .group_by(UserHobby.user_id)
-            .order_by(db.func.count(UserHobby.hobby_id).desc())
+        return cls._cached_match("never_met_user", user_id, cls._find_most_common_user_never_met)
+
+    @classmethod
+    def _find_most_common_user_never_met(cls, user_id: int) -> User:
+        most_common_user = (
+            User.query.join(UserOverlap, UserOverlap.other_user_id == User.id)
+            .filter(UserOverlap.user_id == user_id)
+            .filter(~UserOverlap.other_user_id.in_(cls._met_user_ids(user_id)))
+            .order_by(UserOverlap.shared_count.desc())
             .first()
         )
 
-        if not shared_hobbies:
-            raise UserException("No other users share hobbies with the given user.")
-
-        # Get the user with the most shared hobbies
-        most_common_user_id = shared_hobbies.user_id
-        return User.query.get(most_common_user_id)
+        # Fall back to the hobby similarity table when nobody shares an exact hobby
+        if not most_common_user:
+            return cls.get_most_similar_user(user_id, never_met=True)
+        return most_common_user
 
     @classmethod
     def get_user_one_on_ones(cls, user_id: int) -> list[OneOnOne]:
@@ -252,38 +1037,175 @@ class DbManager:
         ).all()
 
     @classmethod
-    def get_upcoming_one_on_ones(cls, user_id: int) -> list[OneOnOne]:
-        """Given a user, return a list of upcoming one on one meetings."""
+    def _one_on_ones_with_partners(
+        cls, user_id: int, filters=(), descending: bool = False, limit: int | None = None
+    ) -> list[tuple[OneOnOne, User]]:
+        """
+        Return the meetings of a user matching the given filters, with the other attendee,
+        ordered by (date, id). Meetings where the user is user_id1 and where they are user_id2
+        are read separately and combined with UNION ALL, so each side is a range scan of
+        its (user_id, date) index that stops after limit rows, instead of a scan of the
+        whole table for an OR.
+        """
+        direction = db.desc if descending else db.asc
+
+        def meetings_as(user_column, partner_column):
+            query = (
+                db.select(OneOnOne.id, OneOnOne.date, partner_column.label("partner_id"))
+                .where(user_column == user_id, *filters)
+                .order_by(direction(OneOnOne.date), direction(OneOnOne.id))
+                .limit(limit)
+            )
+            return db.select(query.subquery())
+
+        meetings = db.union_all(
+            meetings_as(OneOnOne.user_id1, OneOnOne.user_id2),
+            meetings_as(OneOnOne.user_id2, OneOnOne.user_id1),
+        ).subquery()
         return (
-            OneOnOne.query.filter((OneOnOne.user_id1 == user_id) | (OneOnOne.user_id2 == user_id))
-            .filter(OneOnOne.date > datetime.now())
-            .order_by(OneOnOne.date.asc())
+            db.session.query(OneOnOne, User)
+            .join(meetings, meetings.c.id == OneOnOne.id)
+            .join(User, User.id == meetings.c.partner_id)
+            .order_by(direction(meetings.c.date), direction(meetings.c.id))
+            .limit(limit)
             .all()
         )
 
     @classmethod
-    def get_past_one_on_ones(cls, user_id: int) -> list[OneOnOne]:
-        """Given a user, return a list of past one on one meetings."""
-        return (
-            OneOnOne.query.filter((OneOnOne.user_id1 == user_id) | (OneOnOne.user_id2 == user_id))
-            .filter(OneOnOne.date < datetime.now())
-            .order_by(OneOnOne.date.desc())
-            .all()
+    def get_user_one_on_ones_with_partners(cls, user_id: int) -> list[tuple[OneOnOne, User]]:
+        """Given a user, return their one on one meetings together with the other attendee."""
+        return cls._one_on_ones_with_partners(user_id)
+
+    @classmethod
+    def get_upcoming_one_on_ones(
+        cls, user_id: int, limit: int = 20, after: tuple[datetime, int] | None = None
+    ) -> list[tuple[OneOnOne, User]]:
+        """
+        Given a user, return their next upcoming one on one meetings with the other attendee,
+        soonest first, starting after the (date, id) cursor of the last meeting of the previous page.
+        """
+        # the plain date bound is what lets the index range start at the cursor
+        filters = [OneOnOne.date >= datetime.now(UTC).replace(tzinfo=None)]
+        if after is not None:
+            filters = [OneOnOne.date >= after[0], db.tuple_(OneOnOne.date, OneOnOne.id) > after]
+        return cls._one_on_ones_with_partners(user_id, filters, limit=limit)
+
+    @classmethod
+    def get_past_one_on_ones(
+        cls, user_id: int, limit: int = 20, before: tuple[datetime, int] | None = None
+    ) -> list[tuple[OneOnOne, User]]:
+        """
+        Given a user, return their most recent past one on one meetings with the other attendee,
+        latest first, starting before the (date, id) cursor of the last meeting of the previous page.
+        """
+        filters = [OneOnOne.date < datetime.now(UTC).replace(tzinfo=None)]
+        if before is not None:
+            filters = [OneOnOne.date <= before[0], db.tuple_(OneOnOne.date, OneOnOne.id) < before]
+        return cls._one_on_ones_with_partners(user_id, filters, descending=True, limit=limit)
+
+    @classmethod
+    def _load_calendar(cls, user_id: int) -> list[Meeting]:
+        """Return the meetings of a user that have not ended yet, with both index range reads."""
+        since = datetime.now(UTC).replace(tzinfo=None) - timedelta(minutes=MAX_MEETING_MINUTES)
+        columns = (OneOnOne.date, OneOnOne.duration_minutes, OneOnOne.id)
+        rows = db.session.execute(
+            db.union_all(
+                db.select(*columns).where(OneOnOne.user_id1 == user_id, OneOnOne.date >= since),
+                db.select(*columns).where(OneOnOne.user_id2 == user_id, OneOnOne.date >= since),
+            )
+        ).all()
+        return [
+            (date, date + timedelta(minutes=minutes), meeting_id) for date, minutes, meeting_id in rows
+        ]
+
+    @staticmethod
+    def _meeting_window(date: datetime, duration_minutes: int) -> tuple[datetime, datetime]:
+        """Return the naive UTC start and end of a meeting, after checking its duration."""
+        if not 0 < duration_minutes <= MAX_MEETING_MINUTES:
+            raise UserException(f"Meetings must last between 1 and {MAX_MEETING_MINUTES} minutes.")
+        if date.tzinfo is not None:
+            date = date.astimezone(UTC).replace(tzinfo=None)
+        return date, date + timedelta(minutes=duration_minutes)
+
+    @classmethod
+    def find_conflicts(
+        cls,
+        user_id1: int,
+        user_id2: int,
+        date: datetime,
+        duration_minutes: int = DEFAULT_MEETING_MINUTES,
+    ) -> list[Meeting]:
+        """Return the meetings of either user that overlap a meeting at date, as (start, end, id)."""
+        start, end = cls._meeting_window(date, duration_minutes)
+        return cls.availability.conflicts((user_id1, user_id2), start, end, cls._load_calendar)
+
+    @classmethod
+    def get_free_slots(
+        cls,
+        user_id1: int,
+        user_id2: int,
+        duration_minutes: int = DEFAULT_MEETING_MINUTES,
+        after: datetime | None = None,
+        count: int = 5,
+    ) -> list[datetime]:
+        """Return the starts (naive UTC) of the next slots in which both users are free."""
+        now = datetime.now(UTC).replace(tzinfo=None)
+        start, end = cls._meeting_window(max(after or now, now), duration_minutes)
+        return cls.availability.free_slots(
+            (user_id1, user_id2), start, end - start, cls._load_calendar, count=count
         )
 
     @classmethod
-    def add_one_on_one(cls, user_id1: int, user_id2: int, date: datetime) -> None:
-        """Given two users and a date, add a new one on one meeting."""
-        new_one_on_one = OneOnOne(user_id1=user_id1, user_id2=user_id2, date=date)
-        db.session.add(new_one_on_one)
+    @retry_on_locked
+    def add_one_on_one(
+        cls,
+        user_id1: int,
+        user_id2: int,
+        date: datetime,
+        duration_minutes: int = DEFAULT_MEETING_MINUTES,
+    ) -> int:
+        """Given two users, a date and a duration, add a meeting that overlaps none of theirs."""
+        user_ids = (user_id1, user_id2)
+        if cls.find_conflicts(user_id1, user_id2, date, duration_minutes):
+            raise UserException("One of you already has a meeting at that time.")
+
+        # checked again in the INSERT itself, as calendars of other workers can be outdated
+        start, end = cls._meeting_window(date, duration_minutes)
+        overlapping = db.select(OneOnOne.id).where(
+            db.or_(OneOnOne.user_id1.in_(user_ids), OneOnOne.user_id2.in_(user_ids)),
+            OneOnOne.date > start - timedelta(minutes=MAX_MEETING_MINUTES),
+            OneOnOne.date < end,
+            db.func.strftime("%s", OneOnOne.date).cast(db.Integer) + OneOnOne.duration_minutes * 60
+            > int(start.replace(tzinfo=UTC).timestamp()),
+        )
+        values = db.select(
+            db.literal(user_id1),
+            db.literal(user_id2),
+            db.literal(start, db.DateTime),
+            db.literal(duration_minutes),
+        ).where(~overlapping.exists())
+        one_on_one_id = db.session.execute(
+            db.insert(OneOnOne)
+            .from_select(["user_id1", "user_id2", "date", "duration_minutes"], values)
+            .returning(OneOnOne.id)
+        ).scalar()
+        if one_on_one_id is None:
+            db.session.rollback()
+            cls.availability.invalidate(*user_ids)
+            raise UserException("One of you already has a meeting at that time.")
         db.session.commit()
 
+        cls.availability.add(user_ids, (start, end, one_on_one_id))
+        cls.invalidate_cached_matches(user_id1, user_id2)
+        return one_on_one_id
+
     @classmethod
     def get_one_on_one(cls, one_on_one_id: int) -> OneOnOne:
         """Given a one on one meeting ID, return the meeting."""
         return OneOnOne.query.get(one_on_one_id)
 
     @classmethod
+    @retry_on_locked
     def cancel_one_on_one(cls, one_on_one_id: int) -> None:
         """Given a one on one meeting ID, cancel the meeting."""
         one_on_one = OneOnOne.query.get(one_on_one_id)
@@ -291,3 +1213,7 @@ class DbManager:
             raise UserException("One on one meeting does not exist!")
         db.session.delete(one_on_one)
         db.session.commit()
+        cls.availability.remove(
+            (one_on_one.user_id1, one_on_one.user_id2), one_on_one.id, one_on_one.date
+        )
+        cls.invalidate_cached_matches(one_on_one.user_id1, one_on_one.user_id2)